@@ -1,14 +1,20 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, send_from_directory, make_response
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, send_from_directory, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
 import time
 import json
+import math
 import os
 import requests
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import uuid
+import threading
+import atexit
+from bisect import bisect_left, insort
+from collections import deque
+import numpy as np
 # Load environment variables
 load_dotenv()
 app = Flask(__name__)
@@ -21,6 +27,10 @@ IMAGE_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'images')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['IMAGE_UPLOAD_FOLDER'] = IMAGE_UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Monthly Parquet/npz partitions written by columnar_export.py
+app.config['COLUMNAR_EXPORT_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports', 'columnar')
+# Result files of background report jobs
+app.config['REPORT_JOB_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports', 'report_jobs')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 # Ensure upload directories exist
 os.makedirs(IMAGE_UPLOAD_FOLDER, exist_ok=True)
@@ -31,7 +41,98 @@ def allowed_file(filename):
 db = SQLAlchemy(app)
 # Performance optimizations
 from flask_caching import Cache
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})
+from functools import wraps
+# Use FileSystemCache, RedisCache, MemcachedCache or UWSGICache (shared memory) to share hits between workers
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'SimpleCache')
+app.config['CACHE_DIR'] = os.getenv('CACHE_DIR', os.path.join(app.instance_path, 'cache'))
+app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL')
+app.config['CACHE_DEFAULT_TIMEOUT'] = int(os.getenv('CACHE_DEFAULT_TIMEOUT', 3600))
+cache = Cache(app)
+# Write generations: every commit that writes a table moves that table's counter forward,
+# so cached results keyed on the counters of the tables they read are invalidated exactly.
+# Counters live in the database, so every worker sees every other worker's writes whatever
+# the cache backend (the default SimpleCache is per process).
+TABLE_GENERATION_WILDCARD = '*'  # bumped by raw SQL writes whose table can't be determined
+class TableGeneration(db.Model):
+    __tablename__ = 'table_generations'
+    table_name = db.Column(db.String(100), primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False)
+def table_generations(tables):
+    # Own connection, so reading counters never opens a transaction on the request session
+    with db.engine.connect() as conn:
+        stored = dict(conn.execute(db.select(TableGeneration.table_name, TableGeneration.generation).where(
+            TableGeneration.table_name.in_(tables)
+        )).all())
+    return {table: stored.get(table, 0) for table in tables}
+def bump_table_generations(tables):
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = TableGeneration.__table__
+    statement = insert(table)
+    # Never below the clock, so counters keep moving forward if the database is restored under a shared cache
+    statement = statement.on_conflict_do_update(index_elements=['table_name'], set_={
+        'generation': db.case(
+            (table.c.generation + 1 > statement.excluded.generation, table.c.generation + 1),
+            else_=statement.excluded.generation
+        )
+    })
+    now = time.time_ns()
+    with db.engine.begin() as conn:
+        conn.execute(statement, [{'table_name': name, 'generation': now} for name in tables])
+def _written_tables(sess):
+    return sess.info.setdefault('written_tables', set())
+@db.event.listens_for(db.session, 'after_flush')
+def _track_flushed_tables(sess, flush_context):
+    written = _written_tables(sess)
+    for obj in list(sess.new) + list(sess.dirty) + list(sess.deleted):
+        written.update(table.name for table in db.inspect(obj).mapper.tables)
+@db.event.listens_for(db.session, 'do_orm_execute')
+def _track_executed_tables(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        _written_tables(orm_execute_state.session).add(table.name if table is not None else TABLE_GENERATION_WILDCARD)
+    elif isinstance(orm_execute_state.statement, db.TextClause):
+        verb = str(orm_execute_state.statement).lstrip().split(None, 1)[:1]
+        if verb and verb[0].lower() in ('insert', 'update', 'delete', 'replace'):
+            _written_tables(orm_execute_state.session).add(TABLE_GENERATION_WILDCARD)
+@db.event.listens_for(db.session, 'after_commit')
+def _bump_committed_tables(sess):
+    written = sess.info.pop('written_tables', None)
+    if written:
+        bump_table_generations(sorted(written))
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _discard_written_tables(sess, previous_transaction):
+    sess.info.pop('written_tables', None)
+def cached_by_tables(*tables):
+    """Cache a GET view's response until one of the tables it reads is written.
+    The key covers the path, query string, the current date (for relative date windows) and the table generations."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            generations = table_generations(sorted(tables) + [TABLE_GENERATION_WILDCARD])
+            key = 'view:{}?{}:{}:{}'.format(
+                request.path,
+                '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True))),
+                datetime.utcnow().date().isoformat(),
+                ','.join(f'{t}={g}' for t, g in generations.items())
+            )
+            hit = cache.get(key)
+            if hit is not None:
+                body, status, headers = hit
+                response = make_response(body, status, headers)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                cache.set(key, (response.get_data(), response.status_code, [
+                    (name, value) for name, value in response.headers.items() if name.lower() != 'content-length'
+                ]))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
 # Add cache headers for static assets
 @app.after_request
 def add_cache_headers(response):
@@ -66,6 +167,15 @@ def get_customer_loyalty_tier(points):
         return 'silver'
     else:
         return 'bronze'
+def loyalty_tier_case(points_column):
+    """SQL equivalent of get_customer_loyalty_tier, for bucketing customers in a GROUP BY"""
+    points = db.func.coalesce(points_column, 0)
+    return db.case(
+        (points >= LOYALTY_TIER_THRESHOLDS['platinum'], 'platinum'),
+        (points >= LOYALTY_TIER_THRESHOLDS['gold'], 'gold'),
+        (points >= LOYALTY_TIER_THRESHOLDS['silver'], 'silver'),
+        else_='bronze'
+    )
 def get_next_tier_threshold(points):
     """Get the points needed for the next tier"""
     points = points or 0
@@ -84,10 +194,45 @@ def get_points_to_next_tier(points):
     if next_threshold:
         return next_threshold - points
     return 0  # Already at max tier
+# Reservation configuration
+RESERVATION_DEFAULT_DURATION_MINUTES = 90
+RESERVATION_MAX_DURATION_MINUTES = 360  # also bounds the index range scanned by overlap queries
+RESERVATION_ACTIVE_STATUSES = ('confirmed', 'seated')  # statuses that hold a table
+RESERVATION_SLOT_MINUTES = 15  # granularity of free-slot search
+RESERVATION_SERVICE_HOURS = (11, 23)  # default window searched for free slots
+# Table assignment scoring (lower is better)
+ASSIGNMENT_WASTE_PENALTY = 1.0  # per empty seat
+ASSIGNMENT_LOCATION_PENALTY = 3.0  # per table outside the requested location
+ASSIGNMENT_COMBINATION_PENALTY = 2.5  # per table joined beyond the first
+ASSIGNMENT_IDLE_GAP_PENALTY = 1.5  # per hour left between bookings that is too short to sell
+ASSIGNMENT_MAX_COMBINED_TABLES = 3
+ASSIGNMENT_LARGE_PARTY = 6  # combinations are considered from this size up, or when no single table fits
+# Waitlist quotes
+WAITLIST_ACTIVE_STATUSES = ('waiting', 'notified')  # parties still in the queue
+WAITLIST_DEFAULT_TURN_MINUTES = 60  # used for a table size until enough turns have been seen
+WAITLIST_MIN_TURN_SAMPLES = 5
+WAITLIST_QUOTE_STDDEVS = 0.5  # quote a little above the mean turn so most parties are seated early
+WAITLIST_MIN_REMAINING_MINUTES = 5  # an occupied table past its expected turn is still a few minutes away
+WAITLIST_CLEANING_MINUTES = 5
+WAITLIST_QUOTE_ROUNDING_MINUTES = 5
+TURN_TIME_EWMA_WEIGHT = 0.05  # weight of the newest turn, about the last 20 turns per table size
+TURN_TIME_MIN_SECONDS = 5 * 60  # shorter or longer occupancies are mistakes, not turns
+TURN_TIME_MAX_SECONDS = 6 * 3600
 # Notification configuration
 LOW_STOCK_THRESHOLD = 20  # percentage
 CRITICAL_STOCK_THRESHOLD = 10  # percentage
 EXPIRING_ITEMS_DAYS = 7  # days before expiration alert
+# Reorder point configuration
+REORDER_HISTORY_DAYS = 90  # days of usage history used to estimate demand
+REORDER_DEFAULT_LEAD_TIME_DAYS = 2  # used when an ingredient has no lead time set
+REORDER_REVIEW_PERIOD_DAYS = 7  # par level covers lead time plus one review period
+REORDER_SERVICE_LEVEL_Z = 1.65  # ~95% cycle service level
+# Background report job configuration
+REPORT_JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', 2))  # processes per web worker
+REPORT_JOB_QUEUE_SIZE = int(os.getenv('REPORT_JOB_QUEUE_SIZE', 20))  # queued + running jobs across all workers
+REPORT_JOBS_PER_USER = int(os.getenv('REPORT_JOBS_PER_USER', 2))  # queued + running jobs per user
+REPORT_JOB_RESULT_TTL_HOURS = int(os.getenv('REPORT_JOB_RESULT_TTL_HOURS', 24))
+REPORT_JOB_STALE_MINUTES = int(os.getenv('REPORT_JOB_STALE_MINUTES', 30))  # a job running longer was lost to a crash or restart
 # Database Models
 class User(db.Model):
     __tablename__ = 'users'
@@ -204,6 +349,10 @@ class Ingredient(db.Model):
     cost_per_unit = db.Column(db.Float, default=0.0)  # FIXED: Default to 0.0 instead of NULL
     supplier = db.Column(db.String(100))
     last_restocked = db.Column(db.DateTime)
+    lead_time_days = db.Column(db.Float)  # supplier lead time used for reorder points
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'))  # preferred supplier for purchase orders
+    pack_size = db.Column(db.Float)  # order in multiples of this quantity
+    min_order_qty = db.Column(db.Float)  # supplier minimum per order line
 class Recipe(db.Model):
     __tablename__ = 'recipes'
     id = db.Column(db.Integer, primary_key=True)
@@ -219,6 +368,10 @@ class Table(db.Model):
     capacity = db.Column(db.Integer, nullable=False)
     status = db.Column(db.String(20), default='available')  # available, occupied, reserved, cleaning
     location = db.Column(db.String(100))  # indoor, outdoor, bar, etc.
+    occupied_since = db.Column(db.DateTime)
+    # Seated party while occupied; no FK so Order.table stays the only join path between the tables
+    current_order_id = db.Column(db.Integer)
+    party_size = db.Column(db.Integer)
 class Customer(db.Model):
     __tablename__ = 'customers'
     id = db.Column(db.Integer, primary_key=True)
@@ -226,10 +379,45 @@ class Customer(db.Model):
     last_name = db.Column(db.String(50), nullable=False)
     email = db.Column(db.String(120), unique=True)
     phone = db.Column(db.String(20))
-    loyalty_points = db.Column(db.Integer, default=0)
+    loyalty_points = db.Column(db.Integer, default=0)  # running balance of loyalty_ledger, only changed by post_loyalty_entry
+    loyalty_tier = db.Column(db.String(20), default='bronze', nullable=False)
     total_orders = db.Column(db.Integer, default=0)
     total_spent = db.Column(db.Float, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Lookup keys kept in sync by _normalize_customer_lookup_keys (see normalize_phone/normalize_email)
+    phone_normalized = db.Column(db.String(20))
+    email_normalized = db.Column(db.String(120))
+    name_normalized = db.Column(db.String(101))  # 'first last'
+    reversed_name_normalized = db.Column(db.String(101))  # 'last first', so a surname is a prefix too
+    __table_args__ = (
+        # Top spenders: ORDER BY total_spent DESC LIMIT n walks the index instead of sorting the table
+        db.Index('ix_customers_total_spent', 'total_spent'),
+        # Type-ahead lookup: prefix ranges on the normalized keys
+        db.Index('ix_customers_phone_normalized', 'phone_normalized'),
+        db.Index('ix_customers_email_normalized', 'email_normalized'),
+        db.Index('ix_customers_name_normalized', 'name_normalized'),
+        db.Index('ix_customers_reversed_name_normalized', 'reversed_name_normalized'),
+        # Paginated customer list, newest first
+        db.Index('ix_customers_created_at', 'created_at'),
+        db.Index('ix_customers_loyalty_tier', 'loyalty_tier'),
+    )
+# Append-only record of every loyalty points change
+class LoyaltyLedger(db.Model):
+    __tablename__ = 'loyalty_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    entry_type = db.Column(db.String(20), nullable=False)  # opening, accrual, accrual_reversal, redemption, adjustment
+    points = db.Column(db.Integer, nullable=False)  # signed
+    description = db.Column(db.String(200))
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = (
+        db.Index('ix_loyalty_ledger_customer_created', 'customer_id', 'created_at'),
+        # An order accrues points at most once, however many paths try to accrue it
+        db.Index('uq_loyalty_ledger_order_accrual', 'order_id', unique=True,
+                 sqlite_where=db.text("entry_type = 'accrual'"), postgresql_where=db.text("entry_type = 'accrual'")),
+    )
 class Reservation(db.Model):
     __tablename__ = 'reservations'
     id = db.Column(db.Integer, primary_key=True)
@@ -237,11 +425,62 @@ class Reservation(db.Model):
     table_id = db.Column(db.Integer, db.ForeignKey('tables.id'))
     party_size = db.Column(db.Integer, nullable=False)
     reservation_time = db.Column(db.DateTime, nullable=False)
+    duration_minutes = db.Column(db.Integer, default=RESERVATION_DEFAULT_DURATION_MINUTES, nullable=False)
+    end_time = db.Column(db.DateTime)  # reservation_time + duration_minutes, stamped on flush
     status = db.Column(db.String(20), default='confirmed')  # confirmed, seated, completed, cancelled
     special_requests = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     customer = db.relationship('Customer', backref=db.backref('reservations', lazy=True))
     table = db.relationship('Table', backref=db.backref('reservations', lazy=True))
+    __table_args__ = (
+        # Overlap checks: table_id = ? AND reservation_time BETWEEN ? AND ? AND end_time > ?
+        db.Index('ix_reservations_table_start_end', 'table_id', 'reservation_time', 'end_time'),
+        # Loading one service day for the in-memory index
+        db.Index('ix_reservations_start_end', 'reservation_time', 'end_time'),
+    )
+    @property
+    def table_ids(self):
+        """Primary table first, then any tables joined to it for a large party"""
+        return ([self.table_id] if self.table_id else []) + [jt.table_id for jt in self.joined_tables]
+# Extra tables pushed together with a reservation's primary table
+class ReservationTable(db.Model):
+    __tablename__ = 'reservation_tables'
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservations.id'), primary_key=True)
+    table_id = db.Column(db.Integer, db.ForeignKey('tables.id'), primary_key=True)
+    reservation = db.relationship('Reservation', backref=db.backref('joined_tables', lazy=True, cascade='all, delete-orphan'))
+    table = db.relationship('Table')
+    __table_args__ = (
+        db.Index('ix_reservation_tables_table', 'table_id', 'reservation_id'),
+    )
+# Walk-in parties waiting for a table
+class WaitlistEntry(db.Model):
+    __tablename__ = 'waitlist_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'))
+    name = db.Column(db.String(100), nullable=False)
+    phone = db.Column(db.String(20))
+    party_size = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='waiting')  # waiting, notified, seated, cancelled, no_show
+    quoted_minutes = db.Column(db.Integer)  # wait quoted when the party joined
+    table_id = db.Column(db.Integer, db.ForeignKey('tables.id'))
+    notes = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    notified_at = db.Column(db.DateTime)
+    seated_at = db.Column(db.DateTime)
+    removed_at = db.Column(db.DateTime)
+    customer = db.relationship('Customer')
+    table = db.relationship('Table')
+    __table_args__ = (
+        db.Index('ix_waitlist_entries_status_created', 'status', 'created_at'),
+    )
+# Rolling table turn statistics per table size, folded in one turn at a time
+class TableTurnStats(db.Model):
+    __tablename__ = 'table_turn_stats'
+    capacity = db.Column(db.Integer, primary_key=True)
+    samples = db.Column(db.Integer, default=0, nullable=False)
+    mean_seconds = db.Column(db.Float, default=0, nullable=False)  # exponentially weighted
+    variance_seconds = db.Column(db.Float, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 class Order(db.Model):
     __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True)
@@ -254,10 +493,16 @@ class Order(db.Model):
     discount_amount = db.Column(db.Float, default=0)
     final_amount = db.Column(db.Float, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    confirmed_at = db.Column(db.DateTime)  # sent to the kitchen
+    first_item_ready_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
     notes = db.Column(db.Text)
     customer = db.relationship('Customer', backref=db.backref('orders', lazy=True))
     table = db.relationship('Table', backref=db.backref('orders', lazy=True))
+    __table_args__ = (
+        # Covering index for revenue reports: filter on status/date, sum final_amount without touching the table
+        db.Index('ix_orders_status_created_final', 'status', 'created_at', 'final_amount'),
+    )
 class OrderItem(db.Model):
     __tablename__ = 'order_items'
     id = db.Column(db.Integer, primary_key=True)
@@ -267,6 +512,9 @@ class OrderItem(db.Model):
     price = db.Column(db.Float, nullable=False)
     special_instructions = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending')  # pending, cooking, ready, served
+    started_at = db.Column(db.DateTime)
+    ready_at = db.Column(db.DateTime)
+    served_at = db.Column(db.DateTime)
     order = db.relationship('Order', backref=db.backref('items', lazy=True))
     menu_item = db.relationship('MenuItem', backref=db.backref('order_items', lazy=True))
 class Payment(db.Model):
@@ -298,8 +546,16 @@ class InventoryTransaction(db.Model):
     transaction_date = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.Text)
     related_order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    delivery_id = db.Column(db.Integer, db.ForeignKey('supplier_deliveries.id'))
+    lot_id = db.Column(db.Integer, db.ForeignKey('ingredient_lots.id'))
+    # Cost snapshot taken when the transaction is written, so later price changes don't rewrite history
+    unit_cost = db.Column(db.Float)
+    total_cost = db.Column(db.Float)
     ingredient = db.relationship('Ingredient', backref=db.backref('transactions', lazy=True))
     order = db.relationship('Order', backref=db.backref('inventory_transactions', lazy=True))
+    __table_args__ = (
+        db.Index('ix_inventory_transactions_type_date_cost', 'transaction_type', 'transaction_date', 'total_cost'),
+    )
 # Suppliers
 class Supplier(db.Model):
     __tablename__ = 'suppliers'
@@ -310,6 +566,164 @@ class Supplier(db.Model):
     phone = db.Column(db.String(50))
     address = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+# Supplier deliveries (one delivery note -> many purchase transactions)
+class SupplierDelivery(db.Model):
+    __tablename__ = 'supplier_deliveries'
+    id = db.Column(db.Integer, primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), nullable=False)
+    reference = db.Column(db.String(100))  # supplier's delivery note / invoice number
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    line_count = db.Column(db.Integer, default=0)
+    total_cost = db.Column(db.Float, default=0.0)
+    notes = db.Column(db.Text)
+    received_by_user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    supplier = db.relationship('Supplier', backref=db.backref('deliveries', lazy=True))
+    received_by = db.relationship('User')
+# Purchase orders
+class PurchaseOrder(db.Model):
+    __tablename__ = 'purchase_orders'
+    id = db.Column(db.Integer, primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('suppliers.id'), nullable=False)
+    status = db.Column(db.String(20), default='draft', index=True)  # draft, sent, received, cancelled
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    received_at = db.Column(db.DateTime)
+    total_cost = db.Column(db.Float, default=0.0)
+    notes = db.Column(db.Text)
+    delivery_id = db.Column(db.Integer, db.ForeignKey('supplier_deliveries.id'))
+    created_by_user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    supplier = db.relationship('Supplier', backref=db.backref('purchase_orders', lazy=True))
+class PurchaseOrderLine(db.Model):
+    __tablename__ = 'purchase_order_lines'
+    id = db.Column(db.Integer, primary_key=True)
+    purchase_order_id = db.Column(db.Integer, db.ForeignKey('purchase_orders.id'), nullable=False, index=True)
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), nullable=False, index=True)
+    quantity = db.Column(db.Float, nullable=False)
+    pack_size = db.Column(db.Float)
+    unit_cost = db.Column(db.Float, default=0.0)
+    line_total = db.Column(db.Float, default=0.0)
+    quantity_received = db.Column(db.Float)
+    purchase_order = db.relationship('PurchaseOrder', backref=db.backref('lines', lazy=True))
+    ingredient = db.relationship('Ingredient')
+# Ingredient lots (received batches with expiry), consumed first-expired-first-out
+class IngredientLot(db.Model):
+    __tablename__ = 'ingredient_lots'
+    id = db.Column(db.Integer, primary_key=True)
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), nullable=False)
+    delivery_id = db.Column(db.Integer, db.ForeignKey('supplier_deliveries.id'))
+    lot_code = db.Column(db.String(100))
+    received_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expiry_date = db.Column(db.DateTime)
+    quantity_received = db.Column(db.Float, nullable=False)
+    quantity_remaining = db.Column(db.Float, nullable=False)
+    cost_per_unit = db.Column(db.Float)
+    ingredient = db.relationship('Ingredient', backref=db.backref('lots', lazy=True))
+    __table_args__ = (
+        # Drives the "expiring within N days" query
+        db.Index('ix_ingredient_lots_expiry_remaining', 'expiry_date', 'quantity_remaining'),
+        # FEFO consumption order per ingredient
+        db.Index('ix_ingredient_lots_fefo', 'ingredient_id', 'expiry_date', 'received_at'),
+    )
+# Reorder points computed in batch from usage history
+class ReorderSuggestion(db.Model):
+    __tablename__ = 'reorder_suggestions'
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), primary_key=True)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    history_days = db.Column(db.Integer)
+    avg_daily_usage = db.Column(db.Float, default=0)
+    usage_std = db.Column(db.Float, default=0)
+    lead_time_days = db.Column(db.Float)
+    safety_stock = db.Column(db.Float, default=0)
+    reorder_point = db.Column(db.Float, default=0, index=True)
+    par_level = db.Column(db.Float, default=0)
+    suggested_order_qty = db.Column(db.Float, default=0)
+    ingredient = db.relationship('Ingredient', backref=db.backref('reorder_suggestion', uselist=False, lazy=True))
+# Reporting rollups, maintained in the same transaction as the writes they summarize
+class DailySales(db.Model):
+    __tablename__ = 'daily_sales'
+    day = db.Column(db.Date, primary_key=True)  # order creation day
+    orders = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    discounts = db.Column(db.Float, default=0, nullable=False)
+    items_sold = db.Column(db.Integer, default=0, nullable=False)
+    payments_total = db.Column(db.Float, default=0, nullable=False)  # by payment day
+    payments_count = db.Column(db.Integer, default=0, nullable=False)
+class HourlySales(db.Model):
+    __tablename__ = 'hourly_sales'
+    day = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)
+    orders = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    items_sold = db.Column(db.Integer, default=0, nullable=False)
+class DailyItemSales(db.Model):
+    __tablename__ = 'daily_item_sales'
+    day = db.Column(db.Date, primary_key=True)
+    menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_items.id'), primary_key=True)
+    quantity = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+class DailyIngredientUsage(db.Model):
+    __tablename__ = 'daily_ingredient_usage'
+    day = db.Column(db.Date, primary_key=True)
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredients.id'), primary_key=True)
+    transaction_type = db.Column(db.String(20), primary_key=True)  # purchase, usage, adjustment, waste
+    quantity = db.Column(db.Float, default=0, nullable=False)
+    transaction_count = db.Column(db.Integer, default=0, nullable=False)
+# Persisted service latency histograms (see the latency section)
+class LatencyHistogram(db.Model):
+    __tablename__ = 'latency_histograms'
+    metric = db.Column(db.String(40), primary_key=True)  # ticket_time, time_to_first_item, item_prep_time, table_turn_time, waitlist_wait
+    dimension = db.Column(db.String(20), primary_key=True)  # all, order_type, hour, station
+    key = db.Column(db.String(100), primary_key=True)
+    counts = db.Column(db.LargeBinary, nullable=False)  # int64 bucket counts, LATENCY_BUCKET_COUNT long
+    total_seconds = db.Column(db.Float, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+# Customer activity, updated when an order's first payment completes
+class CustomerActivity(db.Model):
+    __tablename__ = 'customer_activity'
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), primary_key=True)
+    cohort_month = db.Column(db.Date, nullable=False, index=True)  # month of the first paid order
+    first_order_at = db.Column(db.DateTime, nullable=False)
+    last_order_at = db.Column(db.DateTime, nullable=False)
+    last_active_month = db.Column(db.Date, nullable=False)
+    orders = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+class CohortActivity(db.Model):
+    __tablename__ = 'cohort_activity'
+    cohort_month = db.Column(db.Date, primary_key=True)
+    activity_month = db.Column(db.Date, primary_key=True)
+    new_customers = db.Column(db.Integer, default=0, nullable=False)  # only non-zero when activity_month == cohort_month
+    active_customers = db.Column(db.Integer, default=0, nullable=False)
+    orders = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0, nullable=False)
+    repeat_orders = db.Column(db.Integer, default=0, nullable=False)
+    repeat_interval_days = db.Column(db.Float, default=0, nullable=False)  # sum of days since the previous order
+class CohortRepeatInterval(db.Model):
+    __tablename__ = 'cohort_repeat_intervals'
+    cohort_month = db.Column(db.Date, primary_key=True)
+    bucket_days = db.Column(db.Integer, primary_key=True)  # lower bound of REPEAT_INTERVAL_BUCKETS bucket
+    orders = db.Column(db.Integer, default=0, nullable=False)
+# Materialized stock alert state, maintained whenever stock changes
+class InventoryAlertState(db.Model):
+    __tablename__ = 'inventory_alert_states'
+    # Not a foreign key: rows outlive deleted ingredients so the version never goes backwards
+    ingredient_id = db.Column(db.Integer, primary_key=True)
+    state = db.Column(db.String(20), nullable=False, default='ok', index=True)  # ok, low, critical
+    current_stock = db.Column(db.Float, default=0)
+    min_stock = db.Column(db.Float, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0, index=True)
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow)  # last state crossing
+# Stock threshold crossings, written with the alert state so every worker's stream sees them
+class InventoryAlertEvent(db.Model):
+    __tablename__ = 'inventory_alert_events'
+    id = db.Column(db.Integer, primary_key=True)
+    ingredient_id = db.Column(db.Integer, nullable=False)
+    from_state = db.Column(db.String(20), nullable=False)
+    to_state = db.Column(db.String(20), nullable=False)
+    current_stock = db.Column(db.Float)
+    min_stock = db.Column(db.Float)
+    version = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    __table_args__ = {'sqlite_autoincrement': True}  # ids are stream positions and must never be reused
 # Staff clock in/out
 class StaffTimeLog(db.Model):
     __tablename__ = 'staff_time_logs'
@@ -336,6 +750,23 @@ class Settings(db.Model):
     value = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+# Background report jobs; the table doubles as the queue shared by all web workers
+class ReportJob(db.Model):
+    __tablename__ = 'report_jobs'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    report = db.Column(db.String(200), nullable=False)  # GET path of the report, e.g. /api/reports/export/sales
+    params = db.Column(db.JSON)
+    status = db.Column(db.String(20), default='queued', index=True)  # queued, running, completed, failed, expired
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime)
+    result_path = db.Column(db.String(500))
+    content_type = db.Column(db.String(100))
+    filename = db.Column(db.String(200))
+    size = db.Column(db.Integer)
+    error = db.Column(db.Text)
 # Routes
 @app.route('/')
 def index():
@@ -622,6 +1053,137 @@ def handle_table(table_id):
         db.session.delete(table)
         db.session.commit()
         return jsonify({'message': 'Table deleted'})
+# Live floor state: status, current order, seated time and party size of every table
+FLOOR_STATE_DELTA_BACKLOG = 1000  # deltas kept for stream clients that reconnect
+FLOOR_STATE_SYNC_SECONDS = 0.5  # how often streams look for table writes committed by other workers
+FLOOR_STATE_HEARTBEAT_SECONDS = 15
+FLOOR_STATE_COLUMNS = ('id', 'table_number', 'capacity', 'location', 'status', 'current_order_id', 'occupied_since', 'party_size')
+def floor_entry(values):
+    entry = dict(zip(FLOOR_STATE_COLUMNS, values))
+    entry['occupied_since'] = entry['occupied_since'].isoformat() if entry['occupied_since'] else None
+    return entry
+class FloorState:
+    """Versioned in-memory snapshot of the floor, changed one table at a time.
+    Commits in this process apply their table changes as they happen; commits by other workers are
+    picked up when the 'tables' write generation moves, by reloading the table rows and diffing them.
+    Every change that alters an entry bumps the version and is kept as a delta for the stream."""
+    def __init__(self):
+        self.instance = uuid.uuid4().hex[:8]  # versions are per process; clients resync when this changes
+        self.changed = threading.Condition()
+        self.version = 0
+        self.tables = None  # table id -> entry, loaded on first use
+        self.generation = None
+        self.deltas = deque(maxlen=FLOOR_STATE_DELTA_BACKLOG)  # (version, table id, entry or None if deleted)
+    def _apply(self, entries):
+        # caller holds self.changed
+        for table_id, entry in entries.items():
+            if self.tables.get(table_id) == entry:
+                continue
+            self.version += 1
+            if entry is None:
+                self.tables.pop(table_id, None)
+            else:
+                self.tables[table_id] = entry
+            self.deltas.append((self.version, table_id, entry))
+        self.changed.notify_all()
+    def apply_local(self, entries):
+        with self.changed:
+            if self.tables is not None:
+                self._apply(entries)
+    def sync(self):
+        generation = tuple(table_generations(['tables', TABLE_GENERATION_WILDCARD]).values())
+        if self.tables is not None and generation == self.generation:
+            return
+        # Own connection, so a long-lived stream never holds a transaction open on the request session
+        with db.engine.connect() as conn:
+            rows = conn.execute(db.select(*(getattr(Table, name) for name in FLOOR_STATE_COLUMNS))).all()
+        loaded = {row[0]: floor_entry(row) for row in rows}
+        with self.changed:
+            if self.tables is None:
+                self.tables = loaded
+            else:
+                self._apply({table_id: loaded.get(table_id) for table_id in set(self.tables) | set(loaded)})
+            self.generation = generation
+    def snapshot(self):
+        self.sync()
+        with self.changed:
+            return self.version, sorted(self.tables.values(), key=lambda t: t['table_number'])
+    def deltas_since(self, version):
+        """Deltas after a version, or None when the backlog no longer reaches back that far"""
+        with self.changed:
+            oldest = self.deltas[0][0] if self.deltas else self.version + 1
+            if version > self.version or version < oldest - 1:
+                return None
+            return [delta for delta in self.deltas if delta[0] > version]
+    def wait(self, version, timeout):
+        with self.changed:
+            if self.version == version:
+                self.changed.wait(timeout)
+floor_state = FloorState()
+@db.event.listens_for(db.session, 'after_flush')
+def _collect_floor_changes(sess, flush_context):
+    changes = None
+    for obj in list(sess.new) + list(sess.dirty):
+        if isinstance(obj, Table):
+            changes = changes if changes is not None else sess.info.setdefault('floor_changes', {})
+            changes[obj.id] = floor_entry([getattr(obj, name) for name in FLOOR_STATE_COLUMNS])
+    for obj in sess.deleted:
+        if isinstance(obj, Table):
+            sess.info.setdefault('floor_changes', {})[obj.id] = None
+@db.event.listens_for(db.session, 'after_commit')
+def _publish_floor_changes(sess):
+    changes = sess.info.pop('floor_changes', None)
+    if changes:
+        floor_state.apply_local(changes)
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _discard_floor_changes(sess, previous_transaction):
+    sess.info.pop('floor_changes', None)
+def floor_etag(version):
+    return f'floor-{floor_state.instance}-{version}'
+@app.route('/api/floor', methods=['GET'])
+def get_floor_state():
+    """Every table's live state. Polling clients send If-None-Match and get 304 until something changes."""
+    version, tables = floor_state.snapshot()
+    etag = floor_etag(version)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify({'version': version, 'instance': floor_state.instance, 'tables': tables})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+@app.route('/api/floor/stream')
+def floor_state_stream():
+    """Push floor changes via SSE: a 'snapshot' event first (or after falling behind), then one 'table' event per change.
+    Reconnecting clients resume from Last-Event-ID ('<instance>:<version>')."""
+    resume = request.headers.get('Last-Event-ID') or request.args.get('since') or ''
+    instance, _, resume_version = resume.rpartition(':')
+    @stream_with_context
+    def event_stream():
+        version = int(resume_version) if instance == floor_state.instance and resume_version.isdigit() else None
+        last_sent = time.monotonic()
+        while True:
+            floor_state.sync()
+            deltas = floor_state.deltas_since(version) if version is not None else None
+            if deltas is None:
+                version, tables = floor_state.snapshot()
+                yield f"id: {floor_state.instance}:{version}\n"
+                yield "event: snapshot\n"
+                yield f"data: {json.dumps({'version': version, 'tables': tables})}\n\n"
+                last_sent = time.monotonic()
+            elif deltas:
+                for delta_version, table_id, entry in deltas:
+                    yield f"id: {floor_state.instance}:{delta_version}\n"
+                    yield "event: table\n"
+                    yield f"data: {json.dumps({'version': delta_version, 'id': table_id, 'table': entry})}\n\n"
+                version = deltas[-1][0]
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= FLOOR_STATE_HEARTBEAT_SECONDS:
+                yield "event: heartbeat\n"
+                yield f"data: {json.dumps({'time': datetime.utcnow().isoformat()})}\n\n"
+                last_sent = time.monotonic()
+            floor_state.wait(version, FLOOR_STATE_SYNC_SECONDS)
+    return Response(event_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 @app.route('/api/menu', methods=['POST'])
 def add_menu_item():
     # Handle both JSON and form data
@@ -864,35 +1426,100 @@ def update_menu_item_recipe(item_id):
         db.session.add(recipe)
     db.session.commit()
     return jsonify({'message': 'Recipe updated successfully'})
+# Ingredient lots
+def parse_expiry_date(value):
+    """Parse an optional ISO date/datetime used for lot expiry"""
+    if value in (None, ''):
+        return None
+    return datetime.fromisoformat(str(value))
+def open_lots_query(ingredient_ids):
+    """Open lots for the given ingredients in FEFO order (dated lots by expiry, then undated by receipt)"""
+    return IngredientLot.query.filter(
+        IngredientLot.ingredient_id.in_(ingredient_ids),
+        IngredientLot.quantity_remaining > 0
+    ).order_by(
+        IngredientLot.ingredient_id,
+        IngredientLot.expiry_date.is_(None),
+        IngredientLot.expiry_date,
+        IngredientLot.received_at,
+        IngredientLot.id
+    )
+def consume_lots(needs, lot_id=None):
+    """Take quantities out of ingredient lots in FEFO order.
+    needs maps ingredient_id -> quantity. Open lots for all ingredients are read in one
+    query and decremented with one executemany UPDATE. Stock that is not covered by
+    lots (e.g. stock entered before lot tracking) is simply left untracked.
+    Returns ingredient_id -> [(lot_id, quantity_taken), ...]."""
+    needs = {k: v for k, v in needs.items() if v and v > 0}
+    if not needs:
+        return {}
+    if lot_id is not None:
+        lots = IngredientLot.query.filter(IngredientLot.id == lot_id, IngredientLot.quantity_remaining > 0).all()
+    else:
+        lots = open_lots_query(needs.keys()).with_entities(
+            IngredientLot.id, IngredientLot.ingredient_id, IngredientLot.quantity_remaining
+        ).all()
+    remaining = dict(needs)
+    allocations = {}
+    for lot in lots:
+        wanted = remaining.get(lot.ingredient_id, 0)
+        if wanted <= 0:
+            continue
+        taken = min(wanted, lot.quantity_remaining)
+        remaining[lot.ingredient_id] = wanted - taken
+        allocations.setdefault(lot.ingredient_id, []).append((lot.id, taken))
+    if allocations:
+        lots_table = IngredientLot.__table__
+        lot_update = lots_table.update().where(
+            lots_table.c.id == db.bindparam('b_id')
+        ).values(
+            quantity_remaining=db.case(
+                (lots_table.c.quantity_remaining < db.bindparam('b_taken'), 0),
+                else_=lots_table.c.quantity_remaining - db.bindparam('b_taken')
+            )
+        )
+        db.session.execute(lot_update, [
+            {'b_id': allocated_lot_id, 'b_taken': taken}
+            for taken_from in allocations.values()
+            for allocated_lot_id, taken in taken_from
+        ])
+    return allocations
 # Inventory deduction when orders are placed
 def deduct_inventory_for_order(order_id):
     order = Order.query.get(order_id)
     if not order:
         return
+    # Get language for transaction note translation
+    # Try to get language from request context, default to 'en'
+    try:
+        from flask import request
+        language = request.args.get('lang', 'en') if request else 'en'
+    except:
+        language = 'en'
+    # Transaction note translations
+    transaction_note_translations = {
+        'en': 'Used for {quantity} x {item_name}',
+        'ar': 'استخدمت لـ {quantity} x {item_name}',
+        'tr': '{quantity} x {item_name} için kullanıldı'
+    }
+    note_template = transaction_note_translations.get(language, transaction_note_translations['en'])
+    # Load every recipe line and ingredient for the order up front
+    menu_item_ids = {order_item.menu_item_id for order_item in order.items}
+    recipes_by_item = {}
+    for recipe in Recipe.query.filter(Recipe.menu_item_id.in_(menu_item_ids)).all() if menu_item_ids else []:
+        recipes_by_item.setdefault(recipe.menu_item_id, []).append(recipe)
+    ingredient_ids = {r.ingredient_id for recipes in recipes_by_item.values() for r in recipes}
+    ingredients = {i.id: i for i in Ingredient.query.filter(Ingredient.id.in_(ingredient_ids)).all()} if ingredient_ids else {}
+    needs = {}
     for order_item in order.items:
-        # Get all recipes for this menu item
-        recipes = Recipe.query.filter_by(menu_item_id=order_item.menu_item_id).all()
-        for recipe in recipes:
-            ingredient = Ingredient.query.get(recipe.ingredient_id)
+        for recipe in recipes_by_item.get(order_item.menu_item_id, []):
+            ingredient = ingredients.get(recipe.ingredient_id)
             if ingredient:
                 # Calculate total quantity needed
                 total_quantity = recipe.quantity_required * order_item.quantity
                 # Deduct from inventory
                 ingredient.current_stock = max(0, ingredient.current_stock - total_quantity)
-                # Get language for transaction note translation
-                # Try to get language from request context, default to 'en'
-                try:
-                    from flask import request
-                    language = request.args.get('lang', 'en') if request else 'en'
-                except:
-                    language = 'en'
-                # Transaction note translations
-                transaction_note_translations = {
-                    'en': 'Used for {quantity} x {item_name}',
-                    'ar': 'استخدمت لـ {quantity} x {item_name}',
-                    'tr': '{quantity} x {item_name} için kullanıldı'
-                }
-                note_template = transaction_note_translations.get(language, transaction_note_translations['en'])
+                needs[ingredient.id] = needs.get(ingredient.id, 0) + total_quantity
                 note = note_template.format(quantity=order_item.quantity, item_name=order_item.menu_item.name)
                 # Record inventory transaction
                 transaction = InventoryTransaction(
@@ -903,6 +1530,8 @@ def deduct_inventory_for_order(order_id):
                     notes=note
                 )
                 db.session.add(transaction)
+    consume_lots(needs)
+    refresh_stock_alerts(needs.keys())
     db.session.commit()
 # Order Management
 @app.route('/api/orders', methods=['GET', 'POST'])
@@ -938,6 +1567,8 @@ def handle_orders():
         if order.order_type == 'dine-in' and order.table_id:
             table = Table.query.get(order.table_id)
             table.status = 'occupied'
+            table.current_order_id = order.id
+            table.party_size = data.get('party_size') or table.party_size
         db.session.commit()
         # Deduct inventory for the order
         deduct_inventory_for_order(order.id)
@@ -1002,23 +1633,17 @@ def handle_order_payments(order_id):
         )
         db.session.add(payment)
         db.session.flush()
+        apply_payment_rollups(payment)
         # Update order status if fully paid - send to kitchen
         total_paid = db.session.query(db.func.sum(Payment.amount)).filter_by(order_id=order.id, payment_status='completed').scalar() or 0
         if total_paid >= (order.final_amount or 0):
             # Send order to kitchen if it's not already completed or cancelled
             if order.status not in ['completed', 'cancelled']:
+                old_status = order.status
                 order.status = 'confirmed'  # This will send order to kitchen
-        # Accrue loyalty on completion with tier bonuses
-        if order.customer_id and (order.final_amount or 0) > 0:
-            customer = Customer.query.get(order.customer_id)
-            if customer:
-                # Calculate base points
-                base_points = int(round((order.final_amount or 0) * LOYALTY_POINTS_PER_CURRENCY))
-                # Apply tier bonus
-                current_tier = get_customer_loyalty_tier(customer.loyalty_points or 0)
-                tier_multiplier = LOYALTY_TIER_BONUSES.get(current_tier, 1.0)
-                earned = int(round(base_points * tier_multiplier))
-                customer.loyalty_points = (customer.loyalty_points or 0) + earned
+                track_order_status_change(order, old_status)
+            # Accrue loyalty once the order is paid in full
+            accrue_order_loyalty(order)
         db.session.commit()
         return jsonify({'message': 'Payment recorded', 'payment_id': payment.id, 'total_paid': float(total_paid)}), 201
     # GET
@@ -1044,6 +1669,8 @@ def handle_inventory():
             cost_per_unit=data.get('cost_per_unit', 0.0)  # FIXED: Default to 0.0 if not provided
         )
         db.session.add(new_ingredient)
+        db.session.flush()
+        refresh_stock_alerts([new_ingredient.id])
         db.session.commit()
         return jsonify({'message': 'Ingredient added', 'id': new_ingredient.id}), 201
     elif request.method == 'GET':
@@ -1063,114 +1690,781 @@ def delete_ingredient(ingredient_id):
     ingredient = Ingredient.query.get_or_404(ingredient_id)
     # Optional: also delete related transactions and recipes referencing this ingredient
     InventoryTransaction.query.filter_by(ingredient_id=ingredient_id).delete()
+    IngredientLot.query.filter_by(ingredient_id=ingredient_id).delete()
+    DailyIngredientUsage.query.filter_by(ingredient_id=ingredient_id).delete()
     Recipe.query.filter_by(ingredient_id=ingredient_id).delete()
+    alert = InventoryAlertState.query.get(ingredient_id)
+    if alert and alert.state != 'ok':
+        alert.state = 'ok'
+        alert.version = (db.session.query(db.func.max(InventoryAlertState.version)).scalar() or 0) + 1
+        alert.changed_at = datetime.utcnow()
     db.session.delete(ingredient)
     db.session.commit()
     return jsonify({'message': 'Ingredient deleted'})
 @app.route('/api/inventory/low-stock', methods=['GET'])
 def get_low_stock():
-    low_stock = Ingredient.query.filter(Ingredient.current_stock <= Ingredient.min_stock).all()
+    # Use the computed reorder point where one exists, never going below the manual minimum
+    computed_point = db.func.coalesce(ReorderSuggestion.reorder_point, 0)
+    manual_point = db.func.coalesce(Ingredient.min_stock, 0)
+    reorder_point = db.case((computed_point > manual_point, computed_point), else_=manual_point)
+    rows = db.session.query(Ingredient, ReorderSuggestion).outerjoin(
+        ReorderSuggestion, ReorderSuggestion.ingredient_id == Ingredient.id
+    ).filter(Ingredient.current_stock <= reorder_point).all()
     return jsonify([{
         'id': ing.id,
         'name': ing.name,
         'current_stock': ing.current_stock,
         'min_stock': ing.min_stock,
-        'unit': ing.unit
-    } for ing in low_stock])
+        'unit': ing.unit,
+        'reorder_point': suggestion.reorder_point if suggestion else None,
+        'par_level': suggestion.par_level if suggestion else None,
+        'suggested_order_qty': max(0.0, suggestion.par_level - (ing.current_stock or 0)) if suggestion else None
+    } for ing, suggestion in rows])
+# Reorder point / par level engine
+def compute_reorder_points(ingredient_ids, current_stock, min_stock, lead_times, usage_rows, history_days,
+                           service_z=REORDER_SERVICE_LEVEL_Z, review_days=REORDER_REVIEW_PERIOD_DAYS):
+    """Vectorized reorder calculation for all ingredients at once.
+    usage_rows is an iterable of (ingredient_id, day_index, quantity) with day_index in
+    [0, history_days). Returns a dict of NumPy arrays aligned with ingredient_ids."""
+    ingredient_ids = np.asarray(ingredient_ids, dtype=np.int64)
+    n = len(ingredient_ids)
+    usage = np.zeros((n, history_days), dtype=np.float64)
+    rows = np.asarray(usage_rows, dtype=np.float64).reshape(-1, 3)
+    if len(rows):
+        # Map ingredient ids to row positions without a Python loop
+        order = np.argsort(ingredient_ids)
+        pos = np.searchsorted(ingredient_ids, rows[:, 0].astype(np.int64), sorter=order)
+        pos = np.clip(pos, 0, max(n - 1, 0))
+        row_index = order[pos]
+        valid = (ingredient_ids[row_index] == rows[:, 0].astype(np.int64)) & (rows[:, 1] >= 0) & (rows[:, 1] < history_days)
+        flat = row_index[valid] * history_days + rows[valid, 1].astype(np.int64)
+        usage = np.bincount(flat, weights=rows[valid, 2], minlength=n * history_days).reshape(n, history_days)
+    mean = usage.mean(axis=1) if history_days else np.zeros(n)
+    std = usage.std(axis=1, ddof=1) if history_days > 1 else np.zeros(n)
+    lead = np.asarray(lead_times, dtype=np.float64)
+    lead = np.where(np.isnan(lead) | (lead <= 0), REORDER_DEFAULT_LEAD_TIME_DAYS, lead)
+    safety = service_z * std * np.sqrt(lead)
+    reorder_point = np.maximum(mean * lead + safety, np.nan_to_num(np.asarray(min_stock, dtype=np.float64)))
+    par_level = np.maximum(mean * (lead + review_days) + safety, reorder_point)
+    stock = np.nan_to_num(np.asarray(current_stock, dtype=np.float64))
+    suggested = np.where(stock <= reorder_point, np.maximum(par_level - stock, 0.0), 0.0)
+    return {
+        'avg_daily_usage': mean,
+        'usage_std': std,
+        'lead_time_days': lead,
+        'safety_stock': safety,
+        'reorder_point': reorder_point,
+        'par_level': par_level,
+        'suggested_order_qty': suggested
+    }
+def recalculate_reorder_points(history_days=REORDER_HISTORY_DAYS):
+    """Rebuild the reorder_suggestions table from InventoryTransaction history.
+    Daily consumption (usage + waste) per ingredient comes from one GROUP BY query."""
+    now = datetime.utcnow()
+    start_day = (now - timedelta(days=history_days - 1)).date()
+    ingredients = db.session.query(
+        Ingredient.id, Ingredient.current_stock, Ingredient.min_stock, Ingredient.lead_time_days
+    ).order_by(Ingredient.id).all()
+    day_bucket = db.func.date(InventoryTransaction.transaction_date)
+    usage = db.session.query(
+        InventoryTransaction.ingredient_id, day_bucket, db.func.sum(InventoryTransaction.quantity)
+    ).filter(
+        InventoryTransaction.transaction_type.in_(['usage', 'waste']),
+        InventoryTransaction.transaction_date >= datetime.combine(start_day, datetime.min.time())
+    ).group_by(InventoryTransaction.ingredient_id, day_bucket).all()
+    if usage:
+        ids, days, quantities = zip(*usage)
+        # date() comes back as 'YYYY-MM-DD' on SQLite and as a date elsewhere; NumPy parses both
+        day_index = (np.array(days, dtype='datetime64[D]') - np.datetime64(start_day)).astype(np.int64)
+        usage_rows = np.column_stack([np.asarray(ids, dtype=np.float64), day_index, np.asarray(quantities, dtype=np.float64)])
+    else:
+        usage_rows = np.empty((0, 3))
+    ingredient_ids = [i.id for i in ingredients]
+    result = compute_reorder_points(
+        ingredient_ids,
+        [i.current_stock or 0 for i in ingredients],
+        [i.min_stock or 0 for i in ingredients],
+        [i.lead_time_days if i.lead_time_days is not None else np.nan for i in ingredients],
+        usage_rows,
+        history_days
+    )
+    columns = {k: v.round(4).tolist() for k, v in result.items()}
+    records = [{
+        'ingredient_id': ingredient_id,
+        'computed_at': now,
+        'history_days': history_days,
+        **{k: columns[k][i] for k in columns}
+    } for i, ingredient_id in enumerate(ingredient_ids)]
+    ReorderSuggestion.query.delete()
+    if records:
+        db.session.execute(ReorderSuggestion.__table__.insert(), records)
+    db.session.commit()
+    return len(records)
+@app.route('/api/inventory/reorder', methods=['GET'])
+def get_reorder_suggestions():
+    rows = db.session.query(ReorderSuggestion, Ingredient).join(
+        Ingredient, Ingredient.id == ReorderSuggestion.ingredient_id
+    ).order_by(Ingredient.name).all()
+    only_needed = request.args.get('only_needed', 'false').lower() == 'true'
+    result = []
+    for suggestion, ing in rows:
+        needs_reorder = (ing.current_stock or 0) <= suggestion.reorder_point
+        if only_needed and not needs_reorder:
+            continue
+        result.append({
+            'ingredient_id': ing.id,
+            'name': ing.name,
+            'unit': ing.unit,
+            'supplier': ing.supplier,
+            'current_stock': ing.current_stock,
+            'min_stock': ing.min_stock,
+            'avg_daily_usage': suggestion.avg_daily_usage,
+            'usage_std': suggestion.usage_std,
+            'lead_time_days': suggestion.lead_time_days,
+            'safety_stock': suggestion.safety_stock,
+            'reorder_point': suggestion.reorder_point,
+            'par_level': suggestion.par_level,
+            'needs_reorder': needs_reorder,
+            'suggested_order_qty': max(0.0, suggestion.par_level - (ing.current_stock or 0)) if needs_reorder else 0.0,
+            'computed_at': suggestion.computed_at.isoformat() if suggestion.computed_at else None
+        })
+    return jsonify(result)
+@app.route('/api/inventory/reorder/recalculate', methods=['POST'])
+def recalculate_reorder_suggestions():
+    data = request.get_json(silent=True) or {}
+    history_days = int(data.get('history_days', REORDER_HISTORY_DAYS))
+    if history_days < 2:
+        return jsonify({'message': 'history_days must be at least 2'}), 400
+    started = time.perf_counter()
+    count = recalculate_reorder_points(history_days)
+    return jsonify({
+        'message': 'Reorder points recalculated',
+        'ingredients': count,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+    })
+# Inventory alerts
+INVENTORY_ALERT_TRANSLATIONS = {
+    'en': {
+        'low_stock_title': 'Low Stock Alert: {item}',
+        'low_stock_message': '{item} is running low. Current: {current} {unit}, Minimum: {minimum} {unit}',
+        'critical_stock_title': 'Critical Stock Alert: {item}',
+        'critical_stock_message': '{item} is critically low! Current: {current} {unit}, Minimum: {minimum} {unit}',
+        'expiring_title': 'Expiring Soon: {item}',
+        'expiring_message': '{quantity} {unit} of {item} expires on {date}',
+        'expired_title': 'Expired: {item}',
+        'expired_message': '{quantity} {unit} of {item} expired on {date}'
+    },
+    'ar': {
+        'low_stock_title': 'تنبيه المخزون المنخفض: {item}',
+        'low_stock_message': '{item} ينفد. المتوفر: {current} {unit}, الحد الأدنى: {minimum} {unit}',
+        'critical_stock_title': 'تنبيه المخزون الحرجة: {item}',
+        'critical_stock_message': '{item} منخفض للغاية! المتوفر: {current} {unit}, الحد الأدنى: {minimum} {unit}',
+        'expiring_title': 'ينتهي قريبًا: {item}',
+        'expiring_message': '{quantity} {unit} من {item} تنتهي صلاحيتها في {date}',
+        'expired_title': 'منتهي الصلاحية: {item}',
+        'expired_message': '{quantity} {unit} من {item} انتهت صلاحيتها في {date}'
+    },
+    'tr': {
+        'low_stock_title': 'Düşük Stok Uyarısı: {item}',
+        'low_stock_message': '{item} azalıyor. Mevcut: {current} {unit}, Minimum: {minimum} {unit}',
+        'critical_stock_title': 'Kritik Stok Uyarısı: {item}',
+        'critical_stock_message': '{item} kritik düzeyde! Mevcut: {current} {unit}, Minimum: {minimum} {unit}',
+        'expiring_title': 'Son Kullanma Yaklaşıyor: {item}',
+        'expiring_message': '{item} ürününün {quantity} {unit} miktarı {date} tarihinde sona eriyor',
+        'expired_title': 'Süresi Doldu: {item}',
+        'expired_message': '{item} ürününün {quantity} {unit} miktarının süresi {date} tarihinde doldu'
+    }
+}
+def get_stock_state(current_stock, min_stock):
+    """Classify a stock level as ok, low or critical"""
+    current_stock = current_stock or 0
+    min_stock = min_stock or 0
+    if current_stock <= min_stock * CRITICAL_STOCK_THRESHOLD / 100:
+        return 'critical'
+    if current_stock <= min_stock:
+        return 'low'
+    return 'ok'
+def refresh_stock_alerts(ingredient_ids, record_events=True):
+    """Re-evaluate alert state for the given ingredients inside the current transaction.
+    Call this after any write to current_stock or min_stock, before committing.
+    Threshold crossings are written to inventory_alert_events, so streams see them once the commit succeeds."""
+    ingredient_ids = {i for i in ingredient_ids if i is not None}
+    if not ingredient_ids:
+        return []
+    db.session.flush()
+    rows = db.session.query(Ingredient.id, Ingredient.current_stock, Ingredient.min_stock).filter(
+        Ingredient.id.in_(ingredient_ids)
+    ).all()
+    states = {s.ingredient_id: s for s in InventoryAlertState.query.filter(
+        InventoryAlertState.ingredient_id.in_(ingredient_ids)
+    ).all()}
+    version = (db.session.query(db.func.max(InventoryAlertState.version)).scalar() or 0) + 1
+    now = datetime.utcnow()
+    events = []
+    for ingredient_id, current_stock, min_stock in rows:
+        new_state = get_stock_state(current_stock, min_stock)
+        alert = states.get(ingredient_id)
+        old_state = alert.state if alert else 'ok'
+        if alert is None:
+            if new_state == 'ok':
+                continue
+            alert = InventoryAlertState(ingredient_id=ingredient_id)
+            db.session.add(alert)
+        elif new_state == old_state == 'ok':
+            continue
+        elif (new_state == old_state and alert.current_stock == current_stock
+                and alert.min_stock == min_stock):
+            continue
+        alert.state = new_state
+        alert.current_stock = current_stock
+        alert.min_stock = min_stock
+        alert.version = version
+        if new_state != old_state:
+            alert.changed_at = now
+            events.append({
+                'ingredient_id': ingredient_id,
+                'from_state': old_state,
+                'to_state': new_state,
+                'current_stock': current_stock,
+                'min_stock': min_stock,
+                'version': version
+            })
+    if events and record_events:
+        db.session.execute(InventoryAlertEvent.__table__.insert(), [dict(event, created_at=now) for event in events])
+        prune_inventory_alert_events()
+        db.session.info['inventory_alert_events'] = True
+    return events
+def rebuild_stock_alerts():
+    """Recompute the materialized alert set for every ingredient (startup backfill)"""
+    ids = [row[0] for row in db.session.query(Ingredient.id).all()]
+    refresh_stock_alerts(ids, record_events=False)
+    db.session.commit()
+# Stock alert crossing events for the notifications stream
+INVENTORY_ALERT_EVENT_BACKLOG = 500  # events kept for stream clients that reconnect
+INVENTORY_ALERT_SYNC_SECONDS = 1  # how often streams look for crossings committed by other workers
+INVENTORY_ALERT_HEARTBEAT_SECONDS = 15
+_inventory_alert_committed = threading.Condition()  # wakes this process's streams after a local commit
+def inventory_alert_event_log():
+    """Id of this database's event log; stream ids are '<log>:<event id>' so a client never resumes against another log"""
+    setting = Settings.query.filter_by(key='inventory_alert_event_log').first()
+    if setting is None:
+        db.session.add(Settings(key='inventory_alert_event_log', value=uuid.uuid4().hex[:8]))
+        try:
+            db.session.commit()
+        except Exception:
+            # Another worker created it first
+            db.session.rollback()
+        setting = Settings.query.filter_by(key='inventory_alert_event_log').first()
+    return setting.value
+def prune_inventory_alert_events():
+    newest = db.session.query(db.func.max(InventoryAlertEvent.id)).scalar()
+    if newest is not None:
+        InventoryAlertEvent.query.filter(InventoryAlertEvent.id <= newest - INVENTORY_ALERT_EVENT_BACKLOG).delete()
+def serialize_inventory_alert_event(row):
+    return {
+        'ingredient_id': row.ingredient_id,
+        'from_state': row.from_state,
+        'to_state': row.to_state,
+        'current_stock': row.current_stock,
+        'min_stock': row.min_stock,
+        'version': row.version
+    }
+@db.event.listens_for(db.session, 'after_commit')
+def _publish_inventory_alert_events(sess):
+    if sess.info.pop('inventory_alert_events', None):
+        with _inventory_alert_committed:
+            _inventory_alert_committed.notify_all()
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _discard_inventory_alert_events(sess, previous_transaction):
+    sess.info.pop('inventory_alert_events', None)
 @app.route('/api/notifications/alerts', methods=['GET'])
 def get_inventory_alerts():
-    """Get automated inventory alerts based on thresholds"""
-    # Get language from query parameter
+    """Get inventory alerts from the materialized alert set.
+    The list is cached (in the shared cache) per language and rebuilt when the alert version or the ingredients table changes."""
     language = request.args.get('lang', 'en')
-    # Alert translations
-    alert_translations = {
-        'en': {
-            'low_stock_title': 'Low Stock Alert: {item}',
-            'low_stock_message': '{item} is running low. Current: {current} {unit}, Minimum: {minimum} {unit}',
-            'critical_stock_title': 'Critical Stock Alert: {item}',
-            'critical_stock_message': '{item} is critically low! Current: {current} {unit}, Minimum: {minimum} {unit}'
-        },
-        'ar': {
-            'low_stock_title': 'تنبيه المخزون المنخفض: {item}',
-            'low_stock_message': '{item} ينفد. المتوفر: {current} {unit}, الحد الأدنى: {minimum} {unit}',
-            'critical_stock_title': 'تنبيه المخزون الحرجة: {item}',
-            'critical_stock_message': '{item} منخفض للغاية! المتوفر: {current} {unit}, الحد الأدنى: {minimum} {unit}'
-        },
-        'tr': {
-            'low_stock_title': 'Düşük Stok Uyarısı: {item}',
-            'low_stock_message': '{item} azalıyor. Mevcut: {current} {unit}, Minimum: {minimum} {unit}',
-            'critical_stock_title': 'Kritik Stok Uyarısı: {item}',
-            'critical_stock_message': '{item} kritik düzeyde! Mevcut: {current} {unit}, Minimum: {minimum} {unit}'
-        }
-    }
-    translations = alert_translations.get(language, alert_translations['en'])
+    if language not in INVENTORY_ALERT_TRANSLATIONS:
+        language = 'en'
+    version = db.session.query(db.func.max(InventoryAlertState.version)).scalar() or 0
+    translations = INVENTORY_ALERT_TRANSLATIONS[language]
+    # Names and units come from ingredients, whose edits don't move the alert version
+    ingredients_generation = ':'.join(str(g) for g in table_generations(['ingredients', TABLE_GENERATION_WILDCARD]).values())
+    cache_key = f'inventory_alerts:{language}:{version}:{ingredients_generation}'
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return jsonify(with_expiry_alerts(cached, translations))
+    rows = db.session.query(InventoryAlertState, Ingredient.name, Ingredient.unit).join(
+        Ingredient, Ingredient.id == InventoryAlertState.ingredient_id
+    ).filter(InventoryAlertState.state != 'ok').order_by(InventoryAlertState.changed_at.desc()).all()
     alerts = []
-    # Low stock alerts
-    low_stock_items = Ingredient.query.filter(
-        Ingredient.current_stock <= Ingredient.min_stock
-    ).all()
-    for item in low_stock_items:
+    for alert, name, unit in rows:
+        prefix = 'critical_stock' if alert.state == 'critical' else 'low_stock'
         alerts.append({
-            'type': 'low_stock',
-            'severity': 'warning',
-            'title': translations['low_stock_title'].format(item=item.name),
-            'message': translations['low_stock_message'].format(
-                item=item.name,
-                current=item.current_stock,
-                unit=item.unit,
-                minimum=item.min_stock
+            'type': prefix,
+            'severity': 'error' if alert.state == 'critical' else 'warning',
+            'title': translations[prefix + '_title'].format(item=name),
+            'message': translations[prefix + '_message'].format(
+                item=name,
+                current=alert.current_stock,
+                unit=unit,
+                minimum=alert.min_stock
             ),
-            'item_id': item.id,
-            'item_name': item.name,
-            'current_stock': item.current_stock,
-            'min_stock': item.min_stock,
-            'unit': item.unit,
-            'timestamp': datetime.utcnow().isoformat()
+            'item_id': alert.ingredient_id,
+            'item_name': name,
+            'current_stock': alert.current_stock,
+            'min_stock': alert.min_stock,
+            'unit': unit,
+            'timestamp': alert.changed_at.isoformat() if alert.changed_at else None
         })
-    # Critical stock alerts
-    critical_items = Ingredient.query.filter(
-        Ingredient.current_stock <= (Ingredient.min_stock * CRITICAL_STOCK_THRESHOLD / 100)
-    ).all()
-    for item in critical_items:
+    payload = {'alerts': alerts, 'version': version}
+    cache.set(cache_key, payload)
+    return jsonify(with_expiry_alerts(payload, translations))
+def with_expiry_alerts(stock_payload, translations):
+    """Combine cached stock alerts with expiring lots.
+    Expiry depends on the clock rather than on writes, so it is read live from the expiry index."""
+    now = datetime.utcnow()
+    alerts = list(stock_payload['alerts'])
+    for lot, ingredient in get_expiring_lots(EXPIRING_ITEMS_DAYS):
+        prefix = 'expired' if lot.expiry_date <= now else 'expiring'
         alerts.append({
-            'type': 'critical_stock',
-            'severity': 'error',
-            'title': translations['critical_stock_title'].format(item=item.name),
-            'message': translations['critical_stock_message'].format(
-                item=item.name,
-                current=item.current_stock,
-                unit=item.unit,
-                minimum=item.min_stock
+            'type': prefix,
+            'severity': 'error' if prefix == 'expired' else 'warning',
+            'title': translations[prefix + '_title'].format(item=ingredient.name),
+            'message': translations[prefix + '_message'].format(
+                item=ingredient.name,
+                quantity=lot.quantity_remaining,
+                unit=ingredient.unit,
+                date=lot.expiry_date.date().isoformat()
             ),
-            'item_id': item.id,
-            'item_name': item.name,
-            'current_stock': item.current_stock,
-            'min_stock': item.min_stock,
-            'unit': item.unit,
-            'timestamp': datetime.utcnow().isoformat()
+            'item_id': ingredient.id,
+            'item_name': ingredient.name,
+            'lot_id': lot.id,
+            'quantity': lot.quantity_remaining,
+            'expiry_date': lot.expiry_date.isoformat(),
+            'unit': ingredient.unit,
+            'timestamp': now.isoformat()
         })
-    # Expiring items alert (placeholder for future implementation)
-    # This would require adding expiration dates to ingredients
-    return jsonify({
+    critical_count = len([a for a in alerts if a['severity'] == 'error'])
+    return {
         'alerts': alerts,
         'total_count': len(alerts),
-        'critical_count': len([a for a in alerts if a['severity'] == 'error']),
-        'warning_count': len([a for a in alerts if a['severity'] == 'warning'])
-    })
+        'critical_count': critical_count,
+        'warning_count': len(alerts) - critical_count,
+        'version': stock_payload['version']
+    }
+@app.route('/api/notifications/stream')
+def inventory_alert_stream():
+    """Push stock threshold crossings to dashboards via SSE.
+    Events are read from inventory_alert_events, so crossings committed by any worker are delivered.
+    Reconnecting clients resume from Last-Event-ID ('<log>:<event id>'); new clients start at the latest event."""
+    log = inventory_alert_event_log()
+    resume = request.headers.get('Last-Event-ID') or request.args.get('since') or ''
+    resume_log, _, resume_id = resume.rpartition(':')
+    if resume_log == log and resume_id.isdigit():
+        last_id = int(resume_id)
+    else:
+        last_id = db.session.query(db.func.max(InventoryAlertEvent.id)).scalar() or 0
+    db.session.remove()
+    @stream_with_context
+    def event_stream():
+        sent_id = last_id
+        generation = None
+        last_sent = time.monotonic() - INVENTORY_ALERT_HEARTBEAT_SECONDS  # heartbeat right away so the client sees the stream open
+        while True:
+            current = tuple(table_generations(['inventory_alert_events', TABLE_GENERATION_WILDCARD]).values())
+            if current != generation:
+                generation = current
+                # Own connection, so a long-lived stream never holds a transaction open on the request session
+                with db.engine.connect() as conn:
+                    rows = conn.execute(db.select(InventoryAlertEvent).where(
+                        InventoryAlertEvent.id > sent_id
+                    ).order_by(InventoryAlertEvent.id)).all()
+                for row in rows:
+                    evt = {
+                        'id': f'{log}:{row.id}',
+                        'event': 'stock_' + row.to_state if row.to_state != 'ok' else 'stock_recovered',
+                        'payload': serialize_inventory_alert_event(row),
+                        'time': row.created_at.isoformat()
+                    }
+                    yield f"id: {evt['id']}\n"
+                    yield f"event: {evt['event']}\n"
+                    yield f"data: {json.dumps(evt)}\n\n"
+                    sent_id = row.id
+                    last_sent = time.monotonic()
+            if time.monotonic() - last_sent >= INVENTORY_ALERT_HEARTBEAT_SECONDS:
+                yield "event: heartbeat\n"
+                yield f"data: {json.dumps({'time': datetime.utcnow().isoformat()})}\n\n"
+                last_sent = time.monotonic()
+            with _inventory_alert_committed:
+                _inventory_alert_committed.wait(INVENTORY_ALERT_SYNC_SECONDS)
+    return Response(event_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 @app.route('/api/inventory/restock', methods=['POST'])
 def restock_inventory():
     data = request.get_json()
     ingredient = Ingredient.query.get_or_404(data['ingredient_id'])
+    try:
+        expiry_date = parse_expiry_date(data.get('expiry_date'))
+    except ValueError:
+        return jsonify({'message': 'Invalid expiry_date'}), 400
     ingredient.current_stock += float(data['quantity'])
+    # Every receipt becomes a lot so it can be consumed in FEFO order
+    lot = IngredientLot(
+        ingredient_id=ingredient.id,
+        lot_code=data.get('lot_code'),
+        expiry_date=expiry_date,
+        quantity_received=float(data['quantity']),
+        quantity_remaining=float(data['quantity']),
+        cost_per_unit=ingredient.cost_per_unit
+    )
+    db.session.add(lot)
+    db.session.flush()
     # Log the transaction
     transaction = InventoryTransaction(
         ingredient_id=ingredient.id,
         transaction_type='purchase',
-        quantity=float(data['quantity'])
+        quantity=float(data['quantity']),
+        lot_id=lot.id
     )
     db.session.add(transaction)
+    refresh_stock_alerts([ingredient.id])
     db.session.commit()
     return jsonify({'message': 'Stock updated', 'new_stock': ingredient.current_stock})
+# Supplier deliveries / bulk receiving
+def resolve_supplier(supplier_id=None, supplier_name=None):
+    """Find a supplier by id or name, creating it by name if it does not exist yet.
+    Raises ValueError if supplier_id is not a number."""
+    if supplier_id:
+        try:
+            supplier_id = int(supplier_id)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid supplier_id {supplier_id!r}')
+        return Supplier.query.get(supplier_id)
+    supplier_name = (supplier_name or '').strip()
+    if not supplier_name:
+        return None
+    supplier = Supplier.query.filter(db.func.lower(Supplier.name) == supplier_name.lower()).first()
+    if not supplier:
+        supplier = Supplier(name=supplier_name)
+        db.session.add(supplier)
+        db.session.flush()
+    return supplier
+def parse_delivery_lines(raw_lines):
+    """Normalize delivery lines and resolve ingredients by id or name.
+    Uses one IN query for ids and one for names regardless of delivery size.
+    Returns (lines, errors) where each line is a dict with the resolved ingredient."""
+    lines, errors = [], []
+    ids, names = set(), set()
+    for index, raw in enumerate(raw_lines, start=1):
+        ingredient_id = raw.get('ingredient_id')
+        ingredient_name = (raw.get('ingredient') or raw.get('ingredient_name') or '').strip()
+        try:
+            quantity = float(raw.get('quantity'))
+        except (TypeError, ValueError):
+            errors.append({'line': index, 'message': 'Invalid quantity'})
+            continue
+        if quantity <= 0:
+            errors.append({'line': index, 'message': 'Quantity must be greater than zero'})
+            continue
+        cost = raw.get('cost_per_unit')
+        try:
+            cost = float(cost) if cost not in (None, '') else None
+        except (TypeError, ValueError):
+            errors.append({'line': index, 'message': 'Invalid cost_per_unit'})
+            continue
+        try:
+            expiry_date = parse_expiry_date(raw.get('expiry_date'))
+        except ValueError:
+            errors.append({'line': index, 'message': 'Invalid expiry_date'})
+            continue
+        if ingredient_id not in (None, ''):
+            try:
+                ingredient_id = int(ingredient_id)
+            except (TypeError, ValueError):
+                errors.append({'line': index, 'message': 'Invalid ingredient_id'})
+                continue
+            ids.add(ingredient_id)
+        elif ingredient_name:
+            ingredient_id = None
+            names.add(ingredient_name.lower())
+        else:
+            errors.append({'line': index, 'message': 'ingredient_id or ingredient name is required'})
+            continue
+        lines.append({
+            'line': index,
+            'ingredient_id': ingredient_id,
+            'ingredient_name': ingredient_name,
+            'quantity': quantity,
+            'cost_per_unit': cost,
+            'expiry_date': expiry_date,
+            'lot_code': raw.get('lot_code') or None,
+            'notes': raw.get('notes')
+        })
+    by_id = {i.id: i for i in Ingredient.query.filter(Ingredient.id.in_(ids)).all()} if ids else {}
+    by_name = {}
+    if names:
+        for ing in Ingredient.query.filter(db.func.lower(Ingredient.name).in_(names)).all():
+            by_name.setdefault(ing.name.lower(), ing)
+    resolved = []
+    for line in lines:
+        if line['ingredient_id'] is not None:
+            ingredient = by_id.get(line['ingredient_id'])
+        else:
+            ingredient = by_name.get(line['ingredient_name'].lower())
+        if not ingredient:
+            errors.append({'line': line['line'], 'message': f"Ingredient not found: {line['ingredient_id'] or line['ingredient_name']}"})
+            continue
+        line['ingredient'] = ingredient
+        resolved.append(line)
+    return resolved, errors
+def receive_delivery(supplier, lines, reference=None, notes=None):
+    """Apply every line of a delivery note in a single transaction.
+    Stock increments are issued as one executemany UPDATE, purchase transactions
+    as one bulk INSERT. The caller is responsible for committing."""
+    now = datetime.utcnow()
+    delivery = SupplierDelivery(
+        supplier_id=supplier.id,
+        reference=reference,
+        received_at=now,
+        notes=notes,
+        received_by_user_id=session.get('user_id')
+    )
+    db.session.add(delivery)
+    db.session.flush()
+    # Collapse repeated lines for the same ingredient into one stock update
+    increments = {}
+    latest_cost = {}
+    total_cost = 0.0
+    transactions = []
+    lots = []
+    for line in lines:
+        ingredient = line['ingredient']
+        increments[ingredient.id] = increments.get(ingredient.id, 0.0) + line['quantity']
+        unit_cost = line['cost_per_unit'] if line['cost_per_unit'] is not None else (ingredient.cost_per_unit or 0.0)
+        if line['cost_per_unit'] is not None:
+            latest_cost[ingredient.id] = line['cost_per_unit']
+        total_cost += unit_cost * line['quantity']
+        lots.append({
+            'ingredient_id': ingredient.id,
+            'delivery_id': delivery.id,
+            'lot_code': line.get('lot_code') or reference,
+            'received_at': now,
+            'expiry_date': line.get('expiry_date'),
+            'quantity_received': line['quantity'],
+            'quantity_remaining': line['quantity'],
+            'cost_per_unit': unit_cost
+        })
+        transactions.append({
+            'ingredient_id': ingredient.id,
+            'transaction_type': 'purchase',
+            'quantity': line['quantity'],
+            'unit_cost': unit_cost,
+            'total_cost': unit_cost * line['quantity'],
+            'transaction_date': now,
+            'notes': line.get('notes') or (f"Delivery {reference}" if reference else f"Delivery #{delivery.id}"),
+            'delivery_id': delivery.id
+        })
+    ingredients_table = Ingredient.__table__
+    stock_update = ingredients_table.update().where(
+        ingredients_table.c.id == db.bindparam('b_id')
+    ).values(
+        current_stock=db.func.coalesce(ingredients_table.c.current_stock, 0) + db.bindparam('b_quantity'),
+        last_restocked=db.bindparam('b_restocked')
+    )
+    db.session.execute(stock_update, [
+        {'b_id': ingredient_id, 'b_quantity': quantity, 'b_restocked': now}
+        for ingredient_id, quantity in increments.items()
+    ])
+    if latest_cost:
+        cost_update = ingredients_table.update().where(
+            ingredients_table.c.id == db.bindparam('b_id')
+        ).values(cost_per_unit=db.bindparam('b_cost'))
+        db.session.execute(cost_update, [
+            {'b_id': ingredient_id, 'b_cost': cost} for ingredient_id, cost in latest_cost.items()
+        ])
+    db.session.execute(IngredientLot.__table__.insert(), lots)
+    db.session.execute(InventoryTransaction.__table__.insert(), transactions)
+    apply_inventory_rollups(transactions)
+    delivery.line_count = len(transactions)
+    delivery.total_cost = round(total_cost, 2)
+    # The bulk statements bypass the identity map, so refresh any loaded ingredients
+    for line in lines:
+        db.session.expire(line['ingredient'])
+    refresh_stock_alerts(increments.keys())
+    return delivery, increments
+def serialize_delivery(delivery, include_lines=False):
+    data = {
+        'id': delivery.id,
+        'supplier_id': delivery.supplier_id,
+        'supplier_name': delivery.supplier.name if delivery.supplier else None,
+        'reference': delivery.reference,
+        'received_at': delivery.received_at.isoformat() if delivery.received_at else None,
+        'line_count': delivery.line_count,
+        'total_cost': delivery.total_cost,
+        'notes': delivery.notes
+    }
+    if include_lines:
+        transactions = InventoryTransaction.query.filter_by(delivery_id=delivery.id).all()
+        data['lines'] = [{
+            'transaction_id': t.id,
+            'ingredient_id': t.ingredient_id,
+            'ingredient_name': t.ingredient.name if t.ingredient else None,
+            'quantity': t.quantity
+        } for t in transactions]
+    return data
+def _receive_delivery_response(supplier, raw_lines, reference, notes):
+    if not supplier:
+        return jsonify({'message': 'Supplier is required'}), 400
+    if not raw_lines:
+        return jsonify({'message': 'Delivery has no lines'}), 400
+    lines, errors = parse_delivery_lines(raw_lines)
+    if errors:
+        # Reject the whole delivery note so it can be corrected and resubmitted as one unit
+        db.session.rollback()
+        return jsonify({'message': 'Delivery rejected', 'errors': errors}), 400
+    delivery, increments = receive_delivery(supplier, lines, reference=reference, notes=notes)
+    db.session.commit()
+    stock = dict(db.session.query(Ingredient.id, Ingredient.current_stock).filter(Ingredient.id.in_(increments.keys())).all())
+    return jsonify({
+        'message': 'Delivery received',
+        'delivery': serialize_delivery(delivery),
+        'updated_ingredients': [{
+            'ingredient_id': ingredient_id,
+            'quantity_received': quantity,
+            'new_stock': stock.get(ingredient_id)
+        } for ingredient_id, quantity in increments.items()]
+    }), 201
+@app.route('/api/inventory/receive', methods=['POST'])
+def receive_inventory():
+    """Receive a whole supplier delivery note in one request"""
+    data = request.get_json()
+    try:
+        supplier = resolve_supplier(data.get('supplier_id'), data.get('supplier'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return _receive_delivery_response(supplier, data.get('lines', []), data.get('reference'), data.get('notes'))
+@app.route('/api/inventory/receive/import', methods=['POST'])
+def import_delivery_csv():
+    """Receive a supplier delivery from an uploaded CSV file.
+    Expected columns: ingredient_id or ingredient, quantity, cost_per_unit (optional), notes (optional)"""
+    if 'file' not in request.files:
+        return jsonify({'message': 'No file part'}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'message': 'No selected file'}), 400
+    import csv
+    from io import TextIOWrapper
+    reader = csv.DictReader(TextIOWrapper(file.stream, encoding='utf-8-sig'))
+    raw_lines = [{(k or '').strip().lower(): (v or '').strip() for k, v in row.items()} for row in reader]
+    try:
+        supplier = resolve_supplier(request.form.get('supplier_id'), request.form.get('supplier'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return _receive_delivery_response(supplier, raw_lines, request.form.get('reference'), request.form.get('notes'))
+@app.route('/api/inventory/deliveries', methods=['GET'])
+def get_deliveries():
+    query = SupplierDelivery.query
+    supplier_id = request.args.get('supplier_id')
+    if supplier_id:
+        if not supplier_id.isdigit():
+            return jsonify({'message': f'Invalid supplier_id {supplier_id!r}'}), 400
+        query = query.filter_by(supplier_id=int(supplier_id))
+    deliveries = query.order_by(SupplierDelivery.received_at.desc()).all()
+    return jsonify([serialize_delivery(d) for d in deliveries])
+@app.route('/api/inventory/deliveries/<int:delivery_id>', methods=['GET'])
+def get_delivery(delivery_id):
+    delivery = SupplierDelivery.query.get_or_404(delivery_id)
+    return jsonify(serialize_delivery(delivery, include_lines=True))
+# Supplier Management
+@app.route('/api/suppliers', methods=['GET', 'POST'])
+def handle_suppliers():
+    if request.method == 'POST':
+        data = request.get_json()
+        if not (data.get('name') or '').strip():
+            return jsonify({'message': 'Supplier name is required'}), 400
+        supplier = Supplier(
+            name=data['name'].strip(),
+            contact_name=data.get('contact_name'),
+            email=data.get('email'),
+            phone=data.get('phone'),
+            address=data.get('address')
+        )
+        db.session.add(supplier)
+        db.session.commit()
+        return jsonify({'message': 'Supplier created', 'id': supplier.id}), 201
+    suppliers = Supplier.query.order_by(Supplier.name).all()
+    return jsonify([{
+        'id': s.id,
+        'name': s.name,
+        'contact_name': s.contact_name,
+        'email': s.email,
+        'phone': s.phone,
+        'address': s.address
+    } for s in suppliers])
+def record_waste(ingredient, quantity, notes, lot_id=None):
+    """Write waste transactions, one per lot the quantity was taken from.
+    Without an explicit lot, waste comes out of the soonest-expiring lots first."""
+    allocations = consume_lots({ingredient.id: quantity}, lot_id=lot_id).get(ingredient.id, [])
+    untracked = quantity - sum(taken for _, taken in allocations)
+    for allocated_lot_id, taken in allocations:
+        db.session.add(InventoryTransaction(
+            ingredient_id=ingredient.id,
+            transaction_type='waste',
+            quantity=taken,
+            notes=notes,
+            lot_id=allocated_lot_id
+        ))
+    if untracked > 1e-9:
+        db.session.add(InventoryTransaction(
+            ingredient_id=ingredient.id,
+            transaction_type='waste',
+            quantity=untracked,
+            notes=notes
+        ))
+def serialize_lot(lot, ingredient=None):
+    data = {
+        'id': lot.id,
+        'ingredient_id': lot.ingredient_id,
+        'delivery_id': lot.delivery_id,
+        'lot_code': lot.lot_code,
+        'received_at': lot.received_at.isoformat() if lot.received_at else None,
+        'expiry_date': lot.expiry_date.isoformat() if lot.expiry_date else None,
+        'quantity_received': lot.quantity_received,
+        'quantity_remaining': lot.quantity_remaining,
+        'cost_per_unit': lot.cost_per_unit
+    }
+    if ingredient is not None:
+        data['ingredient_name'] = ingredient.name
+        data['unit'] = ingredient.unit
+    return data
+@app.route('/api/inventory/<int:ingredient_id>/lots', methods=['GET'])
+def get_ingredient_lots(ingredient_id):
+    Ingredient.query.get_or_404(ingredient_id)
+    query = IngredientLot.query.filter_by(ingredient_id=ingredient_id)
+    if request.args.get('include_empty', 'false').lower() != 'true':
+        query = query.filter(IngredientLot.quantity_remaining > 0)
+    lots = query.order_by(IngredientLot.expiry_date.is_(None), IngredientLot.expiry_date, IngredientLot.received_at).all()
+    return jsonify([serialize_lot(lot) for lot in lots])
+def get_expiring_lots(days):
+    """Open lots expiring within the given number of days (already expired lots included).
+    Served by the (expiry_date, quantity_remaining) index."""
+    cutoff = datetime.utcnow() + timedelta(days=days)
+    return db.session.query(IngredientLot, Ingredient).join(
+        Ingredient, Ingredient.id == IngredientLot.ingredient_id
+    ).filter(
+        IngredientLot.expiry_date.isnot(None),
+        IngredientLot.expiry_date <= cutoff,
+        IngredientLot.quantity_remaining > 0
+    ).order_by(IngredientLot.expiry_date.asc()).all()
+@app.route('/api/inventory/expiring', methods=['GET'])
+def get_expiring_inventory():
+    days = request.args.get('days', EXPIRING_ITEMS_DAYS, type=int)
+    now = datetime.utcnow()
+    result = []
+    for lot, ingredient in get_expiring_lots(days):
+        data = serialize_lot(lot, ingredient)
+        data['expired'] = lot.expiry_date <= now
+        data['days_until_expiry'] = (lot.expiry_date - now).days
+        result.append(data)
+    return jsonify(result)
 @app.route('/api/inventory/wastage', methods=['POST', 'GET'])
 def inventory_wastage():
     if request.method == 'POST':
@@ -1187,14 +2481,18 @@ def inventory_wastage():
         }
         default_reason = wastage_reason_translations.get(language, wastage_reason_translations['en'])
         reason = data.get('reason', default_reason)
+        if quantity <= 0:
+            return jsonify({'message': 'Quantity must be greater than zero'}), 400
+        lot_id = data.get('lot_id')
+        if lot_id:
+            lot = IngredientLot.query.filter_by(id=lot_id, ingredient_id=ingredient.id).first()
+            if not lot:
+                return jsonify({'message': 'Lot not found for this ingredient'}), 400
+            if quantity > lot.quantity_remaining:
+                return jsonify({'message': 'Cannot waste more than the lot has remaining'}), 400
         ingredient.current_stock = max(0, (ingredient.current_stock or 0) - quantity)
-        t = InventoryTransaction(
-            ingredient_id=ingredient.id,
-            transaction_type='waste',
-            quantity=quantity,
-            notes=reason
-        )
-        db.session.add(t)
+        record_waste(ingredient, quantity, reason, lot_id=lot_id)
+        refresh_stock_alerts([ingredient.id])
         db.session.commit()
         return jsonify({'message': 'Wastage recorded', 'ingredient_id': ingredient.id, 'new_stock': ingredient.current_stock}), 201
     transactions = InventoryTransaction.query.filter_by(transaction_type='waste').order_by(InventoryTransaction.transaction_date.desc()).all()
@@ -1218,6 +2516,13 @@ def spoil_ingredient(ingredient_id):
         return jsonify({'message': 'Quantity must be greater than zero'}), 400
     if quantity > (ingredient.current_stock or 0):
         return jsonify({'message': 'Cannot spoil more than current stock'}), 400
+    lot_id = data.get('lot_id')
+    if lot_id:
+        lot = IngredientLot.query.filter_by(id=lot_id, ingredient_id=ingredient.id).first()
+        if not lot:
+            return jsonify({'message': 'Lot not found for this ingredient'}), 400
+        if quantity > lot.quantity_remaining:
+            return jsonify({'message': 'Cannot spoil more than the lot has remaining'}), 400
     # Get language for spoil reason translation
     language = request.args.get('lang', 'en')
     # Default spoil reason translations
@@ -1230,14 +2535,9 @@ def spoil_ingredient(ingredient_id):
     spoil_reason = reason if reason else default_reason
     # Update ingredient stock
     ingredient.current_stock = max(0, (ingredient.current_stock or 0) - quantity)
-    # Create waste transaction
-    transaction = InventoryTransaction(
-        ingredient_id=ingredient.id,
-        transaction_type='waste',
-        quantity=quantity,
-        notes=spoil_reason
-    )
-    db.session.add(transaction)
+    # Create waste transaction(s), taken from the given lot or from the soonest-expiring lots
+    record_waste(ingredient, quantity, spoil_reason, lot_id=lot_id)
+    refresh_stock_alerts([ingredient.id])
     db.session.commit()
     return jsonify({
         'message': 'Ingredient spoiled successfully', 
@@ -1254,8 +2554,8 @@ def get_inventory_transactions():
         'ingredient_name': t.ingredient.name if t.ingredient else None,
         'transaction_type': t.transaction_type,
         'quantity': t.quantity,
-        'cost_per_unit': t.ingredient.cost_per_unit if t.ingredient else None,
-        'total_cost': (t.quantity * (t.ingredient.cost_per_unit or 0)) if t.ingredient else 0,
+        'cost_per_unit': t.unit_cost,
+        'total_cost': t.total_cost or 0,
         'transaction_date': t.transaction_date.isoformat(),
         'notes': t.notes,
         'related_order_id': t.related_order_id
@@ -1275,67 +2575,674 @@ def update_ingredient(ingredient_id):
         ingredient.cost_per_unit = float(data['cost_per_unit']) if data['cost_per_unit'] is not None else 0.0
     if 'supplier' in data:
         ingredient.supplier = data['supplier']
+    if 'supplier_id' in data:
+        ingredient.supplier_id = int(data['supplier_id']) if data['supplier_id'] else None
+    if 'pack_size' in data:
+        ingredient.pack_size = float(data['pack_size']) if data['pack_size'] else None
+    if 'min_order_qty' in data:
+        ingredient.min_order_qty = float(data['min_order_qty']) if data['min_order_qty'] else None
+    if 'lead_time_days' in data:
+        ingredient.lead_time_days = float(data['lead_time_days']) if data['lead_time_days'] is not None else None
+    if 'min_stock' in data or 'current_stock' in data:
+        refresh_stock_alerts([ingredient.id])
     db.session.commit()
     return jsonify({'message': 'Ingredient updated', 'id': ingredient.id})
+# Purchase Orders
+def round_order_quantity(quantity, min_order_qty=None, pack_size=None):
+    """Apply a supplier minimum and round up to whole packs"""
+    quantity = max(quantity, min_order_qty or 0)
+    if pack_size and pack_size > 0:
+        quantity = np.ceil(round(quantity / pack_size, 9)) * pack_size
+    return float(quantity)
+def serialize_purchase_order(po, include_lines=False):
+    data = {
+        'id': po.id,
+        'supplier_id': po.supplier_id,
+        'supplier_name': po.supplier.name if po.supplier else None,
+        'status': po.status,
+        'created_at': po.created_at.isoformat() if po.created_at else None,
+        'sent_at': po.sent_at.isoformat() if po.sent_at else None,
+        'received_at': po.received_at.isoformat() if po.received_at else None,
+        'total_cost': po.total_cost,
+        'delivery_id': po.delivery_id,
+        'notes': po.notes
+    }
+    if include_lines:
+        data['lines'] = [{
+            'id': line.id,
+            'ingredient_id': line.ingredient_id,
+            'ingredient_name': line.ingredient.name if line.ingredient else None,
+            'unit': line.ingredient.unit if line.ingredient else None,
+            'quantity': line.quantity,
+            'pack_size': line.pack_size,
+            'unit_cost': line.unit_cost,
+            'line_total': line.line_total,
+            'quantity_received': line.quantity_received
+        } for line in po.lines]
+    return data
+@app.route('/api/purchase-orders/generate', methods=['POST'])
+def generate_purchase_orders():
+    """Turn reorder suggestions into draft purchase orders, one per supplier.
+    Quantities already on open purchase orders are netted off so re-running does not double-order."""
+    data = request.get_json(silent=True) or {}
+    if data.get('recalculate'):
+        recalculate_reorder_points()
+    rows = db.session.query(
+        Ingredient.id, Ingredient.current_stock, Ingredient.cost_per_unit, Ingredient.supplier_id,
+        Ingredient.supplier, Ingredient.pack_size, Ingredient.min_order_qty,
+        ReorderSuggestion.reorder_point, ReorderSuggestion.par_level
+    ).join(ReorderSuggestion, ReorderSuggestion.ingredient_id == Ingredient.id).filter(
+        Ingredient.current_stock <= ReorderSuggestion.reorder_point
+    ).all()
+    on_order = dict(db.session.query(
+        PurchaseOrderLine.ingredient_id, db.func.sum(PurchaseOrderLine.quantity)
+    ).join(PurchaseOrder).filter(PurchaseOrder.status.in_(['draft', 'sent'])).group_by(PurchaseOrderLine.ingredient_id).all())
+    # Free-text supplier names are matched to Supplier rows for ingredients not linked yet
+    suppliers_by_name = {s.name.lower(): s.id for s in Supplier.query.all()}
+    grouped = {}
+    unassigned = []
+    for row in rows:
+        need = (row.par_level or 0) - (row.current_stock or 0) - (on_order.get(row.id) or 0)
+        if need <= 0:
+            continue
+        supplier_id = row.supplier_id or suppliers_by_name.get((row.supplier or '').strip().lower())
+        if not supplier_id:
+            unassigned.append({'ingredient_id': row.id, 'quantity_needed': round(need, 4)})
+            continue
+        quantity = round_order_quantity(need, row.min_order_qty, row.pack_size)
+        unit_cost = row.cost_per_unit or 0.0
+        grouped.setdefault(supplier_id, []).append({
+            'ingredient_id': row.id,
+            'quantity': quantity,
+            'pack_size': row.pack_size,
+            'unit_cost': unit_cost,
+            'line_total': round(quantity * unit_cost, 2)
+        })
+    orders = []
+    for supplier_id, lines in grouped.items():
+        po = PurchaseOrder(
+            supplier_id=supplier_id,
+            status='draft',
+            total_cost=round(sum(l['line_total'] for l in lines), 2),
+            created_by_user_id=session.get('user_id')
+        )
+        db.session.add(po)
+        orders.append((po, lines))
+    db.session.flush()
+    line_records = [dict(line, purchase_order_id=po.id) for po, lines in orders for line in lines]
+    if line_records:
+        db.session.execute(PurchaseOrderLine.__table__.insert(), line_records)
+    db.session.commit()
+    return jsonify({
+        'message': 'Purchase orders generated',
+        'purchase_orders': [dict(serialize_purchase_order(po), line_count=len(lines)) for po, lines in orders],
+        'unassigned': unassigned
+    }), 201
+@app.route('/api/purchase-orders', methods=['GET'])
+def get_purchase_orders():
+    query = PurchaseOrder.query
+    if request.args.get('status'):
+        query = query.filter_by(status=request.args['status'])
+    if request.args.get('supplier_id'):
+        query = query.filter_by(supplier_id=int(request.args['supplier_id']))
+    return jsonify([serialize_purchase_order(po) for po in query.order_by(PurchaseOrder.created_at.desc()).all()])
+@app.route('/api/purchase-orders/<int:po_id>', methods=['GET', 'PATCH'])
+def handle_purchase_order(po_id):
+    po = PurchaseOrder.query.get_or_404(po_id)
+    if request.method == 'PATCH':
+        data = request.get_json()
+        status = data.get('status', po.status)
+        if po.status in ['received', 'cancelled'] and status != po.status:
+            return jsonify({'message': f'Purchase order is already {po.status}'}), 400
+        if status not in ['draft', 'sent', 'cancelled']:
+            return jsonify({'message': 'Invalid status'}), 400
+        if status == 'sent' and po.status != 'sent':
+            po.sent_at = datetime.utcnow()
+        po.status = status
+        po.notes = data.get('notes', po.notes)
+        db.session.commit()
+    return jsonify(serialize_purchase_order(po, include_lines=True))
+@app.route('/api/purchase-orders/<int:po_id>/receive', methods=['POST'])
+def receive_purchase_order(po_id):
+    """Receive a purchase order through the bulk delivery path.
+    Optional body lines: [{"line_id", "quantity_received", "cost_per_unit", "expiry_date", "lot_code"}];
+    lines not mentioned are received in full."""
+    po = PurchaseOrder.query.get_or_404(po_id)
+    if po.status in ['received', 'cancelled']:
+        return jsonify({'message': f'Purchase order is already {po.status}'}), 400
+    data = request.get_json(silent=True) or {}
+    overrides = {int(l['line_id']): l for l in data.get('lines', [])}
+    raw_lines = []
+    for line in po.lines:
+        override = overrides.get(line.id, {})
+        quantity = float(override.get('quantity_received', line.quantity))
+        line.quantity_received = quantity
+        if quantity <= 0:
+            continue
+        raw_lines.append({
+            'ingredient_id': line.ingredient_id,
+            'quantity': quantity,
+            'cost_per_unit': override.get('cost_per_unit', line.unit_cost),
+            'expiry_date': override.get('expiry_date'),
+            'lot_code': override.get('lot_code')
+        })
+    if not raw_lines:
+        db.session.rollback()
+        return jsonify({'message': 'Nothing to receive'}), 400
+    lines, errors = parse_delivery_lines(raw_lines)
+    if errors:
+        db.session.rollback()
+        return jsonify({'message': 'Receiving rejected', 'errors': errors}), 400
+    reference = data.get('reference') or f'PO-{po.id}'
+    delivery, increments = receive_delivery(po.supplier, lines, reference=reference, notes=data.get('notes'))
+    po.status = 'received'
+    po.received_at = delivery.received_at
+    po.delivery_id = delivery.id
+    db.session.commit()
+    return jsonify({
+        'message': 'Purchase order received',
+        'purchase_order': serialize_purchase_order(po, include_lines=True),
+        'delivery': serialize_delivery(delivery)
+    })
+# Production planning (recipe explosion)
+_recipe_matrix_cache = {'generation': None, 'matrix': None}
+def get_recipe_matrix():
+    """Sparse menu-item x ingredient bill-of-materials matrix in COO form.
+    Cached per process and rebuilt when the recipes table's write generation moves,
+    so workers that did not make the change still notice it."""
+    generation = tuple(table_generations(['recipes', TABLE_GENERATION_WILDCARD]).values())
+    # Uncommitted recipe writes in this session haven't moved the generation yet
+    pending = db.session.info.get('written_tables', ())
+    fresh = 'recipes' not in pending and TABLE_GENERATION_WILDCARD not in pending
+    if fresh and _recipe_matrix_cache['generation'] == generation and _recipe_matrix_cache['matrix'] is not None:
+        return _recipe_matrix_cache['matrix']
+    rows = db.session.query(Recipe.menu_item_id, Recipe.ingredient_id, Recipe.quantity_required).all()
+    item_ids = np.array(sorted({r[0] for r in rows}), dtype=np.int64)
+    ingredient_ids = np.array(sorted({r[1] for r in rows}), dtype=np.int64)
+    if rows:
+        raw = np.array(rows, dtype=np.float64)
+        item_index = np.searchsorted(item_ids, raw[:, 0].astype(np.int64))
+        ingredient_index = np.searchsorted(ingredient_ids, raw[:, 1].astype(np.int64))
+        quantities = raw[:, 2]
+    else:
+        item_index = ingredient_index = np.empty(0, dtype=np.int64)
+        quantities = np.empty(0)
+    matrix = {
+        'item_ids': item_ids,
+        'ingredient_ids': ingredient_ids,
+        'rows': item_index,
+        'cols': ingredient_index,
+        'values': quantities
+    }
+    if fresh:
+        _recipe_matrix_cache.update(generation=generation, matrix=matrix)
+    return matrix
+def explode_demand(menu_item_ids, demand, matrix=None):
+    """Multiply menu demand by the recipe matrix.
+    demand has shape (len(menu_item_ids),) or (periods, len(menu_item_ids)).
+    Returns (ingredient_ids, requirements) with requirements shaped (ingredients,)
+    or (periods, ingredients) to match."""
+    matrix = matrix or get_recipe_matrix()
+    demand = np.asarray(demand, dtype=np.float64)
+    single = demand.ndim == 1
+    demand = np.atleast_2d(demand)
+    # Scatter the requested items into the matrix's item order; items without recipes drop out
+    aligned = np.zeros((demand.shape[0], len(matrix['item_ids'])))
+    menu_item_ids = np.asarray(menu_item_ids, dtype=np.int64)
+    if len(matrix['item_ids']) and len(menu_item_ids):
+        pos = np.clip(np.searchsorted(matrix['item_ids'], menu_item_ids), 0, len(matrix['item_ids']) - 1)
+        known = matrix['item_ids'][pos] == menu_item_ids
+        np.add.at(aligned, (slice(None), pos[known]), demand[:, known])
+    requirements = np.zeros((demand.shape[0], len(matrix['ingredient_ids'])))
+    if len(matrix['values']):
+        np.add.at(requirements, (slice(None), matrix['cols']), aligned[:, matrix['rows']] * matrix['values'])
+    return matrix['ingredient_ids'], (requirements[0] if single else requirements)
+def _parse_demand_quantity(value):
+    quantity = float(value)
+    if not math.isfinite(quantity) or quantity < 0:
+        raise ValueError(f'invalid quantity {value!r}')
+    return quantity
+def _parse_demand_map(items):
+    """Accept {"<menu_item_id>": qty} or [{"menu_item_id": id, "quantity": qty}].
+    Raises TypeError, ValueError or KeyError on malformed input."""
+    if isinstance(items, dict):
+        return {int(k): _parse_demand_quantity(v) for k, v in items.items()}
+    if not isinstance(items, list):
+        raise TypeError('demand must be an object or a list')
+    demand = {}
+    for entry in items:
+        menu_item_id = int(entry['menu_item_id'])
+        demand[menu_item_id] = demand.get(menu_item_id, 0.0) + _parse_demand_quantity(entry.get('quantity', 0))
+    return demand
+@app.route('/api/planning/ingredient-requirements', methods=['POST'])
+def ingredient_requirements():
+    """Convert forecast menu demand into ingredient requirements and a shortfall list.
+    Body: {"demand": {...}} for a single period, or
+          {"periods": [{"label": "2024-06-01", "demand": {...}}, ...]} for a horizon."""
+    data = request.get_json(silent=True) or {}
+    try:
+        if data.get('periods'):
+            labels = [p.get('label', str(i)) for i, p in enumerate(data['periods'])]
+            period_maps = [_parse_demand_map(p.get('demand')) for p in data['periods']]
+        elif data.get('demand') is not None:
+            labels = None
+            period_maps = [_parse_demand_map(data['demand'])]
+        else:
+            return jsonify({'message': 'demand or periods is required'}), 400
+    except (AttributeError, TypeError, ValueError, KeyError) as e:
+        return jsonify({'message': f'Invalid demand: {e}'}), 400
+    menu_item_ids = sorted({item_id for m in period_maps for item_id in m})
+    demand = np.array([[m.get(item_id, 0.0) for item_id in menu_item_ids] for m in period_maps]).reshape(len(period_maps), len(menu_item_ids))
+    matrix = get_recipe_matrix()
+    ingredient_ids, requirements = explode_demand(menu_item_ids, demand, matrix)
+    totals = requirements.sum(axis=0)
+    needed = totals > 0
+    ingredients = {i.id: i for i in Ingredient.query.filter(Ingredient.id.in_(ingredient_ids[needed].tolist())).all()} if needed.any() else {}
+    result = []
+    shortfall = []
+    for col in np.nonzero(needed)[0]:
+        ingredient = ingredients.get(int(ingredient_ids[col]))
+        if not ingredient:
+            continue
+        required = float(totals[col])
+        available = ingredient.current_stock or 0
+        entry = {
+            'ingredient_id': ingredient.id,
+            'name': ingredient.name,
+            'unit': ingredient.unit,
+            'required': round(required, 4),
+            'current_stock': available,
+            'shortfall': round(max(0.0, required - available), 4),
+            'estimated_cost': round(required * (ingredient.cost_per_unit or 0), 2)
+        }
+        if labels is not None:
+            entry['by_period'] = [{'label': label, 'required': round(float(q), 4)}
+                                  for label, q in zip(labels, requirements[:, col])]
+        result.append(entry)
+        if entry['shortfall'] > 0:
+            shortfall.append({k: entry[k] for k in ('ingredient_id', 'name', 'unit', 'required', 'current_stock', 'shortfall')})
+    items_with_recipes = set(matrix['item_ids'].tolist())
+    unknown_items = [i for i in menu_item_ids if i not in items_with_recipes]
+    return jsonify({
+        'requirements': sorted(result, key=lambda e: e['name']),
+        'shortfall': sorted(shortfall, key=lambda e: -e['shortfall']),
+        'items_without_recipes': unknown_items,
+        'periods': labels
+    })
 # Reservation Management
+# Reservation conflicts and availability
+@db.event.listens_for(db.session, 'before_flush')
+def _stamp_reservation_end_times(sess, flush_context, instances):
+    for reservation in list(sess.new) + list(sess.dirty):
+        if isinstance(reservation, Reservation) and reservation.reservation_time:
+            if not reservation.duration_minutes:
+                reservation.duration_minutes = RESERVATION_DEFAULT_DURATION_MINUTES
+            reservation.end_time = reservation.reservation_time + timedelta(minutes=reservation.duration_minutes)
+def reservation_conflicts(table_id, start, end, exclude_id=None):
+    """Active reservations on a table overlapping [start, end), found with one range seek on
+    ix_reservations_table_start_end; the maximum duration bounds how far back a booking can start."""
+    overlapping = (
+        Reservation.reservation_time < end,
+        Reservation.reservation_time > start - timedelta(minutes=RESERVATION_MAX_DURATION_MINUTES),
+        Reservation.end_time > start,
+        Reservation.status.in_(RESERVATION_ACTIVE_STATUSES),
+        Reservation.id != (exclude_id or 0)
+    )
+    primary = Reservation.query.filter(Reservation.table_id == table_id, *overlapping)
+    # Bookings that use this table as a joined table
+    joined = Reservation.query.join(ReservationTable, ReservationTable.reservation_id == Reservation.id).filter(
+        ReservationTable.table_id == table_id, *overlapping
+    )
+    return sorted(primary.all() + joined.all(), key=lambda r: r.reservation_time)
+class ReservationDayIndex:
+    """Bookings overlapping one service day, per table, as starts sorted ascending with a running
+    maximum of their ends. Whether [start, end) is free is then a single bisect: the bookings that
+    start before `end` are a prefix, and one of them overlaps iff the largest end in it is after `start`."""
+    def __init__(self, day, bookings):
+        self.day = day
+        by_table = {}
+        for table_id, start, end, reservation_id in sorted(bookings, key=lambda b: b[1]):
+            by_table.setdefault(table_id, []).append((start, end, reservation_id))
+        self.tables = {}
+        for table_id, intervals in by_table.items():
+            max_ends = []
+            for _, end, _ in intervals:
+                max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+            self.tables[table_id] = ([i[0] for i in intervals], max_ends, intervals)
+    def is_free(self, table_id, start, end):
+        entry = self.tables.get(table_id)
+        if entry is None:
+            return True
+        starts, max_ends, _ = entry
+        index = bisect_left(starts, end)
+        return index == 0 or max_ends[index - 1] <= start
+    def neighbours(self, table_id, start, end):
+        """(end of the booking before, start of the booking after) a free [start, end) on the table"""
+        entry = self.tables.get(table_id)
+        if entry is None:
+            return None, None
+        starts, max_ends, _ = entry
+        index = bisect_left(starts, end)
+        return (max_ends[index - 1] if index else None), (starts[index] if index < len(starts) else None)
+    def bookings(self, table_id):
+        return self.tables.get(table_id, ([], [], []))[2]
+    def add(self, table_id, start, end, reservation_id):
+        """Record a booking made after the index was built (batch assignment works on its own copy)"""
+        starts, max_ends, intervals = self.tables.setdefault(table_id, ([], [], []))
+        insort(intervals, (start, end, reservation_id))
+        starts[:] = [i[0] for i in intervals]
+        max_ends[:] = []
+        for _, interval_end, _ in intervals:
+            max_ends.append(max(interval_end, max_ends[-1]) if max_ends else interval_end)
+_reservation_day_indexes = {}  # day -> (reservations table generation, ReservationDayIndex)
+_reservation_day_indexes_lock = threading.Lock()
+RESERVATION_DAY_INDEX_LIMIT = 62  # days kept in memory
+def load_reservation_day_index(day):
+    """Build a fresh index of the active bookings overlapping a service day, joined tables included"""
+    day_start = datetime.combine(day, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+    on_day = (
+        Reservation.reservation_time < day_end,
+        Reservation.reservation_time > day_start - timedelta(minutes=RESERVATION_MAX_DURATION_MINUTES),
+        Reservation.end_time > day_start,
+        Reservation.status.in_(RESERVATION_ACTIVE_STATUSES)
+    )
+    rows = db.session.query(
+        Reservation.table_id, Reservation.reservation_time, Reservation.end_time, Reservation.id
+    ).filter(Reservation.table_id.isnot(None), *on_day).all()
+    rows += db.session.query(
+        ReservationTable.table_id, Reservation.reservation_time, Reservation.end_time, Reservation.id
+    ).join(Reservation, Reservation.id == ReservationTable.reservation_id).filter(*on_day).all()
+    return ReservationDayIndex(day, [tuple(row) for row in rows])
+def reservation_day_index(day):
+    """The in-memory index for a service day, rebuilt only after reservations were written (by any worker)"""
+    generation = tuple(table_generations(['reservations', 'reservation_tables', TABLE_GENERATION_WILDCARD]).values())
+    with _reservation_day_indexes_lock:
+        cached = _reservation_day_indexes.get(day)
+        if cached and cached[0] == generation:
+            return cached[1]
+    index = load_reservation_day_index(day)
+    with _reservation_day_indexes_lock:
+        _reservation_day_indexes[day] = (generation, index)
+        while len(_reservation_day_indexes) > RESERVATION_DAY_INDEX_LIMIT:
+            _reservation_day_indexes.pop(min(_reservation_day_indexes))
+    return index
+def parse_reservation_duration(value):
+    duration = int(value if value is not None else RESERVATION_DEFAULT_DURATION_MINUTES)
+    if not 0 < duration <= RESERVATION_MAX_DURATION_MINUTES:
+        raise ValueError(f'duration_minutes must be between 1 and {RESERVATION_MAX_DURATION_MINUTES}')
+    return duration
+def lock_tables_for_booking(table_ids):
+    """Serialize bookings on these tables until the transaction ends, so an overlap check followed by
+    the write can't interleave with another booking's: a row lock on PostgreSQL, and on SQLite the
+    database write lock, taken by a no-op UPDATE (issued on the connection, so no write is recorded)"""
+    connection = db.session.connection()
+    ids = sorted(set(table_ids))
+    if db.engine.dialect.name == 'postgresql':
+        connection.execute(db.select(Table.id).where(Table.id.in_(ids)).order_by(Table.id).with_for_update(key_share=True))
+    else:
+        table = Table.__table__
+        connection.execute(table.update().where(table.c.id.in_(ids)).values(status=table.c.status))
+def check_reservation_slot(reservation, table_ids=None):
+    """Error response for a reservation that does not fit its table(s), or None.
+    Locks the tables first; commit or roll back promptly after calling this."""
+    table_ids = list(dict.fromkeys(reservation.table_ids if table_ids is None else table_ids))
+    if reservation.status not in RESERVATION_ACTIVE_STATUSES or not table_ids:
+        return None
+    lock_tables_for_booking(table_ids)
+    tables = Table.query.filter(Table.id.in_(table_ids)).all()
+    if len(tables) != len(set(table_ids)):
+        return jsonify({'message': 'Table not found'}), 404
+    capacity = sum(t.capacity for t in tables)
+    if reservation.party_size and reservation.party_size > capacity:
+        numbers = ', '.join(str(t.table_number) for t in tables)
+        return jsonify({'message': f'Table {numbers} seats {capacity}, party is {reservation.party_size}'}), 400
+    end = reservation.reservation_time + timedelta(minutes=reservation.duration_minutes)
+    for table in tables:
+        conflicts = reservation_conflicts(table.id, reservation.reservation_time, end, exclude_id=reservation.id)
+        if conflicts:
+            return jsonify({
+                'message': f'Table {table.table_number} is already booked at that time',
+                'conflicts': [{
+                    'id': r.id,
+                    'reservation_time': r.reservation_time.isoformat(),
+                    'end_time': r.end_time.isoformat()
+                } for r in conflicts]
+            }), 409
+    return None
+def set_reservation_tables(reservation, table_ids):
+    """First table is the primary one; the rest are joined to it (a table listed twice is joined once)"""
+    table_ids = list(dict.fromkeys(table_ids))
+    reservation.table_id = table_ids[0] if table_ids else None
+    reservation.joined_tables = [ReservationTable(table_id=table_id) for table_id in table_ids[1:]]
+# Table assignment: best-fit tables (or combinations) for a party and time window
+def score_table_option(index, tables, party_size, start, end, location=None):
+    capacity = sum(t.capacity for t in tables)
+    score = (capacity - party_size) * ASSIGNMENT_WASTE_PENALTY
+    score += (len(tables) - 1) * ASSIGNMENT_COMBINATION_PENALTY
+    if location:
+        score += sum(1 for t in tables if t.location != location) * ASSIGNMENT_LOCATION_PENALTY
+    # Leaving a gap before or after another booking that is too short to seat anyone wastes table time
+    sellable = timedelta(minutes=RESERVATION_DEFAULT_DURATION_MINUTES)
+    for t in tables:
+        previous_end, next_start = index.neighbours(t.id, start, end)
+        for gap in ((start - previous_end) if previous_end else None, (next_start - end) if next_start else None):
+            if gap is not None and timedelta(0) < gap < sellable:
+                score += gap.total_seconds() / 3600 * ASSIGNMENT_IDLE_GAP_PENALTY
+    return {
+        'table_ids': [t.id for t in tables],
+        'table_numbers': [t.table_number for t in tables],
+        'capacity': capacity,
+        'empty_seats': capacity - party_size,
+        'score': round(score, 2)
+    }
+def table_assignment_options(index, tables, party_size, start, end, location=None, limit=5, exclude_table_ids=()):
+    """Best options for seating a party in [start, end), lowest score first.
+    Combinations are only joined within one location and are found best-fit with bisect over sorted
+    capacities (one table per partner for pairs, per pair for triples) instead of enumerating every set."""
+    free = sorted(
+        (t for t in tables if t.id not in exclude_table_ids and index.is_free(t.id, start, end)),
+        key=lambda t: (t.capacity, t.table_number)
+    )
+    candidates = [[t] for t in free if t.capacity >= party_size]
+    if not candidates or party_size >= ASSIGNMENT_LARGE_PARTY:
+        by_location = {}
+        for t in free:
+            by_location.setdefault(t.location or '', []).append(t)
+        for group in by_location.values():
+            capacities = [t.capacity for t in group]
+            pairs = []
+            for i, first in enumerate(group):
+                j = bisect_left(capacities, party_size - first.capacity, lo=i + 1)
+                if j < len(group):
+                    pairs.append([first, group[j]])
+            candidates.extend(pairs)
+            if not pairs and ASSIGNMENT_MAX_COMBINED_TABLES >= 3:
+                for i, first in enumerate(group):
+                    for j in range(i + 1, len(group)):
+                        k = bisect_left(capacities, party_size - first.capacity - group[j].capacity, lo=j + 1)
+                        if k < len(group):
+                            candidates.append([first, group[j], group[k]])
+    options = [score_table_option(index, option, party_size, start, end, location) for option in candidates]
+    # On equal scores, keep the largest tables free for parties that need them
+    largest = {t.id: t.capacity for t in free}
+    options.sort(key=lambda o: (o['score'], len(o['table_ids']), max(largest[i] for i in o['table_ids']), o['table_numbers']))
+    return options[:limit]
+@app.route('/api/tables/assignment-options', methods=['GET'])
+def table_assignment_options_endpoint():
+    """Ranked tables for a party: ?party_size=N[&time=ISO (default now)&duration=&location=&limit=]"""
+    try:
+        party_size = int(request.args['party_size'])
+        start = datetime.fromisoformat(request.args['time']) if request.args.get('time') else datetime.now().replace(second=0, microsecond=0)
+        duration = parse_reservation_duration(request.args.get('duration', type=int))
+    except (KeyError, ValueError) as e:
+        return jsonify({'message': f'Invalid assignment query: {e}'}), 400
+    end = start + timedelta(minutes=duration)
+    limit = max(1, min(request.args.get('limit', 5, type=int), 20))
+    tables = Table.query.all()
+    # A walk-in can only take tables that are free right now
+    exclude = set()
+    if start <= datetime.now() + timedelta(minutes=RESERVATION_SLOT_MINUTES):
+        exclude = {t.id for t in tables if t.status not in ('available', 'reserved')}
+    options = table_assignment_options(
+        reservation_day_index(start.date()), tables, party_size, start, end,
+        request.args.get('location'), limit, exclude
+    )
+    return jsonify({'party_size': party_size, 'start': start.isoformat(), 'end': end.isoformat(), 'options': options})
+@app.route('/api/reservations/optimize', methods=['POST'])
+def optimize_reservations():
+    """Assign tables to a day's unassigned bookings (body: date, optional from/to HH:MM, dry_run).
+    Largest parties are placed first, each on its best option, against a private copy of the day index."""
+    data = request.get_json(silent=True) or {}
+    try:
+        day = datetime.strptime(data['date'], '%Y-%m-%d').date()
+        window_from = datetime.combine(day, datetime.strptime(data.get('from', '00:00'), '%H:%M').time())
+        window_to = datetime.combine(day, datetime.strptime(data.get('to', '23:59'), '%H:%M').time())
+    except (KeyError, ValueError) as e:
+        return jsonify({'message': f'Invalid optimize request: {e}'}), 400
+    pending = Reservation.query.filter(
+        Reservation.table_id.is_(None),
+        Reservation.reservation_time >= window_from,
+        Reservation.reservation_time <= window_to,
+        Reservation.status.in_(RESERVATION_ACTIVE_STATUSES)
+    ).order_by(Reservation.party_size.desc(), Reservation.reservation_time, Reservation.id).all()
+    index = load_reservation_day_index(day)
+    tables = Table.query.all()
+    tables_by_id = {t.id: t for t in tables}
+    assigned, unplaced = [], []
+    for reservation in pending:
+        options = table_assignment_options(index, tables, reservation.party_size, reservation.reservation_time, reservation.end_time, limit=1)
+        if not options:
+            unplaced.append(reservation.id)
+            continue
+        best = options[0]
+        for table_id in best['table_ids']:
+            index.add(table_id, reservation.reservation_time, reservation.end_time, reservation.id)
+        if not data.get('dry_run'):
+            set_reservation_tables(reservation, best['table_ids'])
+        assigned.append({
+            'reservation_id': reservation.id,
+            'party_size': reservation.party_size,
+            'reservation_time': reservation.reservation_time.isoformat(),
+            'table_ids': best['table_ids'],
+            'table_numbers': [tables_by_id[table_id].table_number for table_id in best['table_ids']],
+            'score': best['score']
+        })
+    if not data.get('dry_run'):
+        db.session.commit()
+    return jsonify({'date': day.isoformat(), 'dry_run': bool(data.get('dry_run')), 'assigned': assigned, 'unplaced': unplaced})
+@app.route('/api/reservations/availability', methods=['GET'])
+def reservation_availability():
+    """Free start times on a day for a party: ?date=YYYY-MM-DD&party_size=N[&duration=&from=HH:MM&to=HH:MM]"""
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d').date()
+        party_size = int(request.args.get('party_size', 1))
+        duration = parse_reservation_duration(request.args.get('duration', type=int))
+        window_from = datetime.strptime(request.args.get('from', f'{RESERVATION_SERVICE_HOURS[0]:02d}:00'), '%H:%M').time()
+        window_to = datetime.strptime(request.args.get('to', f'{RESERVATION_SERVICE_HOURS[1]:02d}:00'), '%H:%M').time()
+    except (KeyError, ValueError) as e:
+        return jsonify({'message': f'Invalid availability query: {e}'}), 400
+    # Smallest tables first, so the first listed table is the tightest fit
+    tables = Table.query.filter(Table.capacity >= party_size).order_by(Table.capacity, Table.table_number).all()
+    index = reservation_day_index(day)
+    step = timedelta(minutes=RESERVATION_SLOT_MINUTES)
+    length = timedelta(minutes=duration)
+    slot = datetime.combine(day, window_from)
+    last_start = datetime.combine(day, window_to) - length
+    slots = []
+    while slot <= last_start:
+        free = [t for t in tables if index.is_free(t.id, slot, slot + length)]
+        if free:
+            slots.append({
+                'time': slot.isoformat(),
+                'tables': [{'id': t.id, 'table_number': t.table_number, 'capacity': t.capacity} for t in free]
+            })
+        slot += step
+    return jsonify({'date': day.isoformat(), 'party_size': party_size, 'duration_minutes': duration, 'slots': slots})
+def serialize_reservation(res):
+    return {
+        'id': res.id,
+        'customer_id': res.customer_id,
+        'customer_name': f"{res.customer.first_name} {res.customer.last_name}" if res.customer else None,
+        'table_id': res.table_id,
+        'table_number': res.table.table_number if res.table else None,
+        'table_ids': res.table_ids,
+        'table_numbers': ([res.table.table_number] if res.table else []) + [jt.table.table_number for jt in res.joined_tables],
+        'party_size': res.party_size,
+        'reservation_time': res.reservation_time.isoformat(),
+        'duration_minutes': res.duration_minutes,
+        'end_time': res.end_time.isoformat() if res.end_time else None,
+        'status': res.status,
+        'special_requests': res.special_requests
+    }
 @app.route('/api/reservations', methods=['GET', 'POST'])
 def handle_reservations():
     if request.method == 'POST':
         data = request.get_json()
-        # Check if table is available
-        table = Table.query.get(data['table_id'])
-        if table.status != 'available':
-            return jsonify({'message': 'Table is not available'}), 400
+        try:
+            duration = parse_reservation_duration(data.get('duration_minutes'))
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
         reservation = Reservation(
             customer_id=data.get('customer_id'),
-            table_id=data['table_id'],
             party_size=data['party_size'],
             reservation_time=datetime.fromisoformat(data['reservation_time']),
+            duration_minutes=duration,
+            status=data.get('status', 'confirmed'),
             special_requests=data.get('special_requests')
         )
-        table.status = 'reserved'
+        # table_ids joins several tables; with neither table_id nor table_ids the booking is left
+        # unassigned for /api/reservations/optimize, unless auto_assign picks the best option now
+        table_ids = data.get('table_ids') or ([data['table_id']] if data.get('table_id') else [])
+        if not table_ids and data.get('auto_assign'):
+            end = reservation.reservation_time + timedelta(minutes=duration)
+            options = table_assignment_options(
+                reservation_day_index(reservation.reservation_time.date()), Table.query.all(),
+                reservation.party_size, reservation.reservation_time, end, data.get('location'), limit=1
+            )
+            if not options:
+                return jsonify({'message': 'No table is free for this party at that time'}), 409
+            table_ids = options[0]['table_ids']
+        error = check_reservation_slot(reservation, table_ids)
+        if error:
+            db.session.rollback()
+            return error
+        set_reservation_tables(reservation, table_ids)
         db.session.add(reservation)
         db.session.commit()
         return jsonify({'message': 'Reservation created', 'id': reservation.id}), 201
     elif request.method == 'GET':
-        reservations = Reservation.query.join(Table).outerjoin(Customer).order_by(Reservation.reservation_time.asc()).all()
-        return jsonify([{
-            'id': res.id,
-            'customer_id': res.customer_id,
-            'customer_name': f"{res.customer.first_name} {res.customer.last_name}" if res.customer else None,
-            'table_id': res.table_id,
-            'table_number': res.table.table_number if res.table else None,
-            'party_size': res.party_size,
-            'reservation_time': res.reservation_time.isoformat(),
-            'status': res.status,
-            'special_requests': res.special_requests
-        } for res in reservations])
+        reservations = Reservation.query.outerjoin(Table).outerjoin(Customer).order_by(Reservation.reservation_time.asc()).all()
+        return jsonify([serialize_reservation(res) for res in reservations])
 @app.route('/api/reservations/<int:reservation_id>', methods=['GET'])
 def get_reservation(reservation_id):
     reservation = Reservation.query.get_or_404(reservation_id)
-    return jsonify({
-        'id': reservation.id,
-        'customer_id': reservation.customer_id,
-        'customer_name': f"{reservation.customer.first_name} {reservation.customer.last_name}" if reservation.customer else None,
-        'table_id': reservation.table_id,
-        'table_number': reservation.table.table_number if reservation.table else None,
-        'party_size': reservation.party_size,
-        'reservation_time': reservation.reservation_time.isoformat(),
-        'status': reservation.status,
-        'special_requests': reservation.special_requests,
-        'created_at': reservation.created_at.isoformat()
-    })
+    return jsonify({**serialize_reservation(reservation), 'created_at': reservation.created_at.isoformat()})
 @app.route('/api/reservations/<int:reservation_id>', methods=['PUT'])
 def update_reservation(reservation_id):
     reservation = Reservation.query.get_or_404(reservation_id)
     data = request.get_json()
     reservation.customer_id = data.get('customer_id', reservation.customer_id)
-    reservation.table_id = data.get('table_id', reservation.table_id)
+    if 'table_ids' in data:
+        set_reservation_tables(reservation, data['table_ids'] or [])
+    elif 'table_id' in data and data['table_id'] != reservation.table_id:
+        set_reservation_tables(reservation, [data['table_id']] if data['table_id'] else [])
     reservation.party_size = data.get('party_size', reservation.party_size)
     if data.get('reservation_time'):
         reservation.reservation_time = datetime.fromisoformat(data['reservation_time'])
+    if 'duration_minutes' in data:
+        try:
+            reservation.duration_minutes = parse_reservation_duration(data['duration_minutes'])
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'message': str(e)}), 400
     reservation.status = data.get('status', reservation.status)
     reservation.special_requests = data.get('special_requests', reservation.special_requests)
+    with db.session.no_autoflush:
+        error = check_reservation_slot(reservation)
+    if error:
+        db.session.rollback()
+        return error
     db.session.commit()
     return jsonify({'message': 'Reservation updated', 'id': reservation.id})
 @app.route('/api/reservations/<int:reservation_id>', methods=['DELETE'])
@@ -1344,6 +3251,481 @@ def delete_reservation(reservation_id):
     db.session.delete(reservation)
     db.session.commit()
     return jsonify({'message': 'Reservation deleted'})
+# Table turn statistics
+def fold_table_turn(samples, mean, variance, seconds):
+    """Exponentially weighted mean and variance after one more turn (a plain mean for the first few)"""
+    weight = max(TURN_TIME_EWMA_WEIGHT, 1.0 / (samples + 1))
+    delta = seconds - mean
+    return samples + 1, mean + weight * delta, (1 - weight) * (variance + weight * delta * delta)
+def queue_table_turn(capacity, seconds):
+    if capacity and TURN_TIME_MIN_SECONDS <= seconds <= TURN_TIME_MAX_SECONDS:
+        db.session.info.setdefault('table_turns', []).append((capacity, seconds))
+def record_table_turns(turns):
+    """Fold turns into the stored statistics with one atomic upsert per turn (same arithmetic as fold_table_turn)"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = TableTurnStats.__table__
+    statement = insert(table)
+    weight = db.case(
+        (table.c.samples + 1 < 1 / TURN_TIME_EWMA_WEIGHT, 1.0 / (table.c.samples + 1)),
+        else_=TURN_TIME_EWMA_WEIGHT
+    )
+    delta = statement.excluded.mean_seconds - table.c.mean_seconds
+    statement = statement.on_conflict_do_update(index_elements=['capacity'], set_={
+        'samples': table.c.samples + 1,
+        'mean_seconds': table.c.mean_seconds + weight * delta,
+        'variance_seconds': (1 - weight) * (table.c.variance_seconds + weight * delta * delta),
+        'updated_at': statement.excluded.updated_at
+    })
+    now = datetime.utcnow()
+    db.session.execute(statement, [
+        {'capacity': capacity, 'samples': 1, 'mean_seconds': seconds, 'variance_seconds': 0.0, 'updated_at': now}
+        for capacity, seconds in turns
+    ])
+@db.event.listens_for(db.session, 'before_flush')
+def _apply_table_turns(sess, flush_context, instances):
+    turns = sess.info.pop('table_turns', None)
+    if turns:
+        record_table_turns(turns)
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _discard_table_turns(sess, previous_transaction):
+    sess.info.pop('table_turns', None)
+def rebuild_table_turn_stats():
+    """Replay completed dine-in orders (opened to completed) through the rolling statistics, oldest first"""
+    TableTurnStats.query.delete()
+    stats = {}
+    rows = db.session.query(Table.capacity, Order.created_at, Order.completed_at).join(
+        Table, Table.id == Order.table_id
+    ).filter(
+        Order.order_type == 'dine-in',
+        Order.status == 'completed',
+        Order.completed_at.isnot(None)
+    ).order_by(Order.completed_at)
+    for capacity, opened_at, completed_at in rows.yield_per(5000):
+        seconds = (completed_at - opened_at).total_seconds()
+        if TURN_TIME_MIN_SECONDS <= seconds <= TURN_TIME_MAX_SECONDS:
+            stats[capacity] = fold_table_turn(*stats.get(capacity, (0, 0.0, 0.0)), seconds)
+    now = datetime.utcnow()
+    db.session.add_all(TableTurnStats(
+        capacity=capacity, samples=samples, mean_seconds=mean, variance_seconds=variance, updated_at=now
+    ) for capacity, (samples, mean, variance) in stats.items())
+    db.session.commit()
+def table_turn_seconds(stats, capacity):
+    """Turn time quoted for a table size: rolling mean plus a margin, or the default until enough turns were seen"""
+    samples, mean, variance = stats.get(capacity, (0, 0.0, 0.0))
+    if samples < WAITLIST_MIN_TURN_SAMPLES:
+        return WAITLIST_DEFAULT_TURN_MINUTES * 60
+    return mean + WAITLIST_QUOTE_STDDEVS * math.sqrt(max(variance, 0.0))
+# Waitlist
+def quote_waitlist(parties):
+    """Estimated wait in minutes for each (key, party_size), in queue order (None when no table is big enough).
+    Each table is given the time it should free up: now if available, the rest of its expected turn if occupied,
+    pushed past any reservation holding it. Parties take the earliest suitable table in turn, which then stays
+    busy for another expected turn. Reads only the live floor state and the per-size turn statistics, so a
+    quote never scans orders."""
+    utc_now, local_now = datetime.utcnow(), datetime.now()
+    stats = {row.capacity: (row.samples, row.mean_seconds, row.variance_seconds) for row in TableTurnStats.query.all()}
+    _, tables = floor_state.snapshot()
+    free_in = {}  # table id -> seconds until it is free
+    for t in tables:
+        if t['status'] == 'available':
+            free_in[t['id']] = 0.0
+        elif t['status'] == 'occupied':
+            elapsed = (utc_now - datetime.fromisoformat(t['occupied_since'])).total_seconds() if t['occupied_since'] else 0.0
+            free_in[t['id']] = max(table_turn_seconds(stats, t['capacity']) - elapsed, WAITLIST_MIN_REMAINING_MINUTES * 60)
+        elif t['status'] == 'cleaning':
+            free_in[t['id']] = WAITLIST_CLEANING_MINUTES * 60
+        # 'reserved' tables are held back from walk-ins
+    capacities = {t['id']: (t['capacity'], t['table_number']) for t in tables}
+    index = reservation_day_index(local_now.date())
+    quotes = {}
+    for key, party_size in parties:
+        best = None
+        for table_id, seconds in free_in.items():
+            capacity, table_number = capacities[table_id]
+            if capacity < party_size:
+                continue
+            turn = timedelta(seconds=table_turn_seconds(stats, capacity))
+            start = local_now + timedelta(seconds=seconds)
+            for booking_start, booking_end, _ in index.bookings(table_id):
+                if booking_start < start + turn and booking_end > start:
+                    start = booking_end
+            candidate = ((start - local_now).total_seconds(), capacity, table_number, table_id, turn)
+            if best is None or candidate[:3] < best[:3]:
+                best = candidate
+        if best is None:
+            quotes[key] = None
+            continue
+        seconds, _, _, table_id, turn = best
+        free_in[table_id] = seconds + turn.total_seconds()
+        quotes[key] = int(math.ceil(seconds / 60 / WAITLIST_QUOTE_ROUNDING_MINUTES) * WAITLIST_QUOTE_ROUNDING_MINUTES)
+    return quotes
+def active_waitlist():
+    return WaitlistEntry.query.filter(WaitlistEntry.status.in_(WAITLIST_ACTIVE_STATUSES)).order_by(
+        WaitlistEntry.created_at, WaitlistEntry.id
+    ).all()
+def serialize_waitlist_entry(entry, position=None, estimate=None):
+    return {
+        'id': entry.id,
+        'customer_id': entry.customer_id,
+        'name': entry.name,
+        'phone': entry.phone,
+        'party_size': entry.party_size,
+        'status': entry.status,
+        'position': position,
+        'quoted_minutes': entry.quoted_minutes,
+        'estimated_minutes': estimate,
+        'table_id': entry.table_id,
+        'table_number': entry.table.table_number if entry.table else None,
+        'notes': entry.notes,
+        'created_at': entry.created_at.isoformat() if entry.created_at else None,
+        'notified_at': entry.notified_at.isoformat() if entry.notified_at else None,
+        'seated_at': entry.seated_at.isoformat() if entry.seated_at else None
+    }
+@app.route('/api/waitlist', methods=['GET', 'POST'])
+def handle_waitlist():
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            party_size = int(data['party_size'])
+            if party_size < 1:
+                raise ValueError('party_size must be at least 1')
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'message': f'Invalid party size: {e}'}), 400
+        customer = db.session.get(Customer, data['customer_id']) if data.get('customer_id') else None
+        name = (data.get('name') or (f'{customer.first_name} {customer.last_name}' if customer else '')).strip()
+        if not name:
+            return jsonify({'message': 'A name is required'}), 400
+        queue = [(e.id, e.party_size) for e in active_waitlist()]
+        quote = quote_waitlist(queue + [(None, party_size)])[None]
+        entry = WaitlistEntry(
+            customer_id=customer.id if customer else None,
+            name=name[:100],
+            phone=data.get('phone') or (customer.phone if customer else None),
+            party_size=party_size,
+            quoted_minutes=quote,
+            notes=data.get('notes')
+        )
+        db.session.add(entry)
+        db.session.commit()
+        return jsonify({'message': 'Added to waitlist', 'entry': serialize_waitlist_entry(entry, len(queue) + 1, quote)}), 201
+    entries = active_waitlist()
+    estimates = quote_waitlist([(e.id, e.party_size) for e in entries])
+    return jsonify({
+        'parties': [serialize_waitlist_entry(e, position, estimates[e.id]) for position, e in enumerate(entries, start=1)],
+        'turn_times': [{
+            'capacity': row.capacity,
+            'samples': row.samples,
+            'mean_minutes': round(row.mean_seconds / 60, 1),
+            'stddev_minutes': round(math.sqrt(max(row.variance_seconds, 0.0)) / 60, 1)
+        } for row in TableTurnStats.query.order_by(TableTurnStats.capacity)]
+    })
+@app.route('/api/waitlist/quote', methods=['GET'])
+def waitlist_quote():
+    """Wait a party of ?party_size=N would be quoted if it joined now"""
+    party_size = request.args.get('party_size', type=int)
+    if not party_size or party_size < 1:
+        return jsonify({'message': 'party_size is required'}), 400
+    queue = [(e.id, e.party_size) for e in active_waitlist()]
+    return jsonify({
+        'party_size': party_size,
+        'parties_ahead': len(queue),
+        'estimated_minutes': quote_waitlist(queue + [(None, party_size)])[None]
+    })
+@app.route('/api/waitlist/<int:entry_id>', methods=['PATCH'])
+def update_waitlist_entry(entry_id):
+    """Move a party along: notified, seated (with table_id, which occupies the table), cancelled or no_show"""
+    entry = WaitlistEntry.query.get_or_404(entry_id)
+    data = request.get_json() or {}
+    status = data.get('status', entry.status)
+    if status not in WAITLIST_ACTIVE_STATUSES + ('seated', 'cancelled', 'no_show'):
+        return jsonify({'message': f'Invalid status {status}'}), 400
+    if entry.status not in WAITLIST_ACTIVE_STATUSES and status != entry.status:
+        return jsonify({'message': f'Party is already {entry.status}'}), 409
+    now = datetime.utcnow()
+    if 'party_size' in data:
+        try:
+            party_size = int(data['party_size'])
+            if party_size < 1:
+                raise ValueError('party_size must be at least 1')
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': f'Invalid party size: {e}'}), 400
+        entry.party_size = party_size
+    entry.notes = data.get('notes', entry.notes)
+    if status == 'notified' and not entry.notified_at:
+        entry.notified_at = now
+    elif status == 'seated' and entry.status != 'seated':
+        if data.get('table_id'):
+            table = db.session.get(Table, data['table_id'])
+            if not table:
+                return jsonify({'message': 'Table not found'}), 404
+            if table.status in ('occupied', 'reserved'):
+                return jsonify({'message': f'Table {table.table_number} is {table.status}'}), 409
+            if (table.capacity or 0) < entry.party_size:
+                return jsonify({'message': f'Table {table.table_number} seats {table.capacity}, party is {entry.party_size}'}), 400
+            # The party keeps the table for an expected turn; a booking inside that window would be displaced
+            stats = {row.capacity: (row.samples, row.mean_seconds, row.variance_seconds)
+                     for row in TableTurnStats.query.filter_by(capacity=table.capacity)}
+            local_now = datetime.now()
+            turn = timedelta(seconds=table_turn_seconds(stats, table.capacity))
+            conflicts = reservation_conflicts(table.id, local_now, local_now + turn)
+            if conflicts:
+                return jsonify({
+                    'message': f'Table {table.table_number} is booked within the expected turn',
+                    'conflicts': [{
+                        'id': r.id,
+                        'reservation_time': r.reservation_time.isoformat(),
+                        'end_time': r.end_time.isoformat()
+                    } for r in conflicts]
+                }), 409
+            table.status = 'occupied'
+            table.party_size = entry.party_size
+            entry.table_id = table.id
+        entry.seated_at = now
+        queue_latency_sample('waitlist_wait', (now - entry.created_at).total_seconds(), {'party_size': entry.party_size})
+    elif status in ('cancelled', 'no_show') and entry.status != status:
+        entry.removed_at = now
+    entry.status = status
+    db.session.commit()
+    return jsonify({'message': 'Waitlist updated', 'entry': serialize_waitlist_entry(entry)})
+# Loyalty ledger
+def post_loyalty_entry(customer_id, points, entry_type, order_id=None, description=None, created_by=None):
+    """Append a ledger entry and apply it to the customer's balance and tier in one atomic UPDATE.
+    Returns False, writing nothing, for a second accrual on the same order or a debit larger than the balance."""
+    points = int(points)
+    entry = {
+        'customer_id': customer_id,
+        'order_id': order_id,
+        'entry_type': entry_type,
+        'points': points,
+        'description': description,
+        'created_by': created_by,
+        'created_at': datetime.utcnow()
+    }
+    if entry_type == 'accrual':
+        # Claim the order's accrual first; the partial unique index makes a repeat a no-op
+        if db.engine.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        claimed = db.session.execute(insert(LoyaltyLedger.__table__).values(**entry).on_conflict_do_nothing(
+            index_elements=['order_id'], index_where=LoyaltyLedger.entry_type == 'accrual'
+        )).rowcount
+        if not claimed:
+            return False
+    balance = db.func.coalesce(Customer.loyalty_points, 0)
+    statement = Customer.__table__.update().where(Customer.id == customer_id)
+    if points < 0:
+        statement = statement.where(balance >= -points)
+    updated = db.session.execute(statement.values(
+        loyalty_points=balance + points,
+        loyalty_tier=loyalty_tier_case(balance + points)
+    )).rowcount
+    if not updated:
+        return False
+    if entry_type != 'accrual':
+        db.session.execute(LoyaltyLedger.__table__.insert().values(**entry))
+    return True
+def accrue_order_loyalty(order):
+    """Credit an order's points, with the customer's tier bonus, exactly once per order"""
+    if not order.customer_id or (order.final_amount or 0) <= 0 or order.status in VOID_ORDER_STATUSES:
+        return False
+    tier = db.session.query(Customer.loyalty_tier).filter_by(id=order.customer_id).scalar()
+    if tier is None:
+        return False
+    base_points = int(round((order.final_amount or 0) * LOYALTY_POINTS_PER_CURRENCY))
+    earned = int(round(base_points * LOYALTY_TIER_BONUSES.get(tier, 1.0)))
+    if earned <= 0:
+        return False
+    return post_loyalty_entry(order.customer_id, earned, 'accrual', order_id=order.id)
+def reverse_order_loyalty(order, sign):
+    """Take back (sign=-1) or restore (sign=1) the points an order accrued, as an 'accrual_reversal' entry.
+    A take-back is capped at the balance, since points may have been redeemed since; restoring gives back
+    exactly what was taken, so the order's entries always net to what it currently contributes."""
+    if not order.customer_id:
+        return False
+    accrued, net = db.session.query(
+        db.func.coalesce(db.func.sum(db.case((LoyaltyLedger.entry_type == 'accrual', LoyaltyLedger.points), else_=0)), 0),
+        db.func.coalesce(db.func.sum(LoyaltyLedger.points), 0)
+    ).filter(
+        LoyaltyLedger.order_id == order.id,
+        LoyaltyLedger.entry_type.in_(('accrual', 'accrual_reversal'))
+    ).one()
+    if sign < 0:
+        balance = db.session.query(db.func.coalesce(Customer.loyalty_points, 0)).filter_by(id=order.customer_id).scalar() or 0
+        points = -min(net, max(balance, 0))
+    else:
+        points = accrued - net
+    if not points:
+        return False
+    description = f'Order #{order.id} {order.status}' if sign < 0 else f'Order #{order.id} reinstated'
+    return post_loyalty_entry(order.customer_id, points, 'accrual_reversal', order_id=order.id, description=description)
+def recompute_loyalty_tiers(batch_size=5000):
+    """Reassign every customer's stored tier from their balance, e.g. after LOYALTY_TIER_THRESHOLDS change.
+    Tiers are computed for all customers at once with NumPy; only changed rows are written."""
+    rows = db.session.query(Customer.id, Customer.loyalty_points, Customer.loyalty_tier).all()
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    points = np.fromiter((r[1] or 0 for r in rows), dtype=np.int64, count=len(rows))
+    current = np.array([r[2] or '' for r in rows], dtype=object)
+    ordered = sorted(LOYALTY_TIER_THRESHOLDS.items(), key=lambda item: item[1])
+    names = np.array([name for name, _ in ordered], dtype=object)
+    thresholds = np.array([threshold for _, threshold in ordered], dtype=np.int64)
+    # Highest threshold at or below the balance; balances below the lowest threshold get the first tier
+    tiers = names[np.maximum(np.searchsorted(thresholds, points, side='right') - 1, 0)]
+    changed = np.flatnonzero(tiers != current)
+    statement = Customer.__table__.update().where(Customer.id == db.bindparam('customer_id')).values(
+        loyalty_tier=db.bindparam('tier')
+    )
+    for start in range(0, len(changed), batch_size):
+        chunk = changed[start:start + batch_size]
+        db.session.execute(statement, [{'customer_id': int(ids[i]), 'tier': tiers[i]} for i in chunk])
+    _set_loyalty_tier_fingerprint()
+    db.session.commit()
+    return len(changed)
+def _loyalty_tier_fingerprint():
+    return json.dumps(LOYALTY_TIER_THRESHOLDS, sort_keys=True)
+def _set_loyalty_tier_fingerprint():
+    setting = Settings.query.filter_by(key='loyalty_tier_thresholds').first()
+    if setting:
+        setting.value = _loyalty_tier_fingerprint()
+    else:
+        db.session.add(Settings(key='loyalty_tier_thresholds', value=_loyalty_tier_fingerprint()))
+def loyalty_tiers_stale():
+    """True when the stored tiers were assigned under different LOYALTY_TIER_THRESHOLDS"""
+    setting = Settings.query.filter_by(key='loyalty_tier_thresholds').first()
+    return setting is None or setting.value != _loyalty_tier_fingerprint()
+def backfill_loyalty_ledger():
+    """Give customers whose points predate the ledger an opening balance entry"""
+    inserted = db.session.execute(LoyaltyLedger.__table__.insert().from_select(
+        ['customer_id', 'entry_type', 'points', 'description', 'created_at'],
+        db.select(
+            Customer.id, db.literal('opening'), Customer.loyalty_points,
+            db.literal('Balance before the loyalty ledger'), db.literal(datetime.utcnow())
+        ).where(Customer.loyalty_points != 0, ~db.exists().where(LoyaltyLedger.customer_id == Customer.id))
+    )).rowcount
+    db.session.commit()
+    return inserted
+@app.route('/api/loyalty/recompute-tiers', methods=['POST'])
+def recompute_loyalty_tiers_endpoint():
+    if not session.get('user_id'):
+        return jsonify({'message': 'Authentication required'}), 401
+    return jsonify({'message': 'Loyalty tiers recomputed', 'updated': recompute_loyalty_tiers()})
+# Customer lookup
+CUSTOMER_LOOKUP_LIMIT = 10
+CUSTOMER_LOOKUP_MAX_LIMIT = 50
+CUSTOMER_LIST_MAX_PER_PAGE = 200
+def normalize_phone(phone):
+    """Digits only, so '+90 (555) 123-45' and '90555 12345' match the same prefix"""
+    digits = ''.join(ch for ch in (phone or '') if ch.isdigit())
+    return digits or None
+def normalize_email(email):
+    email = (email or '').strip().lower()
+    return email or None
+def normalize_customer_name(first_name, last_name):
+    # '' rather than NULL for nameless customers, so the startup backfill can tell them apart from unfilled rows
+    return ' '.join(f"{first_name or ''} {last_name or ''}".lower().split())
+def prefix_filter(column, prefix):
+    """column LIKE 'prefix%' written as a range, so SQLite can always seek the column's index"""
+    return db.and_(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+@db.event.listens_for(db.session, 'before_flush')
+def _normalize_customer_lookup_keys(sess, flush_context, instances):
+    """Keep the normalized lookup keys of new and edited customers in step with their contact fields"""
+    for customer in list(sess.new) + list(sess.dirty):
+        if isinstance(customer, Customer):
+            customer.phone_normalized = normalize_phone(customer.phone)
+            customer.email_normalized = normalize_email(customer.email)
+            customer.name_normalized = normalize_customer_name(customer.first_name, customer.last_name)
+            customer.reversed_name_normalized = normalize_customer_name(customer.last_name, customer.first_name)
+def missing_customer_lookup_keys():
+    return db.or_(Customer.name_normalized.is_(None), Customer.reversed_name_normalized.is_(None))
+def backfill_customer_lookup_keys(batch_size=5000):
+    """Fill the normalized lookup keys of customers written before they existed"""
+    key_columns = ('phone_normalized', 'email_normalized', 'name_normalized', 'reversed_name_normalized')
+    statement = Customer.__table__.update().where(Customer.id == db.bindparam('customer_id')).values(
+        {name: db.bindparam(name) for name in key_columns}
+    )
+    updated = 0
+    last_id = 0
+    while True:
+        # Walk the primary key so each batch starts where the previous one stopped
+        rows = db.session.query(
+            Customer.id, Customer.first_name, Customer.last_name, Customer.phone, Customer.email
+        ).filter(Customer.id > last_id, missing_customer_lookup_keys()).order_by(Customer.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        db.session.execute(statement, [{
+            'customer_id': row.id,
+            'phone_normalized': normalize_phone(row.phone),
+            'email_normalized': normalize_email(row.email),
+            'name_normalized': normalize_customer_name(row.first_name, row.last_name),
+            'reversed_name_normalized': normalize_customer_name(row.last_name, row.first_name)
+        } for row in rows])
+        db.session.commit()
+        updated += len(rows)
+    return updated
+def serialize_customer_option(c):
+    """Just the fields a customer picker needs"""
+    return {
+        'id': c.id,
+        'first_name': c.first_name,
+        'last_name': c.last_name,
+        'phone': c.phone,
+        'email': c.email,
+        'loyalty_points': c.loyalty_points or 0
+    }
+@app.route('/api/customers/lookup', methods=['GET'])
+def lookup_customers():
+    """Type-ahead customer search by phone, email or name prefix ('first last' or 'last first')"""
+    query = (request.args.get('q') or '').strip()
+    limit = max(1, min(request.args.get('limit', CUSTOMER_LOOKUP_LIMIT, type=int), CUSTOMER_LOOKUP_MAX_LIMIT))
+    if not query:
+        return jsonify([])
+    option_columns = (Customer.id, Customer.first_name, Customer.last_name, Customer.phone, Customer.email, Customer.loyalty_points)
+    # Each candidate key is its own index range scan, already in key order, so LIMIT stops it early
+    searches = []
+    if '@' in query:
+        searches.append((Customer.email_normalized, normalize_email(query)))
+    elif not any(ch.isalpha() for ch in query):
+        if normalize_phone(query):
+            searches.append((Customer.phone_normalized, normalize_phone(query)))
+    else:
+        searches.append((Customer.name_normalized, normalize_customer_name(query, '')))
+        searches.append((Customer.reversed_name_normalized, normalize_customer_name(query, '')))
+        searches.append((Customer.email_normalized, normalize_email(query)))
+    results = {}
+    for column, prefix in searches:
+        if not prefix:
+            continue
+        for c in db.session.query(*option_columns).filter(prefix_filter(column, prefix)).order_by(column, Customer.id).limit(limit):
+            results.setdefault(c.id, c)
+        if len(results) >= limit:
+            break
+    return jsonify([serialize_customer_option(c) for c in list(results.values())[:limit]])
+@app.route('/api/customers/import', methods=['POST'])
+def import_customers_upload():
+    """Bulk import customers from an uploaded CSV or JSONL file (multipart field 'file'), merging duplicates"""
+    if not session.get('user_id'):
+        return jsonify({'message': 'Authentication required'}), 401
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'message': 'No file uploaded'}), 400
+    from customer_import import import_customers, detect_format, find_invalid_utf8
+    fmt = request.form.get('format') or detect_format(upload.filename)
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'message': 'format must be csv or jsonl'}), 400
+    # Checked up front: batches are committed as they go, so a decode error part-way would leave a partial import
+    bad_line = find_invalid_utf8(upload.stream)
+    if bad_line:
+        return jsonify({'message': f'File must be UTF-8 encoded (invalid bytes on line {bad_line}); nothing was imported'}), 400
+    report = import_customers(upload.stream, fmt, created_by=session.get('user_id'))
+    return jsonify({'message': 'Customers imported', **report})
+@app.route('/api/customers/<int:customer_id>', methods=['GET'])
+def get_customer(customer_id):
+    customer = Customer.query.get_or_404(customer_id)
+    return jsonify(serialize_customer_option(customer))
 @app.route('/api/customers', methods=['GET', 'POST'])
 def get_or_create_customers():
     if request.method == 'POST':
@@ -1354,35 +3736,73 @@ def get_or_create_customers():
             email=data.get('email'),
             phone=data.get('phone'),
         )
-        # Optional initial loyalty
-        if 'loyalty_points' in data and isinstance(data['loyalty_points'], (int, float)):
-            customer.loyalty_points = int(data['loyalty_points'])
         db.session.add(customer)
+        db.session.flush()
+        # Optional initial loyalty
+        if 'loyalty_points' in data and isinstance(data['loyalty_points'], (int, float)) and int(data['loyalty_points']) > 0:
+            post_loyalty_entry(customer.id, int(data['loyalty_points']), 'opening', created_by=session.get('user_id'))
         db.session.commit()
         return jsonify({'message': 'Customer created', 'id': customer.id}), 201
-    customers = Customer.query.order_by(Customer.created_at.desc()).all()
-    return jsonify([{
+    query = Customer.query.order_by(Customer.created_at.desc(), Customer.id.desc())
+    # Paginated when page or per_page is given; the total is returned in X-Total-Count
+    paginated = 'page' in request.args or 'per_page' in request.args
+    if paginated:
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = max(1, min(request.args.get('per_page', 50, type=int), CUSTOMER_LIST_MAX_PER_PAGE))
+        total = Customer.query.count()
+        query = query.offset((page - 1) * per_page).limit(per_page)
+    response = jsonify([{
         'id': c.id,
         'first_name': c.first_name,
         'last_name': c.last_name,
         'email': c.email,
         'phone': c.phone,
         'loyalty_points': c.loyalty_points,
-        'loyalty_tier': get_customer_loyalty_tier(c.loyalty_points),
+        'loyalty_tier': c.loyalty_tier,
         'next_tier_points': get_next_tier_threshold(c.loyalty_points),
         'points_to_next_tier': get_points_to_next_tier(c.loyalty_points)
-    } for c in customers])
-@app.route('/api/customers/<int:customer_id>/loyalty', methods=['POST'])
+    } for c in query])
+    if paginated:
+        response.headers['X-Total-Count'] = str(total)
+        links = []
+        if page * per_page < total:
+            links.append(f'<{url_for(request.endpoint, page=page + 1, per_page=per_page)}>; rel="next"')
+        if page > 1:
+            links.append(f'<{url_for(request.endpoint, page=page - 1, per_page=per_page)}>; rel="prev"')
+        if links:
+            response.headers['Link'] = ', '.join(links)
+    return response
+@app.route('/api/customers/<int:customer_id>/loyalty', methods=['GET', 'POST'])
 def adjust_loyalty(customer_id):
-    data = request.get_json()
     customer = Customer.query.get_or_404(customer_id)
+    if request.method == 'GET':
+        # Ledger history, newest first
+        limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+        entries = LoyaltyLedger.query.filter_by(customer_id=customer.id).order_by(
+            LoyaltyLedger.created_at.desc(), LoyaltyLedger.id.desc()
+        ).limit(limit).all()
+        return jsonify({
+            'loyalty_points': customer.loyalty_points or 0,
+            'loyalty_tier': customer.loyalty_tier,
+            'entries': [{
+                'id': e.id,
+                'order_id': e.order_id,
+                'entry_type': e.entry_type,
+                'points': e.points,
+                'description': e.description,
+                'created_at': e.created_at.isoformat()
+            } for e in entries]
+        })
+    data = request.get_json()
     delta = int(data.get('points', 0))
     action = data.get('action', 'accrue')
-    if action == 'redeem' and customer.loyalty_points < abs(delta):
+    points = delta if action == 'accrue' else -abs(delta)
+    if not post_loyalty_entry(customer.id, points, 'adjustment' if action == 'accrue' else 'redemption',
+                              description=data.get('description'), created_by=session.get('user_id')):
+        db.session.rollback()
         return jsonify({'message': 'Insufficient points'}), 400
-    customer.loyalty_points = (customer.loyalty_points or 0) + (delta if action == 'accrue' else -abs(delta))
     db.session.commit()
-    return jsonify({'message': 'Loyalty updated', 'loyalty_points': customer.loyalty_points})
+    return jsonify({'message': 'Loyalty updated', 'loyalty_points': customer.loyalty_points, 'loyalty_tier': customer.loyalty_tier})
 @app.route('/api/customers/<int:customer_id>/crm-notes', methods=['GET', 'POST'])
 def crm_notes(customer_id):
     if request.method == 'POST':
@@ -1583,13 +4003,17 @@ def get_kitchen_orders():
 def update_order_item_status(item_id):
     item = OrderItem.query.get_or_404(item_id)
     data = request.get_json()
+    old_status = item.status
     item.status = data.get('status', item.status)
+    track_item_status_change(item, old_status)
     db.session.commit()
     _push_kds_change('item_status', {'item_id': item.id, 'order_id': item.order_id, 'status': item.status})
     # Check if all items in the order are served/completed
     order = Order.query.get(item.order_id)
-    if order and all(item.status in ['served', 'completed'] for item in order.items):
+    if order and order.status != 'completed' and all(item.status in ['served', 'completed'] for item in order.items):
+        old_status = order.status
         order.status = 'completed'
+        track_order_status_change(order, old_status)
         db.session.commit()
     return jsonify({
         'message': 'Order item status updated',
@@ -1604,19 +4028,16 @@ def update_order_status(order_id):
     data = request.get_json()
     old_status = order.status
     order.status = data.get('status', order.status)
+    track_order_status_change(order, old_status)
     # Update table status if order is completed or cancelled
     if order.status in ['completed', 'cancelled'] and order.table_id:
         table = Table.query.get(order.table_id)
         if table and table.status == 'occupied':
             table.status = 'available'
+    # Accrue loyalty when explicitly marked completed (a no-op if the payment already accrued it)
+    if order.status == 'completed':
+        accrue_order_loyalty(order)
     db.session.commit()
-    # Accrue loyalty when explicitly marked completed
-    if order.status == 'completed' and order.customer_id and (order.final_amount or 0) > 0:
-        customer = Customer.query.get(order.customer_id)
-        if customer:
-            earned = int(round((order.final_amount or 0) * LOYALTY_POINTS_PER_CURRENCY))
-            customer.loyalty_points = (customer.loyalty_points or 0) + earned
-            db.session.commit()
     _push_kds_change('order_status', {'order_id': order.id, 'status': order.status})
     return jsonify({
         'message': 'Order status updated',
@@ -1691,29 +4112,402 @@ def delete_schedule(schedule_id):
     db.session.delete(schedule)
     db.session.commit()
     return jsonify({'message': 'Schedule deleted'})
+# Reporting rollups
+def upsert_increments(model, key_columns, rows):
+    """Add the non-key values of each row onto the existing rollup row, inserting it if missing.
+    Rows are pre-aggregated per key and written with a single executemany upsert."""
+    if not rows:
+        return
+    merged = {}
+    for row in rows:
+        key = tuple(row[k] for k in key_columns)
+        if key in merged:
+            for column, value in row.items():
+                if column not in key_columns:
+                    merged[key][column] += value
+        else:
+            merged[key] = dict(row)
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = model.__table__
+    statement = insert(table)
+    value_columns = [c for c in rows[0] if c not in key_columns]
+    statement = statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={c: table.c[c] + statement.excluded[c] for c in value_columns}
+    )
+    db.session.execute(statement, list(merged.values()))
+def apply_order_rollups(order, sign=1):
+    """Add (sign=1) or remove (sign=-1) a completed order from the sales rollups"""
+    created = order.created_at or datetime.utcnow()
+    day = created.date()
+    items = [(item.menu_item_id, item.quantity or 0, (item.quantity or 0) * (item.price or 0)) for item in order.items]
+    items_sold = sum(quantity for _, quantity, _ in items)
+    revenue = order.final_amount or 0
+    upsert_increments(DailySales, ['day'], [{
+        'day': day,
+        'orders': sign,
+        'revenue': sign * revenue,
+        'discounts': sign * (order.discount_amount or 0),
+        'items_sold': sign * items_sold,
+        'payments_total': 0.0,
+        'payments_count': 0
+    }])
+    upsert_increments(HourlySales, ['day', 'hour'], [{
+        'day': day,
+        'hour': created.hour,
+        'orders': sign,
+        'revenue': sign * revenue,
+        'items_sold': sign * items_sold
+    }])
+    upsert_increments(DailyItemSales, ['day', 'menu_item_id'], [{
+        'day': day,
+        'menu_item_id': menu_item_id,
+        'quantity': sign * quantity,
+        'revenue': sign * item_revenue
+    } for menu_item_id, quantity, item_revenue in items])
+def track_order_status_change(order, old_status):
+    """Keep completion timestamps, sales rollups, customer totals and accrued loyalty points in step with order status changes"""
+    if order.status == old_status:
+        return
+    now = datetime.utcnow()
+    if order.status == 'confirmed' and not order.confirmed_at:
+        order.confirmed_at = now
+    if order.status == 'completed':
+        order.completed_at = now
+        apply_order_rollups(order, 1)
+        queue_latency_sample('ticket_time', (now - (order.confirmed_at or order.created_at or now)).total_seconds(), {
+            'order_type': order.order_type,
+            'hour': str((order.created_at or now).hour)
+        })
+    elif old_status == 'completed':
+        # Completed order refunded or cancelled afterwards
+        apply_order_rollups(order, -1)
+    if (old_status in VOID_ORDER_STATUSES) != (order.status in VOID_ORDER_STATUSES):
+        sign = -1 if order.status in VOID_ORDER_STATUSES else 1
+        apply_customer_order_totals(order, sign)
+        reverse_order_loyalty(order, sign)
+def apply_payment_rollups(payment):
+    if payment.payment_status != 'completed':
+        return
+    upsert_increments(DailySales, ['day'], [{
+        'day': (payment.payment_date or datetime.utcnow()).date(),
+        'orders': 0,
+        'revenue': 0.0,
+        'discounts': 0.0,
+        'items_sold': 0,
+        'payments_total': payment.amount or 0,
+        'payments_count': 1
+    }])
+    record_payment_activity(payment)
+    apply_customer_payment_totals(payment)
+# Customer.total_orders / total_spent: paid orders and completed payments, excluding voided orders
+VOID_ORDER_STATUSES = ('cancelled', 'refunded')
+def increment_customer_totals(customer_id, orders, spent):
+    """Atomic UPDATE customers SET total_orders = total_orders + ?, total_spent = total_spent + ?"""
+    db.session.execute(Customer.__table__.update().where(Customer.id == customer_id).values(
+        total_orders=db.func.coalesce(Customer.total_orders, 0) + orders,
+        total_spent=db.func.coalesce(Customer.total_spent, 0) + spent
+    ))
+def apply_customer_payment_totals(payment):
+    """A completed payment adds its amount; the order's first one also counts the order"""
+    order = payment.order or db.session.get(Order, payment.order_id)
+    if not order or not order.customer_id or order.status in VOID_ORDER_STATUSES:
+        return
+    completed_payments = db.session.query(db.func.count(Payment.id)).filter(
+        Payment.order_id == order.id, Payment.payment_status == 'completed'
+    ).scalar()
+    increment_customer_totals(order.customer_id, 1 if completed_payments == 1 else 0, payment.amount or 0)
+def apply_customer_order_totals(order, sign):
+    """Remove (sign=-1) or restore (sign=1) everything an order's completed payments contributed"""
+    if not order.customer_id:
+        return
+    payments, paid = db.session.query(
+        db.func.count(Payment.id), db.func.coalesce(db.func.sum(Payment.amount), 0)
+    ).filter(Payment.order_id == order.id, Payment.payment_status == 'completed').one()
+    if payments:
+        increment_customer_totals(order.customer_id, sign, sign * paid)
+def rebuild_customer_totals():
+    """Recompute total_orders and total_spent for every customer with one aggregate UPDATE ... FROM"""
+    per_order = db.session.query(
+        Order.customer_id.label('customer_id'), db.func.sum(Payment.amount).label('paid')
+    ).join(Payment, Payment.order_id == Order.id).filter(
+        Payment.payment_status == 'completed',
+        Order.customer_id.isnot(None),
+        Order.status.notin_(VOID_ORDER_STATUSES)
+    ).group_by(Order.id).subquery()
+    totals = db.select(
+        per_order.c.customer_id, db.func.count().label('orders'), db.func.sum(per_order.c.paid).label('spent')
+    ).group_by(per_order.c.customer_id).subquery()
+    db.session.execute(Customer.__table__.update().values(total_orders=0, total_spent=0))
+    updated = db.session.execute(Customer.__table__.update().where(Customer.id == totals.c.customer_id).values(
+        total_orders=totals.c.orders, total_spent=totals.c.spent
+    )).rowcount
+    db.session.commit()
+    return updated
+REPEAT_INTERVAL_BUCKETS = (0, 7, 14, 30, 60, 90, 180, 365)  # days since the previous order
+def repeat_interval_bucket(days):
+    return REPEAT_INTERVAL_BUCKETS[int(np.searchsorted(REPEAT_INTERVAL_BUCKETS, days, side='right')) - 1]
+def record_customer_order(activity, customer_id, paid_at, revenue):
+    """Fold one paid order into a customer's activity row (None for a first order).
+    Returns the activity row and the cohort rollup increments; orders must arrive in payment order."""
+    month = paid_at.date().replace(day=1)
+    if activity is None:
+        activity = CustomerActivity(
+            customer_id=customer_id, cohort_month=month, first_order_at=paid_at,
+            last_order_at=paid_at, last_active_month=month, orders=0, revenue=0
+        )
+        first_order, new_month, gap_days = True, True, None
+    else:
+        first_order = False
+        new_month = activity.last_active_month != month
+        gap_days = max(0.0, (paid_at - activity.last_order_at).total_seconds() / 86400)
+        activity.last_order_at = paid_at
+        activity.last_active_month = month
+    activity.orders += 1
+    activity.revenue += revenue
+    cohort_row = {
+        'cohort_month': activity.cohort_month,
+        'activity_month': month,
+        'new_customers': 1 if first_order else 0,
+        'active_customers': 1 if new_month else 0,
+        'orders': 1,
+        'revenue': revenue,
+        'repeat_orders': 0 if gap_days is None else 1,
+        'repeat_interval_days': gap_days or 0.0
+    }
+    interval_row = None if gap_days is None else {
+        'cohort_month': activity.cohort_month,
+        'bucket_days': repeat_interval_bucket(gap_days),
+        'orders': 1
+    }
+    return activity, cohort_row, interval_row
+def record_payment_activity(payment):
+    """An order counts as customer activity when its first completed payment is recorded"""
+    order = payment.order or db.session.get(Order, payment.order_id)
+    if not order or not order.customer_id:
+        return
+    completed_payments = db.session.query(db.func.count(Payment.id)).filter(
+        Payment.order_id == order.id, Payment.payment_status == 'completed'
+    ).scalar()
+    if completed_payments > 1:
+        return
+    existing = db.session.get(CustomerActivity, order.customer_id)
+    activity, cohort_row, interval_row = record_customer_order(
+        existing, order.customer_id, payment.payment_date or datetime.utcnow(), order.final_amount or 0
+    )
+    if existing is None:
+        db.session.add(activity)
+    upsert_increments(CohortActivity, ['cohort_month', 'activity_month'], [cohort_row])
+    if interval_row:
+        upsert_increments(CohortRepeatInterval, ['cohort_month', 'bucket_days'], [interval_row])
+def rebuild_customer_activity():
+    """Recompute customer and cohort activity from payments, replaying each order's first completed payment in order"""
+    for model in (CustomerActivity, CohortActivity, CohortRepeatInterval):
+        model.query.delete()
+    paid_at = db.func.min(Payment.payment_date)
+    rows = db.session.query(Order.customer_id, Order.final_amount, paid_at).join(
+        Payment, Payment.order_id == Order.id
+    ).filter(
+        Payment.payment_status == 'completed', Order.customer_id.isnot(None)
+    ).group_by(Order.id).order_by(paid_at, Order.id)
+    activities = {}
+    cohort_rows = []
+    interval_rows = []
+    for customer_id, final_amount, first_paid in rows.yield_per(10000):
+        if isinstance(first_paid, str):
+            first_paid = datetime.fromisoformat(first_paid)
+        activity, cohort_row, interval_row = record_customer_order(
+            activities.get(customer_id), customer_id, first_paid, final_amount or 0
+        )
+        activities[customer_id] = activity
+        cohort_rows.append(cohort_row)
+        if interval_row:
+            interval_rows.append(interval_row)
+    if activities:
+        db.session.execute(CustomerActivity.__table__.insert(), [{
+            'customer_id': a.customer_id, 'cohort_month': a.cohort_month,
+            'first_order_at': a.first_order_at, 'last_order_at': a.last_order_at,
+            'last_active_month': a.last_active_month, 'orders': a.orders, 'revenue': a.revenue
+        } for a in activities.values()])
+    upsert_increments(CohortActivity, ['cohort_month', 'activity_month'], cohort_rows)
+    upsert_increments(CohortRepeatInterval, ['cohort_month', 'bucket_days'], interval_rows)
+    db.session.commit()
+    return len(activities)
+def apply_inventory_rollups(transactions):
+    """Roll inventory transactions (dicts or InventoryTransaction objects) into daily_ingredient_usage"""
+    rows = []
+    for t in transactions:
+        get = t.get if isinstance(t, dict) else lambda k, obj=t: getattr(obj, k)
+        rows.append({
+            'day': (get('transaction_date') or datetime.utcnow()).date(),
+            'ingredient_id': get('ingredient_id'),
+            'transaction_type': get('transaction_type'),
+            'quantity': get('quantity') or 0,
+            'transaction_count': 1
+        })
+    upsert_increments(DailyIngredientUsage, ['day', 'ingredient_id', 'transaction_type'], rows)
+def stamp_transaction_costs(transactions):
+    """Snapshot unit and total cost on transactions that don't carry one yet.
+    Lot-tracked transactions use the lot's cost, everything else the ingredient's current cost."""
+    pending = [t for t in transactions if t.unit_cost is None]
+    if not pending:
+        return
+    lot_ids = {t.lot_id for t in pending if t.lot_id}
+    ingredient_ids = {t.ingredient_id for t in pending}
+    lot_costs = dict(db.session.query(IngredientLot.id, IngredientLot.cost_per_unit).filter(
+        IngredientLot.id.in_(lot_ids)
+    ).all()) if lot_ids else {}
+    ingredient_costs = dict(db.session.query(Ingredient.id, Ingredient.cost_per_unit).filter(
+        Ingredient.id.in_(ingredient_ids)
+    ).all())
+    for t in pending:
+        unit_cost = lot_costs.get(t.lot_id)
+        if unit_cost is None:
+            unit_cost = ingredient_costs.get(t.ingredient_id)
+        t.unit_cost = unit_cost or 0.0
+        t.total_cost = t.unit_cost * (t.quantity or 0)
+@db.event.listens_for(db.session, 'before_flush')
+def _stamp_new_inventory_transactions(sess, flush_context, instances):
+    """Every InventoryTransaction added through the ORM gets its cost snapshot and is rolled up in the same flush"""
+    new_transactions = [obj for obj in sess.new if isinstance(obj, InventoryTransaction)]
+    if not new_transactions:
+        return
+    for t in new_transactions:
+        if t.transaction_date is None:
+            t.transaction_date = datetime.utcnow()
+    stamp_transaction_costs(new_transactions)
+    apply_inventory_rollups(new_transactions)
+def rebuild_rollups():
+    """Recompute every rollup table from raw orders, payments and inventory transactions"""
+    for model in (DailySales, HourlySales, DailyItemSales, DailyIngredientUsage):
+        model.query.delete()
+    completed = Order.status == 'completed'
+    day = db.func.date(Order.created_at)
+    hour = db.cast(db.func.strftime('%H', Order.created_at), db.Integer)
+    items_per_order = db.session.query(
+        OrderItem.order_id.label('order_id'),
+        db.func.sum(OrderItem.quantity).label('items_sold')
+    ).group_by(OrderItem.order_id).subquery()
+    items_sold = db.func.coalesce(db.func.sum(items_per_order.c.items_sold), 0)
+    db.session.execute(DailySales.__table__.insert().from_select(
+        ['day', 'orders', 'revenue', 'discounts', 'items_sold', 'payments_total', 'payments_count'],
+        db.select(
+            day, db.func.count(Order.id), db.func.coalesce(db.func.sum(Order.final_amount), 0),
+            db.func.coalesce(db.func.sum(Order.discount_amount), 0), items_sold, db.literal(0.0), db.literal(0)
+        ).select_from(Order).outerjoin(items_per_order, items_per_order.c.order_id == Order.id).where(completed).group_by(day)
+    ))
+    db.session.execute(HourlySales.__table__.insert().from_select(
+        ['day', 'hour', 'orders', 'revenue', 'items_sold'],
+        db.select(
+            day, hour, db.func.count(Order.id), db.func.coalesce(db.func.sum(Order.final_amount), 0), items_sold
+        ).select_from(Order).outerjoin(items_per_order, items_per_order.c.order_id == Order.id).where(completed).group_by(day, hour)
+    ))
+    db.session.execute(DailyItemSales.__table__.insert().from_select(
+        ['day', 'menu_item_id', 'quantity', 'revenue'],
+        db.select(
+            day, OrderItem.menu_item_id, db.func.sum(OrderItem.quantity), db.func.sum(OrderItem.quantity * OrderItem.price)
+        ).select_from(OrderItem).join(Order, Order.id == OrderItem.order_id).where(completed).group_by(day, OrderItem.menu_item_id)
+    ))
+    payment_day = db.func.date(Payment.payment_date)
+    payment_rows = [{
+        'day': datetime.fromisoformat(str(row[0])).date(),
+        'orders': 0, 'revenue': 0.0, 'discounts': 0.0, 'items_sold': 0,
+        'payments_total': float(row[1] or 0), 'payments_count': int(row[2])
+    } for row in db.session.query(payment_day, db.func.sum(Payment.amount), db.func.count(Payment.id)).filter(
+        Payment.payment_status == 'completed'
+    ).group_by(payment_day).all()]
+    upsert_increments(DailySales, ['day'], payment_rows)
+    usage_day = db.func.date(InventoryTransaction.transaction_date)
+    db.session.execute(DailyIngredientUsage.__table__.insert().from_select(
+        ['day', 'ingredient_id', 'transaction_type', 'quantity', 'transaction_count'],
+        db.select(
+            usage_day, InventoryTransaction.ingredient_id, InventoryTransaction.transaction_type,
+            db.func.sum(InventoryTransaction.quantity), db.func.count(InventoryTransaction.id)
+        ).group_by(usage_day, InventoryTransaction.ingredient_id, InventoryTransaction.transaction_type)
+    ))
+    db.session.commit()
+    rebuild_customer_activity()
+def use_rollups():
+    """Reports read the rollup tables unless ?source=raw is passed (useful for verifying them)"""
+    return request.args.get('source', 'rollup') != 'raw'
 # Reporting
+REPORT_BUCKETS = ('day', 'week', 'month')
+def date_bucket(column, bucket='day'):
+    """SQL expression truncating a datetime column to the start of its day, ISO week or month ('YYYY-MM-DD')"""
+    if bucket == 'week':
+        # SQLite: move forward to Sunday, then back six days to the Monday starting the week
+        return db.func.date(column, 'weekday 0', '-6 days')
+    if bucket == 'month':
+        return db.func.strftime('%Y-%m-01', column)
+    return db.func.date(column)
+def bucket_starts(start, end, bucket='day'):
+    """Every bucket start between two dates, used to fill gaps in aggregated results"""
+    current = start
+    if bucket == 'week':
+        current = start - timedelta(days=start.weekday())
+    elif bucket == 'month':
+        current = start.replace(day=1)
+    while current <= end:
+        yield current.isoformat()
+        if bucket == 'week':
+            current += timedelta(days=7)
+        elif bucket == 'month':
+            current = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            current += timedelta(days=1)
+def completed_sales_by_bucket(start_date=None, end_date=None, bucket='day', rollups=True):
+    """Revenue and order count per bucket for completed orders, aggregated in SQL.
+    With rollups the range is applied at day granularity on daily_sales."""
+    if rollups:
+        bucket_expr = date_bucket(DailySales.day, bucket)
+        query = db.session.query(
+            bucket_expr.label('bucket'),
+            db.func.coalesce(db.func.sum(DailySales.revenue), 0).label('revenue'),
+            db.func.coalesce(db.func.sum(DailySales.orders), 0).label('orders')
+        ).filter(DailySales.orders != 0)
+        if start_date:
+            query = query.filter(DailySales.day >= start_date.date())
+        if end_date:
+            query = query.filter(DailySales.day <= end_date.date())
+        return query.group_by(bucket_expr).all()
+    bucket_expr = date_bucket(Order.created_at, bucket)
+    query = db.session.query(
+        bucket_expr.label('bucket'),
+        db.func.coalesce(db.func.sum(Order.final_amount), 0).label('revenue'),
+        db.func.count(Order.id).label('orders')
+    ).filter(Order.status == 'completed')
+    if start_date:
+        query = query.filter(Order.created_at >= start_date)
+    if end_date:
+        query = query.filter(Order.created_at <= end_date)
+    return query.group_by(bucket_expr).all()
+def completed_sales_summary(start_date=None, end_date=None, rollups=True):
+    """Totals and best day for completed orders without loading the orders"""
+    daily = completed_sales_by_bucket(start_date, end_date, 'day', rollups)
+    total_sales = float(sum(row.revenue for row in daily))
+    total_orders = int(sum(row.orders for row in daily))
+    best_day = max(daily, key=lambda row: row.revenue, default=None)
+    return {
+        'total_sales': total_sales,
+        'total_orders': total_orders,
+        'average_order_value': total_sales / total_orders if total_orders > 0 else 0,
+        'best_day': best_day.bucket if best_day else 'N/A'
+    }
 @app.route('/api/reports/sales', methods=['GET'])
+@cached_by_tables('orders', 'daily_sales')
 def sales_report():
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
-    query = Order.query.filter(Order.status == 'completed')
-    if start_date_str:
-        start_date = datetime.fromisoformat(start_date_str)
-        query = query.filter(Order.created_at >= start_date)
-    if end_date_str:
-        end_date = datetime.fromisoformat(end_date_str)
-        query = query.filter(Order.created_at <= end_date)
-    orders = query.all()
-    total_sales = sum(order.final_amount for order in orders)
-    total_orders = len(orders)
-    average_order_value = total_sales / total_orders if total_orders > 0 else 0
-    # Find best selling day
-    daily_sales = {}
-    for order in orders:
-        day = order.created_at.date()
-        daily_sales[day] = daily_sales.get(day, 0) + order.final_amount
-    best_day = max(daily_sales.items(), key=lambda x: x[1], default=(None, 0))
-    best_day_formatted = best_day[0].strftime('%Y-%m-%d') if best_day[0] else 'N/A'
+    start_date = datetime.fromisoformat(start_date_str) if start_date_str else None
+    end_date = datetime.fromisoformat(end_date_str) if end_date_str else None
+    summary = completed_sales_summary(start_date, end_date, use_rollups())
+    total_sales = summary['total_sales']
+    total_orders = summary['total_orders']
+    average_order_value = summary['average_order_value']
+    best_day_formatted = summary['best_day']
     return jsonify({
         'total_sales': total_sales,
         'total_orders': total_orders,
@@ -1722,24 +4516,41 @@ def sales_report():
         'period_start': start_date_str,
         'period_end': end_date_str
     })
+def popular_items(start_date=None, end_date=None, limit=20, rollups=True):
+    """Top menu items by quantity sold in completed orders"""
+    if rollups:
+        query = db.session.query(
+            MenuItem.name.label('item_name'),
+            db.func.sum(DailyItemSales.quantity).label('total_quantity'),
+            db.func.sum(DailyItemSales.revenue).label('total_revenue')
+        ).join(DailyItemSales, DailyItemSales.menu_item_id == MenuItem.id)
+        if start_date:
+            query = query.filter(DailyItemSales.day >= start_date.date())
+        if end_date:
+            query = query.filter(DailyItemSales.day <= end_date.date())
+        query = query.group_by(MenuItem.id).having(db.func.sum(DailyItemSales.quantity) > 0)
+    else:
+        query = db.session.query(
+            MenuItem.name.label('item_name'),
+            db.func.sum(OrderItem.quantity).label('total_quantity'),
+            db.func.sum(OrderItem.quantity * OrderItem.price).label('total_revenue')
+        ).join(OrderItem, OrderItem.menu_item_id == MenuItem.id
+        ).join(Order, Order.id == OrderItem.order_id
+        ).filter(Order.status == 'completed')
+        if start_date:
+            query = query.filter(Order.created_at >= start_date)
+        if end_date:
+            query = query.filter(Order.created_at <= end_date)
+        query = query.group_by(MenuItem.id)
+    return query.order_by(db.desc('total_quantity')).limit(limit).all()
 @app.route('/api/reports/popular-items', methods=['GET'])
+@cached_by_tables('orders', 'order_items', 'menu_items', 'daily_item_sales')
 def popular_items_report():
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
-    query = db.session.query(
-        MenuItem.name.label('item_name'),
-        db.func.sum(OrderItem.quantity).label('total_quantity'),
-        db.func.sum(OrderItem.quantity * OrderItem.price).label('total_revenue')
-    ).join(OrderItem, OrderItem.menu_item_id == MenuItem.id
-    ).join(Order, Order.id == OrderItem.order_id
-    ).filter(Order.status == 'completed')
-    if start_date_str:
-        start_date = datetime.fromisoformat(start_date_str)
-        query = query.filter(Order.created_at >= start_date)
-    if end_date_str:
-        end_date = datetime.fromisoformat(end_date_str)
-        query = query.filter(Order.created_at <= end_date)
-    results = query.group_by(MenuItem.id).order_by(db.desc('total_quantity')).limit(20).all()
+    start_date = datetime.fromisoformat(start_date_str) if start_date_str else None
+    end_date = datetime.fromisoformat(end_date_str) if end_date_str else None
+    results = popular_items(start_date, end_date, rollups=use_rollups())
     return jsonify([{
         'item_name': result[0],
         'total_quantity': result[1],
@@ -1747,31 +4558,33 @@ def popular_items_report():
     } for result in results])
 # Advanced Analytics Dashboard
 @app.route('/api/analytics/overview', methods=['GET'])
+@cached_by_tables('orders', 'daily_sales', 'customers', 'ingredients', 'users')
 def analytics_overview():
     """Get comprehensive analytics overview"""
     # Date range (default to last 30 days)
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=30)
     # Revenue analytics
-    orders = Order.query.filter(
-        Order.status == 'completed',
-        Order.created_at >= start_date,
-        Order.created_at <= end_date
-    ).all()
-    total_revenue = sum(order.final_amount or 0 for order in orders)
-    total_orders = len(orders)
+    daily = completed_sales_by_bucket(start_date, end_date, 'day', use_rollups())
+    total_revenue = float(sum(row.revenue for row in daily))
+    total_orders = int(sum(row.orders for row in daily))
     avg_order_value = total_revenue / total_orders if total_orders > 0 else 0
     # Customer analytics
-    customers = Customer.query.all()
-    total_customers = len(customers)
-    active_customers = len([c for c in customers if c.total_orders and c.total_orders > 0])
+    total_customers, active_customers, total_loyalty_points = db.session.query(
+        db.func.count(Customer.id),
+        db.func.coalesce(db.func.sum(db.case((Customer.total_orders > 0, 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(Customer.loyalty_points), 0)
+    ).one()
     # Loyalty program stats
-    total_loyalty_points = sum(c.loyalty_points or 0 for c in customers)
     avg_loyalty_points = total_loyalty_points / total_customers if total_customers > 0 else 0
     # Inventory analytics
-    ingredients = Ingredient.query.all()
-    low_stock_items = len([i for i in ingredients if i.current_stock <= i.min_stock])
-    total_inventory_value = sum((i.current_stock or 0) * (i.cost_per_unit or 0) for i in ingredients)
+    total_ingredients, low_stock_items, total_inventory_value = db.session.query(
+        db.func.count(Ingredient.id),
+        db.func.coalesce(db.func.sum(db.case((Ingredient.current_stock <= Ingredient.min_stock, 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(
+            db.func.coalesce(Ingredient.current_stock, 0) * db.func.coalesce(Ingredient.cost_per_unit, 0)
+        ), 0)
+    ).one()
     # Staff analytics
     staff_count = User.query.filter(User.role != 'customer').count()
     active_staff = User.query.filter(User.role != 'customer', User.is_active == True).count()
@@ -1788,7 +4601,7 @@ def analytics_overview():
             'avg_loyalty_points': avg_loyalty_points
         },
         'inventory': {
-            'total_items': len(ingredients),
+            'total_items': total_ingredients,
             'low_stock': low_stock_items,
             'total_value': total_inventory_value
         },
@@ -1802,54 +4615,260 @@ def analytics_overview():
         }
     })
 @app.route('/api/analytics/revenue-trends', methods=['GET'])
+@cached_by_tables('orders', 'daily_sales')
 def revenue_trends():
-    """Get revenue trends over time"""
+    """Get revenue trends over time, bucketed by day (default), week or month"""
     days = int(request.args.get('days', 30))
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in REPORT_BUCKETS:
+        return jsonify({'message': f"bucket must be one of {', '.join(REPORT_BUCKETS)}"}), 400
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=days)
-    # Daily revenue
-    daily_revenue = {}
-    orders = Order.query.filter(
-        Order.status == 'completed',
-        Order.created_at >= start_date,
-        Order.created_at <= end_date
-    ).all()
-    for order in orders:
-        day = order.created_at.date().isoformat()
-        daily_revenue[day] = daily_revenue.get(day, 0) + (order.final_amount or 0)
-    # Fill missing days with 0
-    current_date = start_date.date()
-    while current_date <= end_date.date():
-        day_str = current_date.isoformat()
-        if day_str not in daily_revenue:
-            daily_revenue[day_str] = 0
-        current_date += timedelta(days=1)
+    revenue = {}
+    orders = {}
+    for row in completed_sales_by_bucket(start_date, end_date, bucket, use_rollups()):
+        revenue[row.bucket] = float(row.revenue)
+        orders[row.bucket] = int(row.orders)
+    # Fill missing buckets with 0 on the small aggregated result
+    for key in bucket_starts(start_date.date(), end_date.date(), bucket):
+        revenue.setdefault(key, 0)
+        orders.setdefault(key, 0)
+    return jsonify({
+        'bucket': bucket,
+        'daily_revenue': [{'date': k, 'revenue': v, 'orders': orders[k]} for k, v in sorted(revenue.items())],
+        'total_revenue': sum(revenue.values()),
+        'avg_daily_revenue': sum(revenue.values()) / len(revenue) if revenue else 0
+    })
+HEATMAP_METRICS = ('orders', 'revenue', 'items')
+HEATMAP_WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+def hourly_sales_rows(start_day, category_id=None, menu_item_ids=None, rollups=True):
+    """(day, hour, orders, revenue, items) for completed orders from start_day onwards.
+    Item filters aggregate the matching order lines; orders then counts orders containing them."""
+    if rollups and not category_id and not menu_item_ids:
+        return [(str(r.day), r.hour, r.orders, r.revenue, r.items_sold) for r in db.session.query(
+            HourlySales.day, HourlySales.hour, HourlySales.orders, HourlySales.revenue, HourlySales.items_sold
+        ).filter(HourlySales.day >= start_day, HourlySales.orders != 0).all()]
+    day = db.func.date(Order.created_at)
+    hour = db.cast(db.func.strftime('%H', Order.created_at), db.Integer)
+    start = datetime.combine(start_day, datetime.min.time())
+    items = db.session.query(
+        day, hour,
+        db.func.count(db.distinct(Order.id)),
+        db.func.sum(OrderItem.quantity * OrderItem.price),
+        db.func.sum(OrderItem.quantity)
+    ).select_from(OrderItem).join(Order, Order.id == OrderItem.order_id).filter(
+        Order.status == 'completed', Order.created_at >= start
+    )
+    if category_id:
+        items = items.join(MenuItem, MenuItem.id == OrderItem.menu_item_id).filter(MenuItem.category_id == category_id)
+    if menu_item_ids:
+        items = items.filter(OrderItem.menu_item_id.in_(menu_item_ids))
+    items = items.group_by(day, hour).all()
+    if category_id or menu_item_ids:
+        return items
+    # Unfiltered: revenue is the order total (after discounts), as in the rollups
+    items_by_slot = {(r[0], r[1]): r[4] for r in items}
+    return [(r[0], r[1], r[2], r[3], items_by_slot.get((r[0], r[1]), 0)) for r in db.session.query(
+        day, hour, db.func.count(Order.id), db.func.sum(Order.final_amount)
+    ).filter(Order.status == 'completed', Order.created_at >= start).group_by(day, hour).all()]
+def weekly_heatmap(rows, start_day, weeks, halflife_weeks):
+    """Fold (day, hour, ...) rows into a weeks x 7 x 24 cube per metric.
+    Returns per-metric totals and an exponentially weighted weekly average (recent weeks count more)."""
+    cube = np.zeros((len(HEATMAP_METRICS), weeks, 7, 24))
+    if rows:
+        days = np.array([(datetime.fromisoformat(str(r[0])).date() - start_day).days for r in rows])
+        hours = np.array([int(r[1]) for r in rows])
+        values = np.array([[float(v or 0) for v in r[2:5]] for r in rows]).T
+        keep = (days >= 0) & (days < weeks * 7)
+        days, hours, values = days[keep], hours[keep], values[:, keep]
+        # start_day is a Monday, so day offsets map straight onto (week, weekday)
+        for metric in range(len(HEATMAP_METRICS)):
+            np.add.at(cube[metric], (days // 7, days % 7, hours), values[metric])
+    weights = 0.5 ** (np.arange(weeks)[::-1] / halflife_weeks)
+    weights /= weights.sum()
+    smoothed = np.tensordot(weights, cube, axes=([0], [1]))
+    return {
+        metric: {
+            'total': np.round(cube[index].sum(axis=0), 2).tolist(),
+            'weekly_average': np.round(smoothed[index], 2).tolist()
+        } for index, metric in enumerate(HEATMAP_METRICS)
+    }
+@app.route('/api/analytics/hourly-heatmap', methods=['GET'])
+@cached_by_tables('orders', 'order_items', 'menu_items', 'hourly_sales')
+def hourly_heatmap():
+    """7x24 (weekday x hour) matrices of orders, revenue and items sold over the last `weeks` full weeks.
+    Optional filters: category_id, menu_item_id (comma separated). halflife_weeks controls the smoothing."""
+    try:
+        weeks = max(1, min(int(request.args.get('weeks', 8)), 104))
+        halflife_weeks = max(0.1, float(request.args.get('halflife_weeks', 4)))
+        category_id = request.args.get('category_id', type=int)
+        menu_item_ids = [int(i) for i in request.args.get('menu_item_id', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'message': 'Invalid heatmap parameters'}), 400
+    today = datetime.utcnow().date()
+    # Window of whole completed weeks, Monday to Sunday; the partial current week would skew the averages
+    start_day = today - timedelta(days=today.weekday()) - timedelta(weeks=weeks)
+    rows = hourly_sales_rows(start_day, category_id, menu_item_ids, use_rollups())
+    heatmap = weekly_heatmap(rows, start_day, weeks, halflife_weeks)
+    orders = np.array(heatmap['orders']['weekly_average'])
+    peak_day, peak_hour = np.unravel_index(int(orders.argmax()), orders.shape)
     return jsonify({
-        'daily_revenue': [{'date': k, 'revenue': v} for k, v in sorted(daily_revenue.items())],
-        'total_revenue': sum(daily_revenue.values()),
-        'avg_daily_revenue': sum(daily_revenue.values()) / len(daily_revenue) if daily_revenue else 0
+        'weeks': weeks,
+        'start': start_day.isoformat(),
+        'end': (start_day + timedelta(weeks=weeks, days=-1)).isoformat(),
+        'weekdays': list(HEATMAP_WEEKDAYS),
+        'hours': list(range(24)),
+        'filters': {'category_id': category_id, 'menu_item_id': menu_item_ids},
+        'halflife_weeks': halflife_weeks,
+        'peak': {
+            'weekday': HEATMAP_WEEKDAYS[peak_day],
+            'hour': int(peak_hour),
+            'orders': float(orders[peak_day, peak_hour])
+        } if orders.any() else None,
+        **heatmap
+    })
+MENU_ENGINEERING_POPULARITY_FACTOR = 0.7  # an item is popular if it sells at least 70% of its fair share
+def menu_item_sales_and_costs(start_date=None, end_date=None, category_id=None, rollups=True):
+    """One aggregate query: per menu item price, quantity sold, revenue and current recipe cost.
+    Includes available items without sales so they can be classified too."""
+    if rollups:
+        sales = db.session.query(
+            DailyItemSales.menu_item_id.label('menu_item_id'),
+            db.func.sum(DailyItemSales.quantity).label('quantity'),
+            db.func.sum(DailyItemSales.revenue).label('revenue')
+        )
+        if start_date:
+            sales = sales.filter(DailyItemSales.day >= start_date.date())
+        if end_date:
+            sales = sales.filter(DailyItemSales.day <= end_date.date())
+        sales = sales.group_by(DailyItemSales.menu_item_id).subquery()
+    else:
+        sales = db.session.query(
+            OrderItem.menu_item_id.label('menu_item_id'),
+            db.func.sum(OrderItem.quantity).label('quantity'),
+            db.func.sum(OrderItem.quantity * OrderItem.price).label('revenue')
+        ).join(Order, Order.id == OrderItem.order_id).filter(Order.status == 'completed')
+        if start_date:
+            sales = sales.filter(Order.created_at >= start_date)
+        if end_date:
+            sales = sales.filter(Order.created_at <= end_date)
+        sales = sales.group_by(OrderItem.menu_item_id).subquery()
+    recipe_costs = db.session.query(
+        Recipe.menu_item_id.label('menu_item_id'),
+        db.func.sum(Recipe.quantity_required * db.func.coalesce(Ingredient.cost_per_unit, 0)).label('unit_cost'),
+        db.func.count(Recipe.id).label('recipe_lines')
+    ).join(Ingredient, Ingredient.id == Recipe.ingredient_id).group_by(Recipe.menu_item_id).subquery()
+    query = db.session.query(
+        MenuItem.id, MenuItem.name, MenuItem.category_id, MenuItem.price,
+        db.func.coalesce(sales.c.quantity, 0),
+        db.func.coalesce(sales.c.revenue, 0),
+        db.func.coalesce(recipe_costs.c.unit_cost, 0),
+        db.func.coalesce(recipe_costs.c.recipe_lines, 0)
+    ).outerjoin(sales, sales.c.menu_item_id == MenuItem.id
+    ).outerjoin(recipe_costs, recipe_costs.c.menu_item_id == MenuItem.id
+    ).filter(db.or_(MenuItem.is_available == True, sales.c.quantity > 0))
+    if category_id:
+        query = query.filter(MenuItem.category_id == category_id)
+    return query.all()
+def classify_menu_items(quantity, revenue, price, unit_cost):
+    """Kasavana-Smith menu engineering over parallel arrays.
+    Popularity threshold: 70% of an even share of items sold. Margin threshold: the sales-weighted average margin."""
+    sold = quantity > 0
+    selling_price = np.where(sold, revenue / np.where(sold, quantity, 1), price)
+    margin = selling_price - unit_cost
+    total_sold = quantity.sum()
+    item_count = len(quantity)
+    popularity_index = quantity / total_sold if total_sold > 0 else np.zeros(item_count)
+    popularity_threshold = MENU_ENGINEERING_POPULARITY_FACTOR / item_count if item_count else 0
+    margin_threshold = float((margin * quantity).sum() / total_sold) if total_sold > 0 else float(margin.mean() if item_count else 0)
+    popular = popularity_index >= popularity_threshold
+    profitable = margin >= margin_threshold
+    classification = np.select(
+        [popular & profitable, popular & ~profitable, ~popular & profitable],
+        ['star', 'plowhorse', 'puzzle'],
+        default='dog'
+    )
+    return {
+        'selling_price': selling_price,
+        'margin': margin,
+        'total_margin': margin * quantity,
+        'food_cost_pct': np.where(selling_price > 0, unit_cost / np.where(selling_price > 0, selling_price, 1) * 100, 0),
+        'popularity_index': popularity_index,
+        'classification': classification,
+        'popularity_threshold': popularity_threshold,
+        'margin_threshold': margin_threshold
+    }
+@app.route('/api/analytics/menu-engineering', methods=['GET'])
+@cached_by_tables('orders', 'order_items', 'menu_items', 'daily_item_sales', 'recipes', 'ingredients')
+def menu_engineering():
+    """Classify menu items as stars, plowhorses, puzzles or dogs by popularity and contribution margin"""
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
+    try:
+        start_date = datetime.fromisoformat(start_date_str) if start_date_str else None
+        end_date = datetime.fromisoformat(end_date_str) if end_date_str else None
+    except ValueError:
+        return jsonify({'message': 'Invalid date format'}), 400
+    category_id = request.args.get('category_id', type=int)
+    rows = menu_item_sales_and_costs(start_date, end_date, category_id, use_rollups())
+    quantity = np.array([float(r[4]) for r in rows])
+    revenue = np.array([float(r[5]) for r in rows])
+    price = np.array([float(r[3] or 0) for r in rows])
+    unit_cost = np.array([float(r[6]) for r in rows])
+    result = classify_menu_items(quantity, revenue, price, unit_cost)
+    items = [{
+        'menu_item_id': row[0],
+        'name': row[1],
+        'category_id': row[2],
+        'price': row[3],
+        'quantity_sold': int(quantity[i]),
+        'revenue': round(float(revenue[i]), 2),
+        'unit_cost': round(float(unit_cost[i]), 4),
+        'has_recipe': row[7] > 0,
+        'contribution_margin': round(float(result['margin'][i]), 2),
+        'total_contribution': round(float(result['total_margin'][i]), 2),
+        'food_cost_pct': round(float(result['food_cost_pct'][i]), 1),
+        'popularity_index': round(float(result['popularity_index'][i]), 4),
+        'classification': str(result['classification'][i])
+    } for i, row in enumerate(rows)]
+    items.sort(key=lambda item: item['total_contribution'], reverse=True)
+    counts = {name: int((result['classification'] == name).sum()) for name in ('star', 'plowhorse', 'puzzle', 'dog')}
+    return jsonify({
+        'period_start': start_date_str,
+        'period_end': end_date_str,
+        'thresholds': {
+            'popularity_index': round(float(result['popularity_threshold']), 4),
+            'contribution_margin': round(result['margin_threshold'], 2)
+        },
+        'totals': {
+            'items': len(items),
+            'quantity_sold': int(quantity.sum()),
+            'revenue': round(float(revenue.sum()), 2),
+            'contribution': round(float(result['total_margin'].sum()), 2)
+        },
+        'quadrants': counts,
+        'items': items
     })
 @app.route('/api/analytics/customer-insights', methods=['GET'])
+@cached_by_tables('customers')
 def customer_insights():
     """Get customer behavior insights"""
-    customers = Customer.query.all()
     # Customer segments
-    segments = {
-        'new': len([c for c in customers if c.total_orders and c.total_orders <= 1]),
-        'regular': len([c for c in customers if c.total_orders and 2 <= c.total_orders <= 10]),
-        'loyal': len([c for c in customers if c.total_orders and c.total_orders > 10])
-    }
+    segment = db.case(
+        (Customer.total_orders > 10, 'loyal'),
+        (Customer.total_orders >= 2, 'regular'),
+        (Customer.total_orders >= 1, 'new')
+    )
+    segments = {'new': 0, 'regular': 0, 'loyal': 0}
+    for name, count in db.session.query(segment, db.func.count(Customer.id)).group_by(segment).all():
+        if name:
+            segments[name] = count
     # Loyalty tier distribution
-    tiers = {}
-    for customer in customers:
-        tier = get_customer_loyalty_tier(customer.loyalty_points)
-        tiers[tier] = tiers.get(tier, 0) + 1
+    tiers = dict(db.session.query(Customer.loyalty_tier, db.func.count(Customer.id)).group_by(Customer.loyalty_tier).all())
     # Top customers by spending
-    top_customers = sorted(
-        [c for c in customers if c.total_spent and c.total_spent > 0],
-        key=lambda x: x.total_spent,
-        reverse=True
-    )[:10]
+    top_customers = Customer.query.filter(Customer.total_spent > 0).order_by(
+        Customer.total_spent.desc(), Customer.id
+    ).limit(10).all()
     return jsonify({
         'segments': segments,
         'tiers': tiers,
@@ -1861,38 +4880,298 @@ def customer_insights():
             'loyalty_points': c.loyalty_points
         } for c in top_customers]
     })
+def month_offset(start, end):
+    return (end.year - start.year) * 12 + end.month - start.month
+@app.route('/api/analytics/cohorts', methods=['GET'])
+@cached_by_tables('cohort_activity', 'cohort_repeat_intervals')
+def cohort_analysis():
+    """Monthly cohort retention, cumulative lifetime value per customer and repeat-visit intervals
+    for the last `months` cohorts, read from the incrementally maintained cohort rollups."""
+    months = max(1, min(request.args.get('months', 24, type=int), 120))
+    this_month = datetime.utcnow().date().replace(day=1)
+    first_cohort = this_month
+    for _ in range(months - 1):
+        first_cohort = (first_cohort - timedelta(days=1)).replace(day=1)
+    cohort_months = [first_cohort]
+    while cohort_months[-1] < this_month:
+        cohort_months.append((cohort_months[-1] + timedelta(days=32)).replace(day=1))
+    index = {month: i for i, month in enumerate(cohort_months)}
+    rows = CohortActivity.query.filter(CohortActivity.cohort_month >= first_cohort).all()
+    size = np.zeros(months)
+    active = np.zeros((months, months))
+    orders = np.zeros((months, months))
+    revenue = np.zeros((months, months))
+    repeat_orders = np.zeros(months)
+    repeat_days = np.zeros(months)
+    for row in rows:
+        c = index.get(row.cohort_month)
+        offset = month_offset(row.cohort_month, row.activity_month)
+        if c is None or not 0 <= offset < months:
+            continue
+        size[c] += row.new_customers
+        active[c, offset] += row.active_customers
+        orders[c, offset] += row.orders
+        revenue[c, offset] += row.revenue
+        repeat_orders[c] += row.repeat_orders
+        repeat_days[c] += row.repeat_interval_days
+    # Offsets beyond the current month haven't happened yet and are returned as null
+    elapsed = np.arange(months)[None, :] <= (months - 1 - np.arange(months))[:, None]
+    safe_size = np.where(size > 0, size, 1)[:, None]
+    retention = np.where(elapsed, active / safe_size * 100, np.nan)
+    clv = np.where(elapsed, np.cumsum(revenue, axis=1) / safe_size, np.nan)
+    # Size-weighted average retention per month offset, over cohorts that have reached it
+    weights = np.where(elapsed, size[:, None], 0)
+    weighted_active = np.where(elapsed, active, 0).sum(axis=0)
+    average_retention = np.where(weights.sum(axis=0) > 0, weighted_active / np.where(weights.sum(axis=0) > 0, weights.sum(axis=0), 1) * 100, np.nan)
+    histogram = {bucket: 0 for bucket in REPEAT_INTERVAL_BUCKETS}
+    for bucket, count in db.session.query(CohortRepeatInterval.bucket_days, db.func.sum(CohortRepeatInterval.orders)).filter(
+        CohortRepeatInterval.cohort_month >= first_cohort
+    ).group_by(CohortRepeatInterval.bucket_days).all():
+        histogram[bucket] = int(count)
+    def to_list(values):
+        return [None if np.isnan(v) else round(float(v), 2) for v in values]
+    cohorts = [{
+        'cohort': month.strftime('%Y-%m'),
+        'customers': int(size[i]),
+        'retention': to_list(retention[i][:months - i]),
+        'active_customers': [int(v) for v in active[i][:months - i]],
+        'orders': [int(v) for v in orders[i][:months - i]],
+        'cumulative_clv': to_list(clv[i][:months - i]),
+        'lifetime_value': round(float(revenue[i].sum() / size[i]), 2) if size[i] else 0.0,
+        'avg_repeat_interval_days': round(float(repeat_days[i] / repeat_orders[i]), 1) if repeat_orders[i] else None
+    } for i, month in enumerate(cohort_months)]
+    total_repeat_orders = repeat_orders.sum()
+    return jsonify({
+        'months': months,
+        'cohorts': cohorts,
+        'average_retention': to_list(average_retention),
+        'repeat_intervals': {
+            'avg_days': round(float(repeat_days.sum() / total_repeat_orders), 1) if total_repeat_orders else None,
+            'histogram': [{
+                'from_days': bucket,
+                'to_days': REPEAT_INTERVAL_BUCKETS[i + 1] if i + 1 < len(REPEAT_INTERVAL_BUCKETS) else None,
+                'orders': histogram[bucket]
+            } for i, bucket in enumerate(REPEAT_INTERVAL_BUCKETS)]
+        }
+    })
+# Service latency histograms
+# Durations are streamed into fixed-size log-bucketed histograms (HDR style, ~3% relative error),
+# so memory is constant and percentiles are read in constant time regardless of order volume.
+LATENCY_BUCKET_GROWTH = 1.03
+LATENCY_MAX_SECONDS = 2 * 24 * 3600
+LATENCY_BUCKET_COUNT = int(np.ceil(np.log(LATENCY_MAX_SECONDS) / np.log(LATENCY_BUCKET_GROWTH))) + 1
+LATENCY_FLUSH_SECONDS = 30  # how often pending samples are merged into latency_histograms
+LATENCY_PERCENTILES = (50, 95, 99)
+_latency_pending = {}  # (metric, dimension, key) -> [counts array, total seconds]
+_latency_lock = threading.Lock()
+_latency_flusher = None
+def latency_bucket(seconds):
+    return min(LATENCY_BUCKET_COUNT - 1, int(np.log(max(seconds, 1.0)) / np.log(LATENCY_BUCKET_GROWTH)))
+def queue_latency_sample(metric, seconds, dimensions=None):
+    """Record a duration once the current transaction commits, under 'all' and each given dimension"""
+    if seconds is None or seconds < 0:
+        return
+    keys = [('all', '')] + [(dimension, str(value)) for dimension, value in (dimensions or {}).items() if value is not None]
+    db.session.info.setdefault('latency_samples', []).extend((metric, dimension, key, seconds) for dimension, key in keys)
+def record_latency_samples(samples):
+    with _latency_lock:
+        for metric, dimension, key, seconds in samples:
+            pending = _latency_pending.setdefault((metric, dimension, key), [np.zeros(LATENCY_BUCKET_COUNT, dtype=np.int64), 0.0])
+            pending[0][latency_bucket(seconds)] += 1
+            pending[1] += seconds
+    _start_latency_flusher()
+@db.event.listens_for(db.session, 'after_commit')
+def _publish_latency_samples(sess):
+    samples = sess.info.pop('latency_samples', None)
+    if samples:
+        record_latency_samples(samples)
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _discard_latency_samples(sess, previous_transaction):
+    sess.info.pop('latency_samples', None)
+def flush_latency_histograms():
+    """Merge this process's pending samples into the persisted histograms.
+    The rows are created first and then read-modify-written under a write lock (SELECT FOR UPDATE
+    on PostgreSQL, the database write lock taken by the insert on SQLite), so concurrent flushes
+    from other workers serialize instead of overwriting each other's counts."""
+    with _latency_lock:
+        pending = dict(_latency_pending)
+        _latency_pending.clear()
+    if not pending:
+        return 0
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        now = datetime.utcnow()
+        empty = np.zeros(LATENCY_BUCKET_COUNT, dtype=np.int64).tobytes()
+        db.session.execute(insert(LatencyHistogram.__table__).on_conflict_do_nothing(), [
+            {'metric': metric, 'dimension': dimension, 'key': key, 'counts': empty, 'total_seconds': 0, 'updated_at': now}
+            for metric, dimension, key in pending
+        ])
+        existing = {(h.metric, h.dimension, h.key): h for h in LatencyHistogram.query.filter(
+            LatencyHistogram.metric.in_({metric for metric, _, _ in pending})
+        ).with_for_update().populate_existing().all()}
+        for ident, (counts, total_seconds) in pending.items():
+            histogram = existing[ident]
+            histogram.counts = (np.frombuffer(histogram.counts, dtype=np.int64) + counts).tobytes()
+            histogram.total_seconds += total_seconds
+            histogram.updated_at = now
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        # Put the samples back so they are retried on the next flush
+        with _latency_lock:
+            for ident, (counts, total_seconds) in pending.items():
+                current = _latency_pending.setdefault(ident, [np.zeros(LATENCY_BUCKET_COUNT, dtype=np.int64), 0.0])
+                current[0] += counts
+                current[1] += total_seconds
+        raise
+    return len(pending)
+def _latency_flush_loop():
+    while True:
+        time.sleep(LATENCY_FLUSH_SECONDS)
+        with app.app_context():
+            try:
+                flush_latency_histograms()
+            except Exception as e:
+                print(f"Error flushing latency histograms: {e}")
+            finally:
+                db.session.remove()
+def _flush_latency_on_exit():
+    with app.app_context():
+        try:
+            flush_latency_histograms()
+        except Exception as e:
+            print(f"Error flushing latency histograms: {e}")
+def _start_latency_flusher():
+    global _latency_flusher
+    with _latency_lock:
+        if _latency_flusher is None:
+            _latency_flusher = threading.Thread(target=_latency_flush_loop, daemon=True)
+            _latency_flusher.start()
+            atexit.register(_flush_latency_on_exit)
+def track_item_status_change(item, old_status):
+    """Stamp item lifecycle times and queue prep-time and time-to-first-item samples"""
+    if item.status == old_status:
+        return
+    now = datetime.utcnow()
+    order = item.order
+    if item.status == 'cooking' and not item.started_at:
+        item.started_at = now
+    elif item.status == 'ready' and not item.ready_at:
+        item.ready_at = now
+        sent_at = order.confirmed_at or order.created_at or now
+        category = item.menu_item.category if item.menu_item else None
+        queue_latency_sample('item_prep_time', (now - (item.started_at or sent_at)).total_seconds(), {
+            'station': category.name if category else 'unassigned'
+        })
+        if not order.first_item_ready_at:
+            order.first_item_ready_at = now
+            queue_latency_sample('time_to_first_item', (now - sent_at).total_seconds(), {
+                'order_type': order.order_type,
+                'hour': str(sent_at.hour)
+            })
+    elif item.status in ('served', 'completed') and not item.served_at:
+        item.served_at = now
+@db.event.listens_for(Table.status, 'set', active_history=True)
+def _track_table_turn(table, value, old_value, initiator):
+    """Table turn time runs from when a table becomes occupied until it is released, whichever code path sets status"""
+    if value == old_value:
+        return
+    now = datetime.utcnow()
+    if value == 'occupied':
+        table.occupied_since = now
+    elif old_value == 'occupied':
+        if table.occupied_since:
+            queue_latency_sample('table_turn_time', (now - table.occupied_since).total_seconds(), {
+                'hour': str(table.occupied_since.hour),
+                'capacity': table.capacity
+            })
+            queue_table_turn(table.capacity, (now - table.occupied_since).total_seconds())
+        table.occupied_since = None
+        table.current_order_id = None
+        table.party_size = None
+def latency_summary(counts, total_seconds):
+    """Count, mean and percentiles (bucket geometric midpoints) from a histogram"""
+    total = int(counts.sum())
+    if total == 0:
+        return {'count': 0, 'mean_seconds': None, **{f'p{p}_seconds': None for p in LATENCY_PERCENTILES}}
+    cumulative = np.cumsum(counts)
+    lower = LATENCY_BUCKET_GROWTH ** np.arange(LATENCY_BUCKET_COUNT)
+    midpoints = lower * np.sqrt(LATENCY_BUCKET_GROWTH)
+    midpoints[0] = 0.5
+    summary = {'count': total, 'mean_seconds': round(float(total_seconds) / total, 1)}
+    for p in LATENCY_PERCENTILES:
+        bucket = int(np.searchsorted(cumulative, np.ceil(total * p / 100)))
+        summary[f'p{p}_seconds'] = round(float(midpoints[bucket]), 1)
+    return summary
+def latency_report():
+    """Persisted histograms plus this process's unflushed samples, grouped as metric -> dimension -> key"""
+    merged = {}
+    for h in LatencyHistogram.query.all():
+        merged[(h.metric, h.dimension, h.key)] = [np.frombuffer(h.counts, dtype=np.int64).copy(), h.total_seconds]
+    with _latency_lock:
+        for ident, (counts, total_seconds) in _latency_pending.items():
+            current = merged.setdefault(ident, [np.zeros(LATENCY_BUCKET_COUNT, dtype=np.int64), 0.0])
+            current[0] += counts
+            current[1] += total_seconds
+    report = {}
+    for (metric, dimension, key), (counts, total_seconds) in sorted(merged.items()):
+        summary = latency_summary(counts, total_seconds)
+        if dimension == 'all':
+            report.setdefault(metric, {})['all'] = summary
+        else:
+            report.setdefault(metric, {}).setdefault('by_' + dimension, {})[key] = summary
+    return report
 @app.route('/api/analytics/operational-efficiency', methods=['GET'])
 def operational_efficiency():
-    """Get operational efficiency metrics"""
-    # Order processing times (placeholder - would need actual timestamps)
-    orders = Order.query.filter(Order.status == 'completed').all()
+    """Get operational efficiency metrics, including ticket, first-item, prep and table turn time percentiles"""
+    completed_orders = Order.query.filter(Order.status == 'completed').count()
     # Table utilization
-    tables = Table.query.all()
-    occupied_tables = len([t for t in tables if t.status == 'occupied'])
-    utilization_rate = (occupied_tables / len(tables)) * 100 if tables else 0
-    # Staff performance (placeholder)
-    staff = User.query.filter(User.role != 'customer').all()
+    total_tables, occupied_tables = db.session.query(
+        db.func.count(Table.id),
+        db.func.coalesce(db.func.sum(db.case((Table.status == 'occupied', 1), else_=0)), 0)
+    ).one()
+    utilization_rate = (occupied_tables / total_tables) * 100 if total_tables else 0
+    staff_count = User.query.filter(User.role != 'customer').count()
     # Inventory turnover (placeholder calculation)
-    ingredients = Ingredient.query.all()
-    avg_inventory_value = sum((i.current_stock or 0) * (i.cost_per_unit or 0) for i in ingredients) / len(ingredients) if ingredients else 0
+    total_ingredients, inventory_value = db.session.query(
+        db.func.count(Ingredient.id),
+        db.func.coalesce(db.func.sum(
+            db.func.coalesce(Ingredient.current_stock, 0) * db.func.coalesce(Ingredient.cost_per_unit, 0)
+        ), 0)
+    ).one()
+    avg_inventory_value = inventory_value / total_ingredients if total_ingredients else 0
     return jsonify({
         'table_utilization': utilization_rate,
-        'total_tables': len(tables),
+        'total_tables': total_tables,
         'occupied_tables': occupied_tables,
         'avg_inventory_value': avg_inventory_value,
-        'total_ingredients': len(ingredients),
-        'staff_count': len(staff),
-        'completed_orders': len(orders)
+        'total_ingredients': total_ingredients,
+        'staff_count': staff_count,
+        'completed_orders': completed_orders,
+        'latency': latency_report()
     })
 @app.route('/api/analytics/profitability', methods=['GET'])
+@cached_by_tables('orders', 'daily_sales', 'inventory_transactions')
 def profitability_analysis():
     """Get profitability analysis"""
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
+    start_date = datetime.fromisoformat(start_date_str) if start_date_str else None
+    end_date = datetime.fromisoformat(end_date_str) if end_date_str else None
     # Revenue
-    orders = Order.query.filter(Order.status == 'completed').all()
-    total_revenue = sum(order.final_amount or 0 for order in orders)
-    # Cost of goods sold (COGS) - estimated from inventory costs
-    inventory_transactions = InventoryTransaction.query.filter_by(transaction_type='usage').all()
-    cogs = sum(t.quantity * t.ingredient.cost_per_unit for t in inventory_transactions if t.ingredient and t.ingredient.cost_per_unit)
+    total_revenue = completed_sales_summary(start_date, end_date, use_rollups())['total_sales']
+    # Cost of goods sold (COGS) - ingredient usage at the cost snapshotted when it was used
+    cogs_query = db.session.query(db.func.coalesce(db.func.sum(InventoryTransaction.total_cost), 0)).filter(
+        InventoryTransaction.transaction_type == 'usage'
+    )
+    if start_date:
+        cogs_query = cogs_query.filter(InventoryTransaction.transaction_date >= start_date)
+    if end_date:
+        cogs_query = cogs_query.filter(InventoryTransaction.transaction_date <= end_date)
+    cogs = float(cogs_query.scalar())
     # Operating expenses (placeholder - would need actual expense tracking)
     estimated_expenses = total_revenue * 0.3  # Assume 30% operating expenses
     # Profit calculations
@@ -1929,8 +5208,11 @@ def apply_loyalty(order_id):
     order.discount_amount = (order.discount_amount or 0) + discount_value
     base_total = order.total_amount or 0
     order.final_amount = max(0.0, base_total - (order.discount_amount or 0))
-    # Deduct points
-    customer.loyalty_points = (customer.loyalty_points or 0) - points_to_redeem
+    # Deduct points; the balance check is repeated atomically in case of a concurrent redemption
+    if not post_loyalty_entry(customer.id, -points_to_redeem, 'redemption', order_id=order.id,
+                              created_by=session.get('user_id')):
+        db.session.rollback()
+        return jsonify({'message': 'Insufficient points'}), 400
     db.session.commit()
     return jsonify({'message': 'Loyalty applied', 'final_amount': order.final_amount, 'discount_amount': order.discount_amount, 'remaining_points': customer.loyalty_points})
 # Public online ordering minimal endpoints
@@ -1996,6 +5278,8 @@ def public_pay():
     method = data.get('method', 'online')
     payment = Payment(order_id=order.id, amount=amount, payment_method=method, payment_status='completed', transaction_id='MOCK-' + datetime.utcnow().strftime('%Y%m%d%H%M%S'))
     db.session.add(payment)
+    db.session.flush()
+    apply_payment_rollups(payment)
     db.session.commit()
     return jsonify({'message': 'Payment successful'})
 # KDS realtime updates via SSE
@@ -2423,31 +5707,19 @@ def handle_category(category_id):
         return jsonify({'message': 'Category deleted'})
 # Export Endpoints for Reports (NEW)
 @app.route('/api/reports/export/sales', methods=['GET'])
+@cached_by_tables('orders', 'daily_sales')
 def export_sales_report():
     """Export sales data as CSV"""
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
+    start_date = datetime.fromisoformat(start_date_str) if start_date_str else None
+    end_date = datetime.fromisoformat(end_date_str) if end_date_str else None
     
-    query = Order.query.filter(Order.status == 'completed')
-    if start_date_str:
-        start_date = datetime.fromisoformat(start_date_str)
-        query = query.filter(Order.created_at >= start_date)
-    if end_date_str:
-        end_date = datetime.fromisoformat(end_date_str)
-        query = query.filter(Order.created_at <= end_date)
-    
-    orders = query.all()
-    total_sales = sum(order.final_amount for order in orders)
-    total_orders = len(orders)
-    average_order_value = total_sales / total_orders if total_orders > 0 else 0
-    
-    # Find best selling day
-    daily_sales = {}
-    for order in orders:
-        day = order.created_at.date()
-        daily_sales[day] = daily_sales.get(day, 0) + order.final_amount
-    best_day = max(daily_sales.items(), key=lambda x: x[1], default=(None, 0))
-    best_day_formatted = best_day[0].strftime('%Y-%m-%d') if best_day[0] else 'N/A'
+    summary = completed_sales_summary(start_date, end_date, use_rollups())
+    total_sales = summary['total_sales']
+    total_orders = summary['total_orders']
+    average_order_value = summary['average_order_value']
+    best_day_formatted = summary['best_day']
     
     # Create CSV content
     import csv
@@ -2471,27 +5743,15 @@ def export_sales_report():
     return output
 
 @app.route('/api/reports/export/popular-items', methods=['GET'])
+@cached_by_tables('orders', 'order_items', 'menu_items', 'daily_item_sales')
 def export_popular_items_report():
     """Export popular items data as CSV"""
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
+    start_date = datetime.fromisoformat(start_date_str) if start_date_str else None
+    end_date = datetime.fromisoformat(end_date_str) if end_date_str else None
     
-    query = db.session.query(
-        MenuItem.name.label('item_name'),
-        db.func.sum(OrderItem.quantity).label('total_quantity'),
-        db.func.sum(OrderItem.quantity * OrderItem.price).label('total_revenue')
-    ).join(OrderItem, OrderItem.menu_item_id == MenuItem.id
-    ).join(Order, Order.id == OrderItem.order_id
-    ).filter(Order.status == 'completed')
-    
-    if start_date_str:
-        start_date = datetime.fromisoformat(start_date_str)
-        query = query.filter(Order.created_at >= start_date)
-    if end_date_str:
-        end_date = datetime.fromisoformat(end_date_str)
-        query = query.filter(Order.created_at <= end_date)
-    
-    results = query.group_by(MenuItem.id).order_by(db.desc('total_quantity')).limit(20).all()
+    results = popular_items(start_date, end_date, rollups=use_rollups())
     
     # Create CSV content
     import csv
@@ -2515,6 +5775,7 @@ def export_popular_items_report():
     return output
 
 @app.route('/api/reports/export/inventory', methods=['GET'])
+@cached_by_tables('ingredients')
 def export_inventory_report():
     """Export inventory data as CSV"""
     # Get all inventory items
@@ -2547,6 +5808,7 @@ def export_inventory_report():
     return output
 
 @app.route('/api/reports/export/staff', methods=['GET'])
+@cached_by_tables('users')
 def export_staff_report():
     """Export staff data as CSV"""
     # Get all staff members
@@ -2577,6 +5839,7 @@ def export_staff_report():
     return output
 
 @app.route('/api/reports/export/customers', methods=['GET'])
+@cached_by_tables('customers')
 def export_customer_report():
     """Export customer data as CSV"""
     # Get all customers
@@ -2607,6 +5870,7 @@ def export_customer_report():
     return output
 
 @app.route('/api/reports/export/inventory-transactions', methods=['GET'])
+@cached_by_tables('inventory_transactions', 'ingredients')
 def export_inventory_transactions_report():
     """Export inventory transactions data as CSV"""
     # Get all inventory transactions
@@ -2642,7 +5906,219 @@ def export_inventory_transactions_report():
     output.headers["Content-type"] = "text/csv"
     return output
 
+# Columnar export runs in a background thread; only one export runs at a time
+_columnar_export_job = {'status': 'idle'}
+_columnar_export_lock = threading.Lock()
+def _run_columnar_export(datasets, fmt, full):
+    from columnar_export import export_all
+    with app.app_context():
+        try:
+            written = export_all(datasets, fmt, full)
+            _columnar_export_job.update(status='completed', written=written)
+        except Exception as e:
+            _columnar_export_job.update(status='failed', error=str(e))
+        finally:
+            _columnar_export_job['finished_at'] = datetime.utcnow().isoformat()
+            db.session.remove()
+
+@app.route('/api/reports/export/columnar', methods=['GET', 'POST'])
+def columnar_export_job():
+    """POST starts an incremental columnar export (body: datasets, format, full); GET reports its status"""
+    if request.method == 'POST':
+        from columnar_export import DATASETS, pa
+        data = request.get_json(silent=True) or {}
+        datasets = data.get('datasets') or None
+        fmt = data.get('format')
+        unknown = [d for d in (datasets or []) if d not in DATASETS]
+        if unknown:
+            return jsonify({'message': f"Unknown datasets: {', '.join(unknown)}"}), 400
+        if fmt not in (None, 'parquet', 'npz'):
+            return jsonify({'message': 'format must be parquet or npz'}), 400
+        if fmt == 'parquet' and pa is None:
+            return jsonify({'message': 'Parquet export requires pyarrow'}), 400
+        with _columnar_export_lock:
+            if _columnar_export_job.get('status') == 'running':
+                return jsonify({'message': 'An export is already running', 'job': _columnar_export_job}), 409
+            _columnar_export_job.clear()
+            _columnar_export_job.update(status='running', started_at=datetime.utcnow().isoformat())
+        threading.Thread(target=_run_columnar_export, args=(datasets, fmt, bool(data.get('full'))), daemon=True).start()
+        return jsonify({'message': 'Export started', 'job': _columnar_export_job}), 202
+    return jsonify(_columnar_export_job)
+
+# Background report jobs
+REPORT_JOB_PREFIXES = ('/api/reports/', '/api/analytics/')
+REPORT_JOB_ACTIVE_STATUSES = ('queued', 'running')
+_report_job_pool = None
+_report_job_pool_lock = threading.Lock()
+def fail_stale_report_jobs():
+    """Jobs left 'running' by a worker that crashed or restarted would hold their queue slots forever"""
+    db.session.execute(ReportJob.__table__.update().where(
+        ReportJob.status == 'running',
+        ReportJob.started_at <= datetime.utcnow() - timedelta(minutes=REPORT_JOB_STALE_MINUTES)
+    ).values(
+        status='failed',
+        error=f'Interrupted: still running after {REPORT_JOB_STALE_MINUTES} minutes; submit it again',
+        finished_at=datetime.utcnow()
+    ))
+    # Commit even when nothing matched: on SQLite the UPDATE holds the write lock until then
+    db.session.commit()
+def get_report_job_pool():
+    """Per-process pool of report workers, created on first use.
+    Jobs still queued in the table (e.g. after a restart) are picked up when the pool starts;
+    run_report_job claims each job atomically so a job never runs twice."""
+    global _report_job_pool
+    with _report_job_pool_lock:
+        if _report_job_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            from report_jobs import init_report_worker, run_report_job
+            # fork lets workers inherit the loaded app instead of re-running database initialization;
+            # platforms without it (Windows) spawn fresh interpreters that import the app
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+            _report_job_pool = ProcessPoolExecutor(
+                max_workers=REPORT_JOB_WORKERS,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=init_report_worker
+            )
+            fail_stale_report_jobs()
+            for (job_id,) in db.session.query(ReportJob.id).filter(ReportJob.status == 'queued').all():
+                _report_job_pool.submit(run_report_job, job_id)
+        return _report_job_pool
+def is_reportable_path(path):
+    """Only GET report/analytics views can run as jobs (not the job or columnar export endpoints themselves)"""
+    if not path.startswith(REPORT_JOB_PREFIXES) or path.startswith('/api/reports/export/columnar'):
+        return False
+    try:
+        endpoint, _ = app.url_map.bind('localhost').match(path, method='GET')
+    except Exception:
+        return False
+    return endpoint is not None
+def purge_expired_report_jobs():
+    """Delete result files past their expiry and mark the jobs expired"""
+    fail_stale_report_jobs()
+    expired = ReportJob.query.filter(ReportJob.status == 'completed', ReportJob.expires_at <= datetime.utcnow()).all()
+    for job in expired:
+        if job.result_path and os.path.exists(job.result_path):
+            os.remove(job.result_path)
+        job.status = 'expired'
+        job.result_path = None
+    if expired:
+        db.session.commit()
+def serialize_report_job(job):
+    return {
+        'id': job.id,
+        'report': job.report,
+        'params': job.params or {},
+        'status': job.status,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None,
+        'content_type': job.content_type,
+        'filename': job.filename,
+        'size': job.size,
+        'error': job.error,
+        'status_url': url_for('report_job_status', job_id=job.id),
+        'download_url': url_for('download_report_job', job_id=job.id) if job.status == 'completed' else None
+    }
+def _get_user_report_job(job_id):
+    job = db.session.get(ReportJob, job_id)
+    if job is None or job.user_id != session.get('user_id'):
+        return None
+    return job
+@app.route('/api/report-jobs', methods=['GET', 'POST'])
+def report_jobs():
+    """POST {"report": "/api/reports/export/sales", "params": {...}} queues a report and returns its job id"""
+    if 'user_id' not in session:
+        return jsonify({'message': 'Authentication required'}), 401
+    user_id = session['user_id']
+    purge_expired_report_jobs()
+    if request.method == 'GET':
+        jobs = ReportJob.query.filter_by(user_id=user_id).order_by(ReportJob.created_at.desc()).limit(50).all()
+        return jsonify([serialize_report_job(job) for job in jobs])
+    data = request.get_json(silent=True) or {}
+    report = data.get('report', '')
+    params = data.get('params') or {}
+    if not isinstance(params, dict) or not is_reportable_path(report):
+        return jsonify({'message': 'report must be the path of a GET /api/reports or /api/analytics endpoint'}), 400
+    # The limits are checked by the INSERT itself, so concurrent submissions cannot both take the last slot
+    active = ReportJob.status.in_(REPORT_JOB_ACTIVE_STATUSES)
+    user_active = db.select(db.func.count()).select_from(ReportJob).where(active, ReportJob.user_id == user_id).scalar_subquery()
+    all_active = db.select(db.func.count()).select_from(ReportJob).where(active).scalar_subquery()
+    values = {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'report': report,
+        'params': {str(k): str(v) for k, v in params.items()},
+        'status': 'queued',
+        'created_at': datetime.utcnow()
+    }
+    table = ReportJob.__table__
+    inserted = db.session.execute(table.insert().from_select(
+        list(values),
+        db.select(*(db.literal(value, table.c[name].type) for name, value in values.items())).where(
+            user_active < REPORT_JOBS_PER_USER, all_active < REPORT_JOB_QUEUE_SIZE
+        )
+    )).rowcount
+    db.session.commit()
+    if not inserted:
+        if ReportJob.query.filter(active).count() < REPORT_JOB_QUEUE_SIZE:
+            return jsonify({'message': f'At most {REPORT_JOBS_PER_USER} report jobs can run per user'}), 429
+        response = jsonify({'message': 'Report queue is full, try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    job = db.session.get(ReportJob, values['id'])
+    from report_jobs import run_report_job
+    get_report_job_pool().submit(run_report_job, job.id)
+    response = jsonify(serialize_report_job(job))
+    response.headers['Location'] = url_for('report_job_status', job_id=job.id)
+    return response, 202
+@app.route('/api/report-jobs/<job_id>', methods=['GET'])
+def report_job_status(job_id):
+    job = _get_user_report_job(job_id)
+    if job is None:
+        return jsonify({'message': 'Report job not found'}), 404
+    purge_expired_report_jobs()
+    response = jsonify(serialize_report_job(job))
+    if job.status == 'completed':
+        # Clients can resume a download with Range requests against download_url
+        response.headers['Accept-Ranges'] = 'bytes'
+    return response
+@app.route('/api/report-jobs/<job_id>/download', methods=['GET'])
+def download_report_job(job_id):
+    """Serve the result file; supports Range/If-Range so interrupted downloads can resume"""
+    job = _get_user_report_job(job_id)
+    if job is None:
+        return jsonify({'message': 'Report job not found'}), 404
+    purge_expired_report_jobs()
+    if job.status == 'expired':
+        return jsonify({'message': 'Report result has expired'}), 410
+    if job.status != 'completed' or not job.result_path or not os.path.exists(job.result_path):
+        return jsonify({'message': f'Report is {job.status}', 'status': job.status}), 409
+    from flask import send_file
+    response = send_file(
+        job.result_path,
+        mimetype=job.content_type,
+        as_attachment=True,
+        download_name=job.filename,
+        conditional=True,
+        etag=True,
+        max_age=0
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
 # Database initialization function
+def missing_schema_columns():
+    """Model columns that existing tables do not have yet; db_migration.py adds them"""
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name in existing_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            missing.extend(f'{table.name}.{column.name}' for column in table.columns if column.name not in existing)
+    return missing
 def initialize_database():
     """Check if database exists and create it if necessary"""
     import os
@@ -2674,7 +6150,33 @@ def initialize_database():
         print(f"Database found at {full_db_path}. Initializing existing database...")
         # Ensure all tables exist (for schema updates)
         db.create_all()
+        # New columns on existing tables come from db_migration.py; the backfills below read them
+        missing = missing_schema_columns()
+        if missing:
+            print(f"Database schema is out of date ({len(missing)} missing column(s), e.g. {', '.join(missing[:3])}). "
+                  "Run `python db_migration.py` and restart; skipping startup backfills.")
+            return
+        # Backfill the materialized stock alerts for databases created before they existed
+        if not InventoryAlertState.query.first() and Ingredient.query.first():
+            rebuild_stock_alerts()
+        # Likewise backfill the reporting rollups
+        if not DailySales.query.first() and Order.query.filter_by(status='completed').first():
+            rebuild_rollups()
+        if not CustomerActivity.query.first() and Payment.query.filter_by(payment_status='completed').first():
+            rebuild_customer_activity()
+        if Customer.query.filter(missing_customer_lookup_keys()).first():
+            backfill_customer_lookup_keys()
+        if not LoyaltyLedger.query.first() and Customer.query.filter(Customer.loyalty_points != 0).first():
+            backfill_loyalty_ledger()
+        # Customer totals were never maintained before; compute them once
+        if not Customer.query.filter(Customer.total_orders > 0).first() and Order.query.filter(Order.customer_id.isnot(None)).first():
+            rebuild_customer_totals()
+        if not TableTurnStats.query.first() and Order.query.filter(Order.order_type == 'dine-in', Order.completed_at.isnot(None)).first():
+            rebuild_table_turn_stats()
         print("Database initialized successfully!")
+    # Stored tiers follow the thresholds; reassign them when the thresholds have changed
+    if loyalty_tiers_stale():
+        recompute_loyalty_tiers()
 # Initialize Database
 with app.app_context():
     initialize_database()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+Recompute Customer.total_orders and total_spent from completed payments, excluding
+cancelled and refunded orders, with a single aggregate UPDATE ... FROM.
+The totals are maintained on every payment and status change; run this after bulk
+data fixes or imports.
+"""
+
+import time
+from app import app, db, rebuild_customer_totals, Customer
+
+def main():
+    with app.app_context():
+        started = time.perf_counter()
+        updated = rebuild_customer_totals()
+        elapsed = time.perf_counter() - started
+        spent = db.session.query(db.func.coalesce(db.func.sum(Customer.total_spent), 0)).scalar()
+        print(f"Recomputed totals for {updated} customer(s) with orders ({spent:.2f} spent in total) in {elapsed:.2f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Columnar export of orders, order items, payments and inventory transactions for analysis.
+
+Each dataset is written as one file per calendar month under COLUMNAR_EXPORT_FOLDER:
+Parquet when pyarrow is installed, otherwise a NumPy .npz archive. A manifest keeps a
+fingerprint (row count, max id and a change marker) per partition so repeated runs only
+rebuild months that are new or have changed.
+"""
+
+import json
+import os
+from datetime import datetime
+import numpy as np
+from app import app, db, Order, OrderItem, Payment, InventoryTransaction
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional
+    pa = None
+    pq = None
+
+ORDER_STATUSES = ('pending', 'confirmed', 'cooking', 'ready', 'served', 'completed', 'cancelled', 'refunded')
+PAYMENT_STATUSES = ('pending', 'completed', 'failed', 'refunded')
+
+def _status_marker(model, column, statuses):
+    # Each status gets its own code, weighted by row id, so changing any row's status moves the total
+    code = db.case({status: i + 1 for i, status in enumerate(statuses)}, value=column, else_=len(statuses) + 1)
+    return db.func.total(code * model.id)
+
+# dataset name -> (model, partition date column, extra fingerprint expression)
+DATASETS = {
+    'orders': (Order, Order.created_at, lambda: db.func.total(Order.final_amount) + db.func.count(Order.completed_at)
+               + _status_marker(Order, Order.status, ORDER_STATUSES)),
+    'order_items': (OrderItem, Order.created_at, lambda: db.func.total(OrderItem.quantity * OrderItem.price)),
+    'payments': (Payment, Payment.payment_date, lambda: db.func.total(Payment.amount)
+                 + _status_marker(Payment, Payment.payment_status, PAYMENT_STATUSES)),
+    'inventory_transactions': (InventoryTransaction, InventoryTransaction.transaction_date,
+                               lambda: db.func.total(InventoryTransaction.quantity) + db.func.total(InventoryTransaction.total_cost)),
+}
+MANIFEST_FILE = 'manifest.json'
+
+def export_folder():
+    return app.config['COLUMNAR_EXPORT_FOLDER']
+
+def default_format():
+    return 'parquet' if pa is not None else 'npz'
+
+def _month(column):
+    return db.func.strftime('%Y-%m', column)
+
+def _base_query(dataset, *columns):
+    model, date_column, _ = DATASETS[dataset]
+    query = db.session.query(*columns)
+    if model is OrderItem:
+        # Order items have no timestamp of their own; they belong to their order's month
+        query = query.select_from(OrderItem).join(Order, Order.id == OrderItem.order_id)
+    return query
+
+def partition_fingerprints(dataset):
+    """{'YYYY-MM': [count, max_id, marker]} for every month that has rows, in one grouped query"""
+    model, date_column, marker = DATASETS[dataset]
+    month = _month(date_column)
+    rows = _base_query(dataset, month, db.func.count(model.id), db.func.max(model.id), marker()).filter(
+        date_column.isnot(None)
+    ).group_by(month).all()
+    return {row[0]: [int(row[1]), int(row[2]), round(float(row[3] or 0), 6)] for row in rows}
+
+def _column_array(column, values):
+    """Convert a list of column values into a typed NumPy array (NaN/NaT/'' stand in for NULL)"""
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return np.array([v if v is not None else None for v in values], dtype='datetime64[us]')
+    if python_type is float:
+        return np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+    if python_type is int:
+        if any(v is None for v in values):
+            return np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+        return np.array(values, dtype=np.int64)
+    if python_type is bool:
+        return np.array([bool(v) for v in values], dtype=np.bool_)
+    return np.array([v if v is not None else '' for v in values], dtype=np.str_)
+
+def _write_partition(path, columns, fmt):
+    tmp_path = path + '.tmp'
+    if fmt == 'parquet':
+        table = pa.table({name: pa.array(values) for name, values in columns.items()})
+        pq.write_table(table, tmp_path)
+    else:
+        arrays = {name: _column_array(column, values) for name, (column, values) in columns.items()}
+        with open(tmp_path, 'wb') as fh:
+            np.savez_compressed(fh, **arrays)
+    os.replace(tmp_path, path)
+
+def _load_manifest(folder):
+    path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+def _save_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def export_dataset(dataset, fmt=None, full=False):
+    """Write the changed monthly partitions of one dataset. Returns the list of months written."""
+    fmt = fmt or default_format()
+    if fmt == 'parquet' and pa is None:
+        raise RuntimeError('Parquet export requires pyarrow; install it or use the npz format')
+    model, date_column, _ = DATASETS[dataset]
+    folder = os.path.join(export_folder(), dataset)
+    os.makedirs(folder, exist_ok=True)
+    manifest = _load_manifest(folder)
+    fingerprints = partition_fingerprints(dataset)
+    stale = sorted(
+        month for month, fingerprint in fingerprints.items()
+        if full or manifest.get(month, {}).get('fingerprint') != fingerprint
+        or manifest[month].get('format') != fmt
+        or not os.path.exists(os.path.join(folder, manifest[month]['file']))
+    )
+    if not stale:
+        return []
+    table_columns = list(model.__table__.columns)
+    month = _month(date_column)
+    # One scan for all stale months; rows are bucketed per month in Python
+    buckets = {m: [[] for _ in table_columns] for m in stale}
+    rows = _base_query(dataset, month, *table_columns).filter(month.in_(stale)).order_by(model.id)
+    for row in rows.yield_per(5000):
+        bucket = buckets[row[0]]
+        for index, value in enumerate(row[1:]):
+            bucket[index].append(value)
+    extension = 'parquet' if fmt == 'parquet' else 'npz'
+    for m in stale:
+        file_name = f'{m}.{extension}'
+        if fmt == 'parquet':
+            columns = {column.name: values for column, values in zip(table_columns, buckets[m])}
+        else:
+            columns = {column.name: (column, values) for column, values in zip(table_columns, buckets[m])}
+        _write_partition(os.path.join(folder, file_name), columns, fmt)
+        previous = manifest.get(m, {}).get('file')
+        if previous and previous != file_name and os.path.exists(os.path.join(folder, previous)):
+            os.remove(os.path.join(folder, previous))
+        manifest[m] = {
+            'file': file_name,
+            'format': fmt,
+            'fingerprint': fingerprints[m],
+            'rows': fingerprints[m][0],
+            'exported_at': datetime.utcnow().isoformat()
+        }
+    # Months whose rows were all deleted no longer have a partition
+    for m in [m for m in manifest if m not in fingerprints]:
+        path = os.path.join(folder, manifest.pop(m)['file'])
+        if os.path.exists(path):
+            os.remove(path)
+    _save_manifest(folder, manifest)
+    return stale
+
+def export_all(datasets=None, fmt=None, full=False):
+    """Export every dataset (or the given ones); returns {dataset: [months written]}"""
+    return {dataset: export_dataset(dataset, fmt, full) for dataset in (datasets or DATASETS)}
+
+def load_dataset(dataset, start_month=None, end_month=None, folder=None):
+    """Load the exported partitions of a dataset (months are 'YYYY-MM', inclusive).
+    Returns a pyarrow Table for Parquet exports or a dict of concatenated NumPy arrays for npz."""
+    folder = os.path.join(folder or export_folder(), dataset)
+    manifest = _load_manifest(folder)
+    months = sorted(m for m in manifest
+                    if (start_month is None or m >= start_month) and (end_month is None or m <= end_month))
+    if not months:
+        return {}
+    if manifest[months[0]]['format'] == 'parquet':
+        return pa.concat_tables([pq.read_table(os.path.join(folder, manifest[m]['file'])) for m in months])
+    parts = [np.load(os.path.join(folder, manifest[m]['file'])) for m in months]
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0].files}
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='Export orders, order items, payments and inventory transactions as monthly columnar partitions')
+    parser.add_argument('--full', action='store_true', help='rebuild every partition instead of only new or changed months')
+    parser.add_argument('--format', choices=['parquet', 'npz'], help='defaults to parquet when pyarrow is installed, npz otherwise')
+    parser.add_argument('datasets', nargs='*', help=f"datasets to export (default: all of {', '.join(DATASETS)})")
+    args = parser.parse_args()
+    unknown = [d for d in args.datasets if d not in DATASETS]
+    if unknown:
+        parser.error(f"unknown dataset(s): {', '.join(unknown)}")
+    with app.app_context():
+        started = time.perf_counter()
+        written = export_all(args.datasets or None, args.format, args.full)
+        elapsed = time.perf_counter() - started
+        for dataset, months in written.items():
+            print(f"{dataset}: {len(months)} partition(s) written" + (f" ({', '.join(months)})" if months else ''))
+        print(f"Columnar export to {export_folder()} finished in {elapsed:.2f}s")
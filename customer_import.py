@@ -0,0 +1,278 @@
+"""
+Bulk customer import from CSV or JSON Lines, e.g. a loyalty list exported from another POS.
+
+Rows are streamed in batches. Email (lower-cased) and phone (digits only) are normalized the
+same way as the customer lookup keys and used to deduplicate: against rows seen earlier in the
+file through in-memory hash maps, and against existing customers through indexed IN lookups on
+the normalized columns. A duplicate is merged into the matching customer (its points are added
+through the loyalty ledger and missing contact fields are filled in); everything else is
+inserted. Each batch is one transaction.
+
+Recognised columns: first_name, last_name (or name), email, phone, loyalty_points (or points).
+"""
+
+import codecs
+import csv
+import io
+import json
+import time
+from datetime import datetime
+from app import (
+    app, db, Customer, LoyaltyLedger, loyalty_tier_case, get_customer_loyalty_tier,
+    normalize_phone, normalize_email, normalize_customer_name
+)
+
+IMPORT_BATCH_SIZE = 5000
+MAX_REPORTED_REJECTIONS = 100
+MIN_PHONE_DIGITS = 7
+MAX_IMPORT_POINTS = 10 ** 9  # well inside a 64-bit INTEGER, even after merging many rows
+
+def detect_format(filename):
+    return 'jsonl' if (filename or '').lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+def find_invalid_utf8(stream):
+    """Line number of the first bytes that are not UTF-8, or None. Reads a seekable binary stream and rewinds it,
+    so a bad file is rejected before any batch is committed."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    line_number = 1
+    try:
+        for chunk in iter(lambda: stream.read(1 << 16), b''):
+            try:
+                decoder.decode(chunk)
+            except UnicodeDecodeError as e:
+                return line_number + chunk[:max(e.start, 0)].count(b'\n')
+            line_number += chunk.count(b'\n')
+        try:
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return line_number
+        return None
+    finally:
+        stream.seek(0)
+
+def iter_records(stream, fmt='csv'):
+    """Yield (line number, dict) from a text or binary stream without reading it all into memory"""
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_number, record if isinstance(record, dict) else None
+    else:
+        reader = csv.DictReader(stream)
+        if reader.fieldnames:
+            reader.fieldnames = [(name or '').strip().lower() for name in reader.fieldnames]
+        for record in reader:
+            yield reader.line_num, record
+
+def clean_record(record):
+    """Normalize one input row into customer fields, or return the reason it is rejected"""
+    if record is None:
+        return None, 'unreadable row'
+    def text(*keys):
+        for key in keys:
+            value = record.get(key)
+            if value is not None and str(value).strip():
+                return str(value).strip()
+        return None
+    first_name, last_name = text('first_name', 'firstname'), text('last_name', 'lastname', 'surname')
+    if not first_name and not last_name and text('name'):
+        first_name, _, last_name = text('name').partition(' ')
+    email, phone = text('email'), text('phone', 'mobile')
+    email_key, phone_key = normalize_email(email), normalize_phone(phone)
+    if email_key and ('@' not in email_key or ' ' in email_key):
+        return None, f'invalid email {email!r}'
+    if phone and (not phone_key or len(phone_key) < MIN_PHONE_DIGITS):
+        return None, f'invalid phone {phone!r}'
+    if not email_key and not phone_key:
+        return None, 'no email or phone to identify the customer'
+    points = text('loyalty_points', 'points') or '0'
+    try:
+        points = int(float(points))
+    except (ValueError, OverflowError):  # 'abc', 'nan', 'inf'
+        return None, f'invalid loyalty points {points!r}'
+    if points < 0:
+        return None, 'negative loyalty points'
+    if points > MAX_IMPORT_POINTS:
+        return None, f'loyalty points above {MAX_IMPORT_POINTS}'
+    return {
+        'first_name': (first_name or '')[:50],
+        'last_name': (last_name or '')[:50],
+        'email': email[:120] if email else None,
+        'phone': phone[:20] if phone else None,
+        'email_normalized': email_key,
+        'phone_normalized': phone_key,
+        'loyalty_points': points
+    }, None
+
+class CustomerImporter:
+    """Accumulates the import report and the hash maps that dedupe across batches"""
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, created_by=None):
+        self.batch_size = batch_size
+        self.created_by = created_by
+        self.by_email = {}  # normalized email -> customer id, for rows already written
+        self.by_phone = {}  # normalized phone -> customer id
+        self.report = {'inserted': 0, 'merged': 0, 'rejected': 0, 'rejections': []}
+
+    def reject(self, line_number, reason):
+        self.report['rejected'] += 1
+        if len(self.report['rejections']) < MAX_REPORTED_REJECTIONS:
+            self.report['rejections'].append({'line': line_number, 'reason': reason})
+
+    def run(self, records):
+        started = time.perf_counter()
+        batch = []
+        for line_number, record in records:
+            row, reason = clean_record(record)
+            if row is None:
+                self.reject(line_number, reason)
+                continue
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                batch = []
+        if batch:
+            self.write_batch(batch)
+        self.report['elapsed_seconds'] = round(time.perf_counter() - started, 2)
+        return self.report
+
+    def _lookup_existing(self, rows):
+        """One indexed IN query per key type for the keys this batch has not seen before"""
+        emails = {r['email_normalized'] for r in rows if r['email_normalized'] and r['email_normalized'] not in self.by_email}
+        phones = {r['phone_normalized'] for r in rows if r['phone_normalized'] and r['phone_normalized'] not in self.by_phone}
+        if emails:
+            for customer_id, key in db.session.query(Customer.id, Customer.email_normalized).filter(
+                Customer.email_normalized.in_(emails)
+            ).order_by(Customer.id.desc()):
+                self.by_email[key] = customer_id  # oldest customer wins on duplicates already in the table
+        if phones:
+            for customer_id, key in db.session.query(Customer.id, Customer.phone_normalized).filter(
+                Customer.phone_normalized.in_(phones)
+            ).order_by(Customer.id.desc()):
+                self.by_phone[key] = customer_id
+
+    def write_batch(self, rows):
+        self._lookup_existing(rows)
+        merges = {}  # existing customer id -> accumulated merge
+        new_rows = []
+        pending_email = {}  # keys of rows inserted by this batch -> index in new_rows
+        pending_phone = {}
+        for row in rows:
+            email_key, phone_key = row['email_normalized'], row['phone_normalized']
+            customer_id = self.by_email.get(email_key) if email_key else None
+            if customer_id is None and phone_key:
+                customer_id = self.by_phone.get(phone_key)
+            if customer_id is not None:
+                merge = merges.setdefault(customer_id, {'points': 0})
+                merge['points'] += row['loyalty_points']
+                for field in ('email', 'email_normalized', 'phone', 'phone_normalized'):
+                    merge[field] = merge.get(field) or row[field]
+                # Later rows with this row's other key belong to the same customer
+                if email_key:
+                    self.by_email.setdefault(email_key, customer_id)
+                if phone_key:
+                    self.by_phone.setdefault(phone_key, customer_id)
+                self.report['merged'] += 1
+                continue
+            index = pending_email.get(email_key) if email_key else None
+            if index is None and phone_key:
+                index = pending_phone.get(phone_key)
+            if index is not None:
+                # Same customer twice in this batch: fold into the row waiting to be inserted
+                target = new_rows[index]
+                target['loyalty_points'] += row['loyalty_points']
+                for field in ('first_name', 'last_name', 'email', 'email_normalized', 'phone', 'phone_normalized'):
+                    target[field] = target[field] or row[field]
+                self.report['merged'] += 1
+            else:
+                new_rows.append(dict(row))
+                index = len(new_rows) - 1
+            # Register this row's keys as well as the target's: a folded row's other key
+            # (e.g. a second email) must lead later rows to the same customer
+            target = new_rows[index]
+            for key in (email_key, target['email_normalized']):
+                if key:
+                    pending_email.setdefault(key, index)
+            for key in (phone_key, target['phone_normalized']):
+                if key:
+                    pending_phone.setdefault(key, index)
+        now = datetime.utcnow()
+        ledger = []
+        if new_rows:
+            for row in new_rows:
+                row['name_normalized'] = normalize_customer_name(row['first_name'], row['last_name'])
+                row['reversed_name_normalized'] = normalize_customer_name(row['last_name'], row['first_name'])
+                row['loyalty_tier'] = get_customer_loyalty_tier(row['loyalty_points'])
+                row['created_at'] = now
+            inserted = db.session.execute(
+                Customer.__table__.insert().returning(Customer.__table__.c.id, sort_by_parameter_order=True), new_rows
+            ).scalars().all()
+            for key, index in pending_email.items():
+                self.by_email[key] = inserted[index]
+            for key, index in pending_phone.items():
+                self.by_phone[key] = inserted[index]
+            for customer_id, row in zip(inserted, new_rows):
+                if row['loyalty_points']:
+                    ledger.append({'customer_id': customer_id, 'entry_type': 'opening', 'points': row['loyalty_points']})
+            self.report['inserted'] += len(new_rows)
+        if merges:
+            self._apply_merges(merges, ledger)
+        if ledger:
+            for entry in ledger:
+                entry.update(order_id=None, description='Customer import', created_by=self.created_by, created_at=now)
+            db.session.execute(LoyaltyLedger.__table__.insert(), ledger)
+        db.session.commit()
+
+    def _apply_merges(self, merges, ledger):
+        """Add merged points and fill blank contact fields on existing customers in one executemany"""
+        table = Customer.__table__
+        balance = db.func.coalesce(table.c.loyalty_points, 0) + db.bindparam('points')
+        # An email is only filled in when no other customer already uses it
+        email_taken = db.select(db.literal(1)).where(table.c.email_normalized == db.bindparam('email_normalized')).exists()
+        statement = table.update().where(table.c.id == db.bindparam('customer_id')).values(
+            loyalty_points=balance,
+            loyalty_tier=loyalty_tier_case(balance),
+            email=db.case((db.and_(table.c.email.is_(None), ~email_taken), db.bindparam('email')), else_=table.c.email),
+            email_normalized=db.case((db.and_(table.c.email.is_(None), ~email_taken), db.bindparam('email_normalized')), else_=table.c.email_normalized),
+            phone=db.func.coalesce(table.c.phone, db.bindparam('phone')),
+            phone_normalized=db.func.coalesce(table.c.phone_normalized, db.bindparam('phone_normalized'))
+        )
+        db.session.execute(statement, [{
+            'customer_id': customer_id,
+            'points': merge['points'],
+            'email': merge['email'],
+            'email_normalized': merge['email_normalized'],
+            'phone': merge['phone'],
+            'phone_normalized': merge['phone_normalized']
+        } for customer_id, merge in merges.items()])
+        ledger.extend({'customer_id': customer_id, 'entry_type': 'adjustment', 'points': merge['points']}
+                      for customer_id, merge in merges.items() if merge['points'])
+
+def import_customers(stream, fmt='csv', batch_size=IMPORT_BATCH_SIZE, created_by=None):
+    """Import customers from a CSV or JSONL stream; returns the inserted/merged/rejected report"""
+    return CustomerImporter(batch_size, created_by).run(iter_records(stream, fmt))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Import customers from a CSV or JSON Lines file, merging duplicates by email and phone')
+    parser.add_argument('path', help='file to import')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='defaults to the file extension')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='rows per transaction')
+    args = parser.parse_args()
+    with app.app_context():
+        with open(args.path, 'rb') as fh:
+            bad_line = find_invalid_utf8(fh)
+            if bad_line:
+                parser.exit(1, f"{args.path} is not UTF-8 encoded (line {bad_line}); nothing was imported\n")
+            report = import_customers(fh, args.format or detect_format(args.path), args.batch_size)
+        print(f"Inserted {report['inserted']}, merged {report['merged']}, rejected {report['rejected']} "
+              f"in {report['elapsed_seconds']:.2f}s")
+        for rejection in report['rejections']:
+            print(f"  line {rejection['line']}: {rejection['reason']}")
@@ -138,6 +138,249 @@ def migrate_settings_table():
         if conn:
             conn.close()
 
+def add_missing_columns(table, columns):
+    """Add columns that db.create_all() cannot add to an existing table"""
+    conn = None
+    try:
+        conn = sqlite3.connect('instance/restaurant.db')
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+        if not cursor.fetchone():
+            print(f"Table {table} does not exist yet. It will be created by the application.")
+            return
+
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        for name, definition in columns:
+            if name in existing:
+                continue
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+            print(f"Added column {table}.{name}")
+
+        conn.commit()
+
+    except Exception as e:
+        print(f"Error adding columns to {table}: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+
+def migrate_inventory_transactions_table():
+    """Link inventory transactions to supplier deliveries and ingredient lots"""
+    add_missing_columns('inventory_transactions', [
+        ('delivery_id', 'INTEGER REFERENCES supplier_deliveries(id)'),
+        ('lot_id', 'INTEGER REFERENCES ingredient_lots(id)'),
+        ('unit_cost', 'FLOAT'),
+        ('total_cost', 'FLOAT'),
+    ])
+
+def migrate_inventory_transaction_costs():
+    """Backfill the cost snapshot on inventory transactions written before it existed.
+    Uses the lot's cost where the transaction is lot-tracked, otherwise the ingredient's current cost.
+    A failure is raised so the migration run does not report success with costs left NULL."""
+    conn = None
+    try:
+        conn = sqlite3.connect('instance/restaurant.db')
+        cursor = conn.cursor()
+
+        cursor.execute("PRAGMA table_info(inventory_transactions)")
+        if 'unit_cost' not in {row[1] for row in cursor.fetchall()}:
+            print("Inventory transaction cost columns do not exist yet. Skipping cost backfill.")
+            return
+
+        # Databases from before lot tracking have no ingredient_lots table (and no lot-tracked transactions)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ingredient_lots'")
+        lot_cost = (
+            "(SELECT cost_per_unit FROM ingredient_lots WHERE ingredient_lots.id = inventory_transactions.lot_id),"
+            if cursor.fetchone() else ""
+        )
+        cursor.execute(f"""
+            UPDATE inventory_transactions SET unit_cost = COALESCE(
+                {lot_cost}
+                (SELECT cost_per_unit FROM ingredients WHERE ingredients.id = inventory_transactions.ingredient_id),
+                0.0
+            )
+            WHERE unit_cost IS NULL
+        """)
+        updated = cursor.rowcount
+        cursor.execute("UPDATE inventory_transactions SET total_cost = quantity * unit_cost WHERE total_cost IS NULL")
+
+        conn.commit()
+        print(f"Backfilled cost on {updated} inventory transaction(s).")
+
+    except Exception as e:
+        print(f"Error backfilling inventory transaction costs: {e}")
+        if conn:
+            conn.rollback()
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+def migrate_lifecycle_timestamps():
+    """Add order, item and table lifecycle timestamps used by the latency histograms"""
+    add_missing_columns('orders', [
+        ('confirmed_at', 'DATETIME'),
+        ('first_item_ready_at', 'DATETIME'),
+    ])
+    add_missing_columns('order_items', [
+        ('started_at', 'DATETIME'),
+        ('ready_at', 'DATETIME'),
+        ('served_at', 'DATETIME'),
+    ])
+    add_missing_columns('tables', [
+        ('occupied_since', 'DATETIME'),
+    ])
+
+def migrate_floor_state():
+    """Add the seated order and party size shown in the live floor state"""
+    add_missing_columns('tables', [
+        ('current_order_id', 'INTEGER'),
+        ('party_size', 'INTEGER'),
+    ])
+
+def migrate_customer_lookup_keys():
+    """Add the normalized phone/email/name columns used by the customer type-ahead lookup.
+    The values are backfilled by the application on startup."""
+    add_missing_columns('customers', [
+        ('phone_normalized', 'VARCHAR(20)'),
+        ('email_normalized', 'VARCHAR(120)'),
+        ('name_normalized', 'VARCHAR(101)'),
+        ('reversed_name_normalized', 'VARCHAR(101)'),
+    ])
+
+def migrate_customer_loyalty_tier():
+    """Store the loyalty tier on customers; the application assigns it on startup"""
+    add_missing_columns('customers', [
+        ('loyalty_tier', "VARCHAR(20) NOT NULL DEFAULT 'bronze'"),
+    ])
+
+def migrate_reservation_durations():
+    """Give reservations a duration and a stored end time for overlap checks"""
+    add_missing_columns('reservations', [
+        ('duration_minutes', 'INTEGER NOT NULL DEFAULT 90'),
+        ('end_time', 'DATETIME'),
+    ])
+    conn = None
+    try:
+        conn = sqlite3.connect('instance/restaurant.db')
+        cursor = conn.cursor()
+
+        cursor.execute("PRAGMA table_info(reservations)")
+        if 'end_time' not in {row[1] for row in cursor.fetchall()}:
+            return
+
+        cursor.execute("""
+            UPDATE reservations
+            SET end_time = strftime('%Y-%m-%d %H:%M:%f000', reservation_time, '+' || duration_minutes || ' minutes')
+            WHERE end_time IS NULL AND reservation_time IS NOT NULL
+        """)
+        updated = cursor.rowcount
+
+        conn.commit()
+        print(f"Backfilled end time on {updated} reservation(s).")
+
+    except Exception as e:
+        print(f"Error backfilling reservation end times: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+
+def migrate_ingredients_table():
+    """Add reorder and purchasing columns to ingredients"""
+    add_missing_columns('ingredients', [
+        ('lead_time_days', 'FLOAT'),
+        ('supplier_id', 'INTEGER REFERENCES suppliers(id)'),
+        ('pack_size', 'FLOAT'),
+        ('min_order_qty', 'FLOAT'),
+    ])
+
+def migrate_ingredient_suppliers():
+    """Link ingredients to Supplier rows based on the free-text supplier column"""
+    conn = None
+    try:
+        conn = sqlite3.connect('instance/restaurant.db')
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='suppliers'")
+        if not cursor.fetchone():
+            print("Suppliers table does not exist yet. Skipping supplier linking.")
+            return
+
+        cursor.execute("""
+            SELECT DISTINCT TRIM(supplier) FROM ingredients
+            WHERE supplier_id IS NULL AND supplier IS NOT NULL AND TRIM(supplier) != ''
+        """)
+        names = [row[0] for row in cursor.fetchall()]
+        for name in names:
+            cursor.execute("SELECT id FROM suppliers WHERE LOWER(name) = LOWER(?)", (name,))
+            row = cursor.fetchone()
+            if row:
+                supplier_id = row[0]
+            else:
+                cursor.execute("INSERT INTO suppliers (name, created_at) VALUES (?, ?)", (name, datetime.utcnow()))
+                supplier_id = cursor.lastrowid
+            cursor.execute(
+                "UPDATE ingredients SET supplier_id = ? WHERE supplier_id IS NULL AND LOWER(TRIM(supplier)) = LOWER(?)",
+                (supplier_id, name)
+            )
+
+        conn.commit()
+        print(f"Linked ingredients to {len(names)} supplier(s).")
+
+    except Exception as e:
+        print(f"Error linking ingredient suppliers: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+
+def create_missing_indexes(indexes):
+    """Create indexes that db.create_all() does not add to existing tables"""
+    conn = None
+    try:
+        conn = sqlite3.connect('instance/restaurant.db')
+        cursor = conn.cursor()
+
+        for name, table, columns in indexes:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+            if not cursor.fetchone():
+                continue
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+        conn.commit()
+        print(f"Ensured {len(indexes)} index(es).")
+
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+
+def migrate_report_indexes():
+    """Covering indexes used by SQL-side report aggregation"""
+    create_missing_indexes([
+        ('ix_orders_status_created_final', 'orders', ['status', 'created_at', 'final_amount']),
+        ('ix_inventory_transactions_type_date_cost', 'inventory_transactions', ['transaction_type', 'transaction_date', 'total_cost']),
+        ('ix_customers_total_spent', 'customers', ['total_spent']),
+        ('ix_customers_phone_normalized', 'customers', ['phone_normalized']),
+        ('ix_customers_email_normalized', 'customers', ['email_normalized']),
+        ('ix_customers_name_normalized', 'customers', ['name_normalized']),
+        ('ix_customers_reversed_name_normalized', 'customers', ['reversed_name_normalized']),
+        ('ix_customers_created_at', 'customers', ['created_at']),
+        ('ix_customers_loyalty_tier', 'customers', ['loyalty_tier']),
+        ('ix_reservations_table_start_end', 'reservations', ['table_id', 'reservation_time', 'end_time']),
+        ('ix_reservations_start_end', 'reservations', ['reservation_time', 'end_time']),
+    ])
+
 def run_migrations():
     """Run all database migrations"""
     print("Starting database migrations...")
@@ -146,9 +389,25 @@ def run_migrations():
     import os
     os.makedirs('instance', exist_ok=True)
 
+    # Create the tables the application defines but this database does not have yet
+    # (e.g. ingredient_lots, which the backfills below read)
+    from app import app, db
+    with app.app_context():
+        db.create_all()
+
     # Run migrations
     migrate_settings_table()
     migrate_roles_table()
+    migrate_inventory_transactions_table()
+    migrate_inventory_transaction_costs()
+    migrate_ingredients_table()
+    migrate_lifecycle_timestamps()
+    migrate_floor_state()
+    migrate_customer_lookup_keys()
+    migrate_customer_loyalty_tier()
+    migrate_reservation_durations()
+    migrate_ingredient_suppliers()
+    migrate_report_indexes()
 
     print("All migrations completed successfully!")
 
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Rebuild the reporting rollup tables (daily_sales, hourly_sales, daily_item_sales,
+daily_ingredient_usage, customer and cohort activity) from the raw orders, payments
+and inventory transactions.
+The rollups are maintained on every write; run this after bulk data fixes or imports.
+"""
+
+import time
+from app import app, rebuild_rollups, DailySales, DailyItemSales, DailyIngredientUsage
+
+def main():
+    with app.app_context():
+        started = time.perf_counter()
+        rebuild_rollups()
+        elapsed = time.perf_counter() - started
+        print(f"Rebuilt rollups: {DailySales.query.count()} sales days, "
+              f"{DailyItemSales.query.count()} item-days, "
+              f"{DailyIngredientUsage.query.count()} ingredient-days in {elapsed:.2f}s")
+
+if __name__ == '__main__':
+    main()
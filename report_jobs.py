@@ -0,0 +1,59 @@
+"""
+Worker side of the report job subsystem.
+
+Jobs are queued in the report_jobs table by POST /api/report-jobs and executed here, in a
+separate process from the web workers (see get_report_job_pool in app.py). The worker renders
+the requested report through the normal GET view and writes the response body to disk.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+def init_report_worker():
+    """Drop database connections inherited from the forking web worker; the child opens its own"""
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def run_report_job(job_id):
+    """Render one queued report job to its result file and record the outcome on the job row"""
+    from app import app, db, ReportJob, REPORT_JOB_RESULT_TTL_HOURS
+    with app.app_context():
+        # Claim the job atomically; another process may have picked it up already
+        claimed = db.session.execute(
+            ReportJob.__table__.update().where(
+                ReportJob.id == job_id, ReportJob.status == 'queued'
+            ).values(status='running', started_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(ReportJob, job_id)
+        folder = app.config['REPORT_JOB_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        try:
+            with app.test_client() as client:
+                response = client.get(job.report, query_string=job.params or {})
+            if response.status_code != 200:
+                raise RuntimeError(f'{job.report} returned {response.status_code}: {response.get_data(as_text=True)[:500]}')
+            content_type = response.headers.get('Content-Type', 'application/octet-stream')
+            extension = 'csv' if 'text/csv' in content_type else 'json' if 'json' in content_type else 'bin'
+            path = os.path.join(folder, f'{job.id}.{extension}')
+            with open(path + '.tmp', 'wb') as fh:
+                fh.write(response.get_data())
+            os.replace(path + '.tmp', path)
+            disposition = response.headers.get('Content-Disposition', '')
+            filename = disposition.split('filename=', 1)[1].strip('"') if 'filename=' in disposition else None
+            now = datetime.utcnow()
+            job.status = 'completed'
+            job.result_path = path
+            job.content_type = content_type
+            job.filename = filename or f"{job.report.strip('/').replace('/', '_')}.{extension}"
+            job.size = os.path.getsize(path)
+            job.finished_at = now
+            job.expires_at = now + timedelta(hours=REPORT_JOB_RESULT_TTL_HOURS)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""
+Recalculate reorder points, safety stock and par levels for all ingredients.
+Run this nightly (e.g. from cron) so /api/inventory/low-stock uses fresh demand estimates.
+"""
+
+import sys
+import time
+from app import app, recalculate_reorder_points, REORDER_HISTORY_DAYS
+
+def main():
+    history_days = int(sys.argv[1]) if len(sys.argv) > 1 else REORDER_HISTORY_DAYS
+    with app.app_context():
+        started = time.perf_counter()
+        count = recalculate_reorder_points(history_days)
+        elapsed = time.perf_counter() - started
+        print(f"Recalculated reorder points for {count} ingredients using {history_days} days of history in {elapsed:.2f}s")
+
+if __name__ == '__main__':
+    main()